@@ -0,0 +1,104 @@
+"""
+Compare fixed and adaptive (AIMD) concurrency against stubs that throttle above a capacity.
+
+Both stages run with the same worker pool. With a fixed limit every worker keeps
+sending and the excess is answered with 429s; the adaptive limiter should settle near
+the stub's capacity instead, with far fewer 429s and no failed rows.
+
+Run from the repository root:
+    python benchmarks/bench_adaptive.py --rows 200 --capacity 6 --workers 24 --latency 0.05
+"""
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_clients import FakeOpenAIClient
+from stub_servers import start_stub_server
+
+
+def write_inputs(rows):
+    with open('input.csv', 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['image_id', 'context', 'description'])
+        for i in range(1, rows + 1):
+            writer.writerow([i, 'bench', f"Description {i}"])
+    with open('enhanced.csv', 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['image_id', 'context', 'original_description', 'enhanced_description'])
+        for i in range(1, rows + 1):
+            writer.writerow([i, 'bench', f"Description {i}", f"Enhanced description {i}"])
+
+
+def count_rows(path, column):
+    with open(path, newline='') as file:
+        return sum(1 for row in csv.DictReader(file) if row.get(column))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200)
+    parser.add_argument('--capacity', type=int, default=6, help="Concurrent requests each stub accepts before answering 429")
+    parser.add_argument('--workers', type=int, default=24, help="Worker pool size, and the adaptive limit's ceiling")
+    parser.add_argument('--latency', type=float, default=0.05, help="Stub response delay in seconds")
+    args = parser.parse_args()
+
+    import generate_descriptions
+    import generate_images
+    import metrics
+    from config import CONFIG
+
+    prompts_path = os.path.abspath('./configs/describe.yml')
+    for adaptive in (False, True):
+        server = start_stub_server(latency=args.latency, capacity=args.capacity, retry_after=0)
+        generate_images.STABILITY_API_URL = server.url
+        fake = FakeOpenAIClient(latency=args.latency, capacity=args.capacity, retry_after=0.05)
+        generate_descriptions.set_client(fake)
+        registry = metrics.MetricsRegistry()
+        metrics.set_registry(registry)
+
+        # No request/token buckets, so concurrency is the only limit in play
+        config = dict(CONFIG, cache={'enabled': False}, concurrency={
+            'adaptive': dict(CONFIG['concurrency'].get('adaptive', {}), enabled=adaptive),
+            'images': {'requests_per_minute': 0},
+            'descriptions': {'requests_per_minute': 0, 'tokens_per_minute': 0, 'max_retries': 20}
+        })
+        with tempfile.TemporaryDirectory() as workdir:
+            cwd = os.getcwd()
+            os.makedirs(os.path.join(workdir, 'configs'))
+            os.symlink(prompts_path, os.path.join(workdir, 'configs', 'describe.yml'))
+            os.chdir(workdir)
+            try:
+                write_inputs(args.rows)
+                start = time.perf_counter()
+                generate_descriptions.process_csv('input.csv', 'described.csv', config, workers=args.workers)
+                describe_elapsed = time.perf_counter() - start
+                start = time.perf_counter()
+                generate_images.process_descriptions('enhanced.csv', 'images.csv', config, workers=args.workers)
+                generate_elapsed = time.perf_counter() - start
+                described = count_rows('described.csv', 'enhanced_description')
+                generated = count_rows('images.csv', 'file_name')
+            finally:
+                os.chdir(cwd)
+        server.shutdown()
+
+        summary = registry.summary()
+        mode = "adaptive" if adaptive else "fixed"
+        for stage, done, elapsed, throttled, peak in (
+            ('descriptions', described, describe_elapsed, fake.throttled_count, fake.peak_in_flight),
+            ('images', generated, generate_elapsed, server.throttled_count, server.peak_in_flight),
+        ):
+            limit = summary['gauges'].get(f'concurrency_limit{{stage="{stage}"}}')
+            backoffs = sum(value for name, value in summary['counters'].items()
+                           if name.startswith('concurrency_backoffs_total') and f'stage="{stage}"' in name)
+            print(f"{mode:<9} {stage:<13} rows={done}/{args.rows} elapsed={elapsed:.2f}s rows/s={done / elapsed:.1f} "
+                  f"429s={throttled} peak_in_flight={peak} "
+                  f"final_limit={'-' if limit is None else f'{limit:.1f}'} backoffs={backoffs}")
+
+
+if __name__ == "__main__":
+    main()
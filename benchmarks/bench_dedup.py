@@ -0,0 +1,62 @@
+"""
+Measure near-duplicate prompt detection on synthetic prompts.
+
+Prompts are drawn from a pool of base prompts with the shared style suffix, and a
+fraction get one or more words replaced. The benchmark reports indexing time,
+how many prompts would reuse an earlier image, and peak RSS, so scaling to
+100k prompts can be checked without calling any API.
+
+Run from the repository root:
+    python benchmarks/bench_dedup.py --prompts 10000 100000 --distinct 30000 --edits 1
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STYLE_SUFFIX = "illustration by (Studio Ghibli style, Art by Hayao Miyazaki:1.2), 2D anime, soft warm colors"
+
+
+def make_prompts(count, distinct, edits, words=60, seed=0):
+    generator = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(5000)]
+    bases = [[generator.choice(vocabulary) for _ in range(words)] for _ in range(distinct)]
+    prompts = []
+    for _ in range(count):
+        prompt = list(generator.choice(bases))
+        if generator.random() < 0.5:
+            for _ in range(edits):
+                prompt[generator.randrange(words)] = generator.choice(vocabulary)
+        prompts.append(f"{' '.join(prompt)}, {STYLE_SUFFIX}")
+    return prompts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--prompts', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--distinct', type=int, default=30000, help="Number of base prompts")
+    parser.add_argument('--edits', type=int, default=1, help="Words replaced in an edited prompt")
+    parser.add_argument('--threshold', type=float, default=0.9)
+    args = parser.parse_args()
+
+    from dedup import NearDuplicateIndex
+    from config import CONFIG
+
+    ignore_phrases = [phrase.lower() for phrase in CONFIG.get('dedup', {}).get('ignore_phrases') or []]
+    for count in args.prompts:
+        prompts = make_prompts(count, min(args.distinct, count), args.edits)
+        index = NearDuplicateIndex(threshold=args.threshold, ignore_phrases=ignore_phrases)
+        start = time.perf_counter()
+        reused = sum(index.match_or_add(i, prompt) is not None for i, prompt in enumerate(prompts))
+        elapsed = time.perf_counter() - start
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"prompts={count} elapsed={elapsed:.2f}s prompts/s={count / elapsed:.0f} "
+              f"reused={reused} generated={len(index)} peak_rss={peak_rss_mb:.0f}MB")
+
+
+if __name__ == "__main__":
+    main()
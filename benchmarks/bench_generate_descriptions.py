@@ -0,0 +1,69 @@
+"""
+Compare serial and concurrent description enhancement against an in-process fake OpenAI client.
+
+Run from the repository root:
+    python benchmarks/bench_generate_descriptions.py --rows 40 --latency 0.2 --workers 1 8 --throttle-rate 0.05
+    python benchmarks/bench_generate_descriptions.py --rows 40 --workers 4 --batch-size 1 10
+"""
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_clients import FakeOpenAIClient
+
+
+def write_input_csv(path, rows):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['image_id', 'context', 'description'])
+        for i in range(1, rows + 1):
+            writer.writerow([i, 'bench', f"Description {i}"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.2, help="Fake completion delay in seconds")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Fraction of calls answered with 429")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[1], help="Descriptions per request")
+    args = parser.parse_args()
+
+    import generate_descriptions
+    from config import CONFIG
+
+    # Unlimited buckets so only the worker count and the fake's latency matter
+    config = dict(CONFIG, concurrency={'descriptions': {'requests_per_minute': 0, 'tokens_per_minute': 0}},
+                  cache={'enabled': False})
+    prompts_path = os.path.abspath('./configs/describe.yml')
+    baseline = None
+    runs = [(workers, batch_size) for workers in args.workers for batch_size in args.batch_size]
+    for workers, batch_size in runs:
+        fake = FakeOpenAIClient(latency=args.latency, throttle_rate=args.throttle_rate, retry_after=0.1)
+        generate_descriptions.set_client(fake)
+        with tempfile.TemporaryDirectory() as workdir:
+            cwd = os.getcwd()
+            os.makedirs(os.path.join(workdir, 'configs'))
+            os.symlink(prompts_path, os.path.join(workdir, 'configs', 'describe.yml'))
+            os.chdir(workdir)
+            try:
+                write_input_csv('input.csv', args.rows)
+                start = time.perf_counter()
+                generate_descriptions.process_csv('input.csv', 'enhanced.csv', config, workers=workers, batch_size=batch_size)
+                elapsed = time.perf_counter() - start
+            finally:
+                os.chdir(cwd)
+
+        baseline = baseline or elapsed
+        print(f"workers={workers:<3} batch={batch_size:<3} rows={args.rows} requests={fake.request_count} "
+              f"throttled={fake.throttled_count} tokens/row={fake.total_tokens / args.rows:.0f} "
+              f"elapsed={elapsed:.2f}s rows/s={args.rows / elapsed:.1f} speedup={baseline / elapsed:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Compare serial and concurrent image generation against a local stub Stability server.
+
+Run from the repository root:
+    python benchmarks/bench_generate_images.py --rows 40 --latency 0.2 --workers 1 8
+"""
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import start_stub_server
+
+
+def write_input_csv(path, rows):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['image_id', 'context', 'original_description', 'enhanced_description'])
+        for i in range(1, rows + 1):
+            writer.writerow([i, 'bench', f"Description {i}", f"Enhanced description {i}"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.2, help="Stub response delay in seconds")
+    parser.add_argument('--payload-size', type=int, default=0, help="Stub image size in bytes")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8])
+    args = parser.parse_args()
+
+    server = start_stub_server(latency=args.latency, payload_size=args.payload_size)
+    os.environ['STABILITY_API_URL'] = server.url
+
+    # Imported after the stub URL is set; config files are read relative to the repo root
+    import generate_images
+    from config import CONFIG
+
+    config = dict(CONFIG, concurrency={'images': {'requests_per_minute': 0}}, cache={'enabled': False})
+    baseline = None
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as workdir:
+            cwd = os.getcwd()
+            os.chdir(workdir)
+            try:
+                write_input_csv('enhanced.csv', args.rows)
+                start = time.perf_counter()
+                generate_images.process_descriptions('enhanced.csv', 'images.csv', config, workers=workers)
+                elapsed = time.perf_counter() - start
+                generated = len(os.listdir(config['output']['directory']))
+            finally:
+                os.chdir(cwd)
+
+        baseline = baseline or elapsed
+        print(f"workers={workers:<3} rows={args.rows} images={generated} "
+              f"elapsed={elapsed:.2f}s rows/s={args.rows / elapsed:.1f} speedup={baseline / elapsed:.1f}x")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Measure start-up cost: importing main.py, and a full no-op run of main.main().
+
+The no-op run uses a scratch directory where images.csv, the images, the validation
+manifest and the S3 sync state are all up to date, so main.main() validates, finds
+nothing to do and exits without touching the network.
+
+Run from the repository root:
+    python benchmarks/bench_startup.py --repeat 5 --images 1000
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path[:0] = [REPO_DIR, BENCHMARK_DIR]
+
+from stub_servers import make_png_payload
+
+BUCKET_NAME = "image-batch-benchmark"
+
+
+def timed_run(code, cwd, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=cwd, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def slowest_imports(cwd, env, count):
+    """Return the modules with the largest cumulative import time when importing main."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=cwd, env=env,
+                            check=True, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[len('import time:'):].split('|'))
+        if not name.startswith(' '):
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def prepare_noop_workdir(workdir, images):
+    """Lay out a scratch directory in which a main.main() run has nothing left to do."""
+    shutil.copytree(os.path.join(REPO_DIR, 'configs'), os.path.join(workdir, 'configs'))
+    output_dir = os.path.join(workdir, 'generated_images')
+    os.makedirs(output_dir)
+    payload = make_png_payload(0)
+    with open(os.path.join(workdir, 'images.csv'), 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['image_id', 'context', 'original_description', 'enhanced_description', 'file_name'])
+        for i in range(images):
+            file_name = f"{i}_bench.png"
+            with open(os.path.join(output_dir, file_name), 'wb') as image:
+                image.write(payload)
+            writer.writerow([i, 'bench', f"Description {i}", f"Enhanced {i}", file_name])
+
+    # One run to build the validation manifest, then record every file as already uploaded
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import sync_to_s3
+        from config import SETTINGS
+        from validate_artifacts import validate_artifacts
+        config = SETTINGS.config
+        validate_artifacts('images.csv', config)
+        prefix = config['s3']['folder']
+        state = {}
+        for file_name in os.listdir(output_dir):
+            _, entry = sync_to_s3.needs_upload(os.path.join(output_dir, file_name), f"{prefix}/{file_name}", state)
+            state[f"{prefix}/{file_name}"] = entry
+        sync_to_s3.save_sync_state({f"s3://{BUCKET_NAME}/{prefix}": state}, config['s3']['sync_state'])
+    finally:
+        os.chdir(cwd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--images', type=int, default=1000, help="Images already present for the no-op run")
+    parser.add_argument('--top', type=int, default=10, help="Slowest imports to list")
+    args = parser.parse_args()
+
+    env = dict(os.environ, S3_BUCKET_NAME=BUCKET_NAME, AWS_DEFAULT_REGION='us-east-1',
+               PYTHONPATH=os.pathsep.join([REPO_DIR, os.environ.get('PYTHONPATH', '')]))
+    workdir = tempfile.mkdtemp(prefix='image-batch-startup-')
+    try:
+        prepare_noop_workdir(workdir, args.images)
+        baseline = [timed_run('pass', workdir, env) for _ in range(args.repeat)]
+        imports = [timed_run('import main', workdir, env) for _ in range(args.repeat)]
+        noop = [timed_run('import main; main.main([])', workdir, env) for _ in range(args.repeat)]
+        top = slowest_imports(workdir, env, args.top)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    interpreter = statistics.median(baseline)
+    print(f"interpreter start-up     {interpreter * 1000:8.1f} ms")
+    print(f"import main              {(statistics.median(imports) - interpreter) * 1000:8.1f} ms (median of {args.repeat})")
+    print(f"no-op main.main() run    {(statistics.median(noop) - interpreter) * 1000:8.1f} ms ({args.images} valid images)")
+    print("slowest imports (cumulative):")
+    for microseconds, name in top:
+        print(f"  {microseconds / 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+
+class FakeRateLimitError(Exception):
+    """Mimics openai.RateLimitError closely enough for get_retry_after()."""
+
+    def __init__(self, retry_after):
+        super().__init__("Rate limit reached")
+        self.status_code = 429
+        self.response = SimpleNamespace(headers={'retry-after': str(retry_after)})
+
+
+class FakeOpenAIClient:
+    """In-process stand-in for OpenAI() exposing chat.completions.create()."""
+
+    def __init__(self, latency=0.2, throttle_rate=0.0, retry_after=0.5, seed=0, capacity=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.request_count = 0
+        self.throttled_count = 0
+        self.total_tokens = 0
+        self.capacity = capacity
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, **kwargs):
+        with self.lock:
+            self.request_count += 1
+            # Over capacity behaves like an account tier limit, otherwise throttle at random
+            throttled = (self.capacity and self.in_flight >= self.capacity) or self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttled_count += 1
+            else:
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        if throttled:
+            raise FakeRateLimitError(self.retry_after)
+
+        try:
+            time.sleep(self.latency)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        prompt = messages[-1]['content']
+        if kwargs.get('response_format', {}).get('type') == 'json_object':
+            # Batched request: the item list is the JSON block at the end of the last message
+            items = json.loads(prompt[prompt.rindex('\n\n['):])
+            content = json.dumps({'results': [
+                {'id': item['id'], 'enhanced_description': f"Enhanced: {item['description']}"} for item in items
+            ]})
+        else:
+            content = f"Enhanced: {prompt[-80:]}"
+
+        prompt_tokens = sum(len(message['content']) for message in messages) // 4
+        completion_tokens = len(content) // 4
+        with self.lock:
+            self.total_tokens += prompt_tokens + completion_tokens
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                  total_tokens=prompt_tokens + completion_tokens)
+        )
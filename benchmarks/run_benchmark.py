@@ -0,0 +1,218 @@
+"""
+End-to-end offline benchmark of main.main.
+
+Every external dependency is replaced by a local stand-in: a stub OpenAI chat completions
+server, a stub Stability generate endpoint and moto's S3 server. Each row count runs in its
+own child process so peak RSS is measured per size.
+
+Requires moto with the server extra (pip install "moto[server]"). Run from the repository root:
+    python benchmarks/run_benchmark.py --rows 1000 10000 100000 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import csv
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import wraps
+
+import yaml
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path[:0] = [REPO_DIR, BENCHMARK_DIR]
+
+from stub_servers import StubOpenAIHandler, StubStabilityHandler, start_stub_server
+
+BUCKET_NAME = "image-batch-benchmark"
+
+
+class LatencyRecorder:
+    """Collects per-call latencies by wrapping module-level functions."""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def wrap(self, module, name, stage):
+        original = getattr(module, name)
+
+        @wraps(original)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+
+        setattr(module, name, timed)
+
+    def summary(self):
+        return {stage: summarize(samples) for stage, samples in self.samples.items()}
+
+
+def percentile(sorted_samples, fraction):
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'p50_ms': percentile(ordered, 0.50) * 1000,
+        'p95_ms': percentile(ordered, 0.95) * 1000,
+        'total_s': sum(ordered)
+    }
+
+
+def write_synthetic_csv(path, rows):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['image_id', 'context', 'description'])
+        for i in range(1, rows + 1):
+            writer.writerow([i, f"context {i % 20}", f"Synthetic scene number {i} with a cat and a lantern."])
+
+
+def prepare_workdir(workdir, args):
+    """Copy the configs into a scratch directory, with rate limits and caching tuned for benchmarking."""
+    shutil.copytree(os.path.join(REPO_DIR, 'configs'), os.path.join(workdir, 'configs'))
+    config_path = os.path.join(workdir, 'configs', 'config.yml')
+    with open(config_path) as file:
+        config = yaml.safe_load(file)
+
+    config['cache']['enabled'] = args.cache
+    if not args.keep_rate_limits:
+        config['concurrency']['images']['requests_per_minute'] = 0
+        config['concurrency']['descriptions']['requests_per_minute'] = 0
+        config['concurrency']['descriptions']['tokens_per_minute'] = 0
+    with open(config_path, 'w') as file:
+        yaml.safe_dump(config, file)
+
+
+def run_single(rows, args):
+    """Run main.main once for `rows` synthetic rows; returns the result dict."""
+    from moto.server import ThreadedMotoServer
+
+    openai_stub = start_stub_server(StubOpenAIHandler, latency=args.latency, error_rate=args.error_rate, retry_after=0)
+    stability_stub = start_stub_server(StubStabilityHandler, latency=args.latency, error_rate=args.error_rate,
+                                       payload_size=args.payload_size, retry_after=0)
+    moto_server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+    moto_server.start()
+    s3_host, s3_port = moto_server.get_host_and_port()
+
+    os.environ.update({
+        'OPENAI_API_KEY': 'benchmark',
+        'OPENAI_BASE_URL': f"{openai_stub.url}/v1",
+        'STABILITY_API_KEY': 'benchmark',
+        'STABILITY_API_URL': stability_stub.url,
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ENDPOINT_URL': f"http://{s3_host}:{s3_port}",
+        'S3_BUCKET_NAME': BUCKET_NAME
+    })
+
+    workdir = tempfile.mkdtemp(prefix='image-batch-bench-')
+    try:
+        prepare_workdir(workdir, args)
+        os.chdir(workdir)
+        write_synthetic_csv('image_descriptions.csv', rows)
+
+        # Configuration and clients are created on first use, relative to this working directory
+        import boto3
+        import generate_descriptions
+        import generate_images
+        import main
+        import pipeline
+        import sync_to_s3
+
+        boto3.client('s3').create_bucket(Bucket=BUCKET_NAME)
+
+        recorder = LatencyRecorder()
+        recorder.wrap(generate_descriptions, 'call_chat', 'openai_call')
+        recorder.wrap(generate_images, 'generate_image', 'stability_call')
+        recorder.wrap(sync_to_s3, 'upload_file', 's3_upload')
+        recorder.wrap(pipeline, 'upload_file', 's3_upload')
+        for name, stage in (('validate_artifacts', 'stage_validate'), ('generate_descriptions', 'stage_describe'),
+                            ('generate_images', 'stage_generate'), ('sync_to_s3', 'stage_sync'),
+                            ('run_streaming_pipeline', 'stage_stream')):
+            recorder.wrap(main, name, stage)
+
+        start = time.perf_counter()
+        main.main(['--stream'] if args.stream else [])
+        elapsed = time.perf_counter() - start
+
+        return {
+            'rows': rows,
+            'mode': 'stream' if args.stream else 'staged',
+            'elapsed_s': elapsed,
+            'rows_per_s': rows / elapsed,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'openai_requests': openai_stub.request_count,
+            'openai_errors': openai_stub.error_count,
+            'stability_requests': stability_stub.request_count,
+            'stability_errors': stability_stub.error_count,
+            'latency': recorder.summary()
+        }
+    finally:
+        os.chdir(REPO_DIR)
+        moto_server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(result):
+    print(f"\n== {result['rows']} rows ({result['mode']}) ==")
+    print(f"elapsed {result['elapsed_s']:.2f}s, {result['rows_per_s']:.1f} rows/s, peak RSS {result['peak_rss_mb']:.0f} MB")
+    print(f"openai requests {result['openai_requests']} ({result['openai_errors']} injected errors), "
+          f"stability requests {result['stability_requests']} ({result['stability_errors']} injected errors)")
+    print(f"{'stage':<18}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'total s':>12}")
+    for stage, stats in sorted(result['latency'].items()):
+        print(f"{stage:<18}{stats['count']:>8}{stats['p50_ms']:>12.1f}{stats['p95_ms']:>12.1f}{stats['total_s']:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--latency', type=float, default=0.05, help="Stub response delay in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of stub responses that are 429/503")
+    parser.add_argument('--payload-size', type=int, default=0, help="Stub image size in bytes")
+    parser.add_argument('--stream', action='store_true', help="Benchmark main.py --stream")
+    parser.add_argument('--cache', action='store_true', help="Leave the response cache enabled")
+    parser.add_argument('--keep-rate-limits', action='store_true', help="Keep the configured rate limits")
+    parser.add_argument('--json', metavar='PATH', help="Also write the results as JSON")
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # Child process: run one size and hand the result back on the last stdout line
+        import logging
+        logging.disable(logging.WARNING)
+        print(json.dumps(run_single(args.single, args)))
+        return
+
+    results = []
+    passthrough = ['--latency', str(args.latency), '--error-rate', str(args.error_rate),
+                   '--payload-size', str(args.payload_size)]
+    passthrough += [flag for flag, enabled in (('--stream', args.stream), ('--cache', args.cache),
+                                               ('--keep-rate-limits', args.keep_rate_limits)) if enabled]
+    for rows in args.rows:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--single', str(rows)] + passthrough,
+                                check=True, capture_output=True, text=True, cwd=REPO_DIR).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print_report(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
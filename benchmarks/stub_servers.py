@@ -0,0 +1,170 @@
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+# Smallest valid PNG (1x1 grey pixel), padded up to the requested payload size
+PNG_1X1 = (
+    b'\x89PNG\r\n\x1a\n'
+    + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0))
+    + _png_chunk(b'IDAT', zlib.compress(b'\x00\x80'))
+    + _png_chunk(b'IEND', b'')
+)
+
+
+def make_png_payload(size):
+    """Return a valid PNG of at least `size` bytes (trailing bytes follow IEND)."""
+    if size <= len(PNG_1X1):
+        return PNG_1X1
+    return PNG_1X1 + b"\0" * (size - len(PNG_1X1))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Shared request plumbing: read the body, wait, and answer with an injected error or a payload."""
+
+    # Keep connections open so client-side pooling is exercised
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if not self.server.begin_request():
+            self.send_error_response(429)
+            return
+        try:
+            time.sleep(self.server.latency)
+            error = self.server.next_error()
+            if error:
+                self.send_error_response(error)
+            else:
+                self.handle_request(body)
+        finally:
+            self.server.end_request()
+
+    def send_body(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_response(self, status):
+        headers = {'Retry-After': str(self.server.retry_after)} if status == 429 else {}
+        body = json.dumps({'error': {'message': f"Injected {status}", 'type': 'stub_error', 'code': status}}).encode()
+        self.send_body(status, 'application/json', body, headers)
+
+    def handle_request(self, body):
+        raise NotImplementedError
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubStabilityHandler(StubHandler):
+    """Answers every POST like the Stability generate endpoint, after a fixed delay."""
+
+    def handle_request(self, body):
+        self.send_body(200, 'image/png', self.server.payload)
+
+
+class StubOpenAIHandler(StubHandler):
+    """Answers POST /v1/chat/completions like the OpenAI API, including JSON-mode batched requests."""
+
+    def handle_request(self, body):
+        request = json.loads(body)
+        prompt = request['messages'][-1]['content']
+        if request.get('response_format', {}).get('type') == 'json_object':
+            items = json.loads(prompt[prompt.rindex('\n\n['):])
+            content = json.dumps({'results': [
+                {'id': item['id'], 'enhanced_description': f"Enhanced: {item['description']}"} for item in items
+            ]})
+        else:
+            content = f"Enhanced: {prompt[-80:]}"
+
+        prompt_tokens = sum(len(message['content']) for message in request['messages']) // 4
+        completion_tokens = len(content) // 4
+        response = {
+            'id': 'chatcmpl-stub',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'gpt-4o'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens}
+        }
+        self.send_body(200, 'application/json', json.dumps(response).encode())
+
+
+class StubServer(ThreadingHTTPServer):
+    """Threaded local HTTP server with configurable latency, error rate and payload size.
+
+    With a capacity, requests beyond that many in flight are rejected with a 429, the
+    way a real API throttles a client that sends more than its tier allows.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0.1, payload_size=0, error_rate=0.0, error_statuses=(429, 503),
+                 retry_after=1, seed=0, capacity=0):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.payload = make_png_payload(payload_size)
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.request_count = 0
+        self.error_count = 0
+        self.capacity = capacity
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.throttled_count = 0
+        self.lock = threading.Lock()
+
+    def begin_request(self):
+        """Admit a request unless the server is at capacity; returns False if it should get a 429."""
+        with self.lock:
+            if self.capacity and self.in_flight >= self.capacity:
+                self.request_count += 1
+                self.throttled_count += 1
+                return False
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return True
+
+    def end_request(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def next_error(self):
+        """Count the request and decide whether to fail it; returns an HTTP status or None."""
+        with self.lock:
+            self.request_count += 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.error_count += 1
+                return self.random.choice(self.error_statuses)
+        return None
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}"
+
+
+def start_stub_server(handler=StubStabilityHandler, **kwargs):
+    """Start a stub server on a free local port in a background thread."""
+    server = StubServer(handler, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,271 @@
+import os
+import csv
+import json
+import logging
+import sqlite3
+import tarfile
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Defaults, overridden by the `bundles` section of the config
+DEFAULT_BUNDLE_DIRECTORY = ".cache/bundles"
+DEFAULT_TARGET_SIZE_MB = 256
+DEFAULT_BUNDLE_PREFIX = "bundles"
+
+CATALOG_FILE = "catalog.sqlite"
+INDEX_SUFFIX = ".index.json"
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+
+def get_bundle_settings(config):
+    """Return the `bundles` section with defaults filled in, or None when bundling is disabled."""
+    settings = (config or {}).get('bundles', {})
+    if not settings.get('enabled'):
+        return None
+    return {
+        'directory': settings.get('directory', DEFAULT_BUNDLE_DIRECTORY),
+        'target_size': max(1, int(float(settings.get('target_size_mb', DEFAULT_TARGET_SIZE_MB)) * 1024 * 1024)),
+        's3_prefix': str(settings.get('s3_prefix', DEFAULT_BUNDLE_PREFIX)).strip('/'),
+        'keep_local': bool(settings.get('keep_local', False))
+    }
+
+def shard_name(number):
+    return f"bundle-{number:06d}.tar"
+
+def index_name(shard):
+    return f"{shard}{INDEX_SUFFIX}"
+
+def _write_json_atomically(value, path):
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w') as file:
+        json.dump(value, file)
+    os.replace(tmp_path, path)
+
+class BundleWriter:
+    """Packs image files into tar shards of about target_size bytes, each with an offset index.
+
+    Shards are uncompressed tar files, so any tar tool can unpack them, and the index
+    (<shard>.index.json: file name -> [offset, size]) lets a reader fetch one image with
+    a single byte-range request. A catalog in SQLite records which shard holds the
+    current copy of every file and which shards have been uploaded, so a file is only
+    bundled again if it changed. Files join the catalog when their shard is sealed; a
+    shard left open by a crash is discarded and its files are bundled again.
+
+    Safe to call from several threads. on_sealed(shard_path, index_path) is called for
+    each sealed shard, e.g. to upload it while more images are still being generated.
+    """
+
+    def __init__(self, directory, target_size, on_sealed=None):
+        self.directory = directory
+        self.target_size = target_size
+        self.on_sealed = on_sealed
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, CATALOG_FILE), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (file_name TEXT PRIMARY KEY, shard TEXT, offset INTEGER, size INTEGER, mtime_ns INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS shards (shard TEXT PRIMARY KEY, uploaded INTEGER DEFAULT 0)")
+        self.db.commit()
+        sealed = {shard for (shard,) in self.db.execute("SELECT shard FROM shards")}
+        for name in os.listdir(directory):
+            if name.endswith('.tar') and name not in sealed:
+                logging.warning(f"Discarding unsealed bundle {name} from an interrupted run")
+                os.remove(os.path.join(directory, name))
+        self.next_number = max((int(shard[len('bundle-'):-len('.tar')]) for shard in sealed), default=0) + 1
+        self.tar = None
+        self.shard = None
+        self.entries = {}
+
+    def is_bundled(self, file_name, stat):
+        """True if the catalog already holds this version of the file."""
+        with self.lock:
+            found = self.entries.get(file_name)
+            if found is None:
+                found = self.db.execute("SELECT offset, size, mtime_ns FROM files WHERE file_name = ?", (file_name,)).fetchone()
+        return found is not None and found[1] == stat.st_size and found[2] == stat.st_mtime_ns
+
+    def add(self, file_name, file_path):
+        """Append a file to the open shard, unless its current version is already bundled."""
+        stat = os.stat(file_path)
+        if self.is_bundled(file_name, stat):
+            return False
+        sealed = None
+        with self.lock:
+            if self.tar is None:
+                self.shard = shard_name(self.next_number)
+                self.next_number += 1
+                self.tar = tarfile.open(os.path.join(self.directory, self.shard), 'w')
+            info = tarfile.TarInfo(file_name)
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            with open(file_path, 'rb') as file:
+                self.tar.addfile(info, file)
+            # The data ends where the tar stream is now, padded to a whole block
+            padded = -(-stat.st_size // TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE
+            self.entries[file_name] = (self.tar.offset - padded, stat.st_size, stat.st_mtime_ns)
+            metrics.inc('bundle_files_total')
+            if self.tar.offset >= self.target_size:
+                sealed = self._seal()
+        if sealed and self.on_sealed is not None:
+            self.on_sealed(*sealed)
+        return True
+
+    def _seal(self):
+        self.tar.close()
+        shard_path = os.path.join(self.directory, self.shard)
+        index_path = os.path.join(self.directory, index_name(self.shard))
+        _write_json_atomically({'shard': self.shard, 'files': {name: [offset, size] for name, (offset, size, _) in self.entries.items()}}, index_path)
+        self.db.executemany("INSERT OR REPLACE INTO files (file_name, shard, offset, size, mtime_ns) VALUES (?, ?, ?, ?, ?)",
+                            [(name, self.shard, offset, size, mtime_ns) for name, (offset, size, mtime_ns) in self.entries.items()])
+        self.db.execute("INSERT OR REPLACE INTO shards (shard, uploaded) VALUES (?, 0)", (self.shard,))
+        self.db.commit()
+        logging.info(f"Sealed bundle {self.shard}: {len(self.entries)} files, {os.path.getsize(shard_path) / (1024 * 1024):.1f} MB")
+        metrics.inc('bundles_sealed_total')
+        self.tar, self.shard, self.entries = None, None, {}
+        return shard_path, index_path
+
+    def flush(self):
+        """Seal the open shard, however small, so everything added so far can be uploaded."""
+        with self.lock:
+            sealed = self._seal() if self.tar is not None else None
+        if sealed and self.on_sealed is not None:
+            self.on_sealed(*sealed)
+
+    def pending_uploads(self):
+        """Sealed shards that have not been uploaded yet."""
+        with self.lock:
+            return [shard for (shard,) in self.db.execute("SELECT shard FROM shards WHERE uploaded = 0 ORDER BY shard")]
+
+    def mark_uploaded(self, shard):
+        with self.lock:
+            self.db.execute("UPDATE shards SET uploaded = 1 WHERE shard = ?", (shard,))
+            self.db.commit()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
+
+def open_bundle_writer(config, on_sealed=None):
+    """Return a BundleWriter for the config, or None when bundling is disabled."""
+    settings = get_bundle_settings(config)
+    if settings is None:
+        return None
+    return BundleWriter(settings['directory'], settings['target_size'], on_sealed)
+
+def upload_shard(writer, shard, bucket_name, settings, transfer_config=None):
+    """Upload a sealed shard and then its index; the index last, so readers never see a partial shard."""
+    from sync_to_s3 import upload_file
+
+    shard_path = os.path.join(writer.directory, shard)
+    prefix = settings['s3_prefix']
+    if not upload_file(shard_path, bucket_name, f"{prefix}/{shard}", transfer_config):
+        return False
+    if not upload_file(os.path.join(writer.directory, index_name(shard)), bucket_name, f"{prefix}/{index_name(shard)}"):
+        return False
+    writer.mark_uploaded(shard)
+    metrics.inc('bundle_bytes_uploaded_total', os.path.getsize(shard_path))
+    if not settings['keep_local']:
+        os.remove(shard_path)
+    return True
+
+def bundle_files(csv_file):
+    """Every image, variant and derivative file listed in csv_file."""
+    from postprocess import load_derivatives
+    from variants import image_files
+
+    with open(csv_file, 'r', newline='', encoding='utf-8') as file:
+        for row in csv.DictReader(file):
+            yield from image_files(row)
+            yield from load_derivatives(row.get('derivatives')).values()
+
+def sync_bundles(local_directory, bucket_name, csv_file, config, transfer_config=None, workers=1):
+    """Bundle every file listed in csv_file that is not bundled yet and upload the sealed shards.
+
+    Files come from the CSV instead of a directory walk; a missing file fails the sync
+    the way a file count mismatch does.
+    """
+    settings = get_bundle_settings(config)
+    writer = BundleWriter(settings['directory'], settings['target_size'])
+    missing = 0
+    added = 0
+    for file_name in bundle_files(csv_file):
+        file_path = os.path.join(local_directory, file_name)
+        if not os.path.exists(file_path):
+            logging.error(f"File listed in {csv_file} not found: {file_path}")
+            missing += 1
+            continue
+        added += writer.add(file_name, file_path)
+    writer.flush()
+    if missing:
+        writer.close()
+        return False
+
+    shards = writer.pending_uploads()
+    logging.info(f"Bundled {added} new or changed files; uploading {len(shards)} bundles to s3://{bucket_name}/{settings['s3_prefix']}")
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(lambda shard: upload_shard(writer, shard, bucket_name, settings, transfer_config), shards))
+    writer.close()
+    return all(results)
+
+class BundleReader:
+    """Reads single files out of bundles by byte range, from a local bundle directory or s3://bucket/prefix.
+
+    When a file was bundled more than once, the copy in the newest shard is read.
+    """
+
+    def __init__(self, location):
+        from ingest import parse_s3_url
+
+        self.location = location
+        self.s3 = parse_s3_url(location)
+        self.entries = {}
+        for shard, index in sorted(self._load_indexes()):
+            for file_name, (offset, size) in index['files'].items():
+                self.entries[file_name] = (shard, offset, size)
+
+    def _load_indexes(self):
+        if self.s3 is None:
+            for name in os.listdir(self.location):
+                if name.endswith(INDEX_SUFFIX):
+                    with open(os.path.join(self.location, name), 'r') as file:
+                        index = json.load(file)
+                    yield index['shard'], index
+            return
+        from clients import get_s3_client
+
+        bucket_name, prefix = self.s3
+        paginator = get_s3_client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{prefix.rstrip('/')}/"):
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith(INDEX_SUFFIX):
+                    index = json.loads(get_s3_client().get_object(Bucket=bucket_name, Key=obj['Key'])['Body'].read())
+                    yield index['shard'], index
+
+    def __contains__(self, file_name):
+        return file_name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def names(self):
+        return list(self.entries)
+
+    def read(self, file_name):
+        """Return the bytes of one bundled file; raises KeyError if it is not in any bundle."""
+        shard, offset, size = self.entries[file_name]
+        if size == 0:
+            return b''
+        if self.s3 is None:
+            with open(os.path.join(self.location, shard), 'rb') as file:
+                file.seek(offset)
+                return file.read(size)
+        from clients import get_s3_client
+
+        bucket_name, prefix = self.s3
+        response = get_s3_client().get_object(Bucket=bucket_name, Key=f"{prefix.rstrip('/')}/{shard}",
+                                              Range=f"bytes={offset}-{offset + size - 1}")
+        return response['Body'].read()
@@ -0,0 +1,30 @@
+import os
+import threading
+
+# Clients are created on first use and shared by every module and thread
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _get_client(name, factory):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+def _create_s3_client():
+    import boto3
+    return boto3.client('s3')
+
+def _create_openai_client():
+    from openai import OpenAI
+    # call_chat retries on its own, reporting every 429 to the limiters and metrics; SDK
+    # retries underneath it would multiply the attempts and hide the throttling
+    return OpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+
+def get_s3_client():
+    """Return the shared S3 client (boto3 clients are thread-safe)."""
+    return _get_client('s3', _create_s3_client)
+
+def get_openai_client():
+    """Return the shared OpenAI client."""
+    return _get_client('openai', _create_openai_client)
@@ -1,27 +1,70 @@
 import os
+import threading
 import yaml
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+CONFIG_FILE = './configs/config.yml'
+IMAGES_CONFIG_FILE = './configs/images.yml'
+PROMPTS_FILE = './configs/describe.yml'
+
+def read_yaml(path):
+    with open(path, 'r') as file:
+        return yaml.safe_load(file)
+
 def load_config():
-    with open('./configs/config.yml', 'r') as file:
-        config = yaml.safe_load(file)
+    config = read_yaml(CONFIG_FILE)
     
     # Replace environment variables in the config
     config['s3']['bucket_name'] = os.getenv(config['s3']['bucket_name'].strip('${}'))
     
     return config
 
-# Load configuration
-CONFIG = load_config()
-
-# Convenience variables
-INPUT_CSV = CONFIG['csv_files']['input']
-ENHANCED_DESCRIPTIONS_CSV = CONFIG['csv_files']['enhanced_descriptions']
-IMAGES_CSV = CONFIG['csv_files']['images']
-S3_BUCKET_NAME = CONFIG['s3']['bucket_name']
-S3_INPUT_KEY = CONFIG['s3']['input_key']
-OUTPUT_DIR = CONFIG['output']['directory']
-OUTPUT_FORMAT = CONFIG['output']['format']
\ No newline at end of file
+class Settings:
+    """All YAML configuration; each file is read once, on first access, and then shared."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = {}
+
+    def _get(self, name, loader):
+        with self._lock:
+            if name not in self._loaded:
+                self._loaded[name] = loader()
+            return self._loaded[name]
+
+    @property
+    def config(self):
+        """configs/config.yml, with environment variables substituted."""
+        return self._get('config', load_config)
+
+    @property
+    def images(self):
+        """configs/images.yml"""
+        return self._get('images', lambda: read_yaml(IMAGES_CONFIG_FILE))
+
+    @property
+    def prompts(self):
+        """configs/describe.yml"""
+        return self._get('prompts', lambda: read_yaml(PROMPTS_FILE))
+
+SETTINGS = Settings()
+
+# Convenience variables, resolved from config.yml the first time they are used
+_CONVENIENCE = {
+    'CONFIG': lambda config: config,
+    'INPUT_CSV': lambda config: config['csv_files']['input'],
+    'ENHANCED_DESCRIPTIONS_CSV': lambda config: config['csv_files']['enhanced_descriptions'],
+    'IMAGES_CSV': lambda config: config['csv_files']['images'],
+    'S3_BUCKET_NAME': lambda config: config['s3']['bucket_name'],
+    'S3_INPUT_KEY': lambda config: config['s3']['input_key'],
+    'OUTPUT_DIR': lambda config: config['output']['directory'],
+    'OUTPUT_FORMAT': lambda config: config['output']['format'],
+}
+
+def __getattr__(name):
+    if name in _CONVENIENCE:
+        return _CONVENIENCE[name](SETTINGS.config)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
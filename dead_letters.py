@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import random
+import logging
+import sqlite3
+import threading
+import metrics
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Defaults, overridden by the `dead_letters` section of the config
+DEFAULT_DEAD_LETTER_PATH = ".cache/dead_letters.sqlite"
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF_BASE = 30
+DEFAULT_BACKOFF_MAX = 3600
+
+# Longest error message kept per row
+MAX_MESSAGE_LENGTH = 500
+
+_shared_store = None
+_shared_store_lock = threading.Lock()
+
+# The most recent API failure on this thread, noted where it happens and picked up by the caller that owns the row
+_last_failure = threading.local()
+
+def note_failure(error=None, status_code=None, message=None):
+    """Remember why the current thread's API call failed, for record() further up the stack."""
+    _last_failure.value = {
+        'error_class': type(error).__name__ if error is not None else f"HTTP {status_code}",
+        'status_code': status_code if status_code is not None else getattr(error, 'status_code', None),
+        'message': (message if message is not None else str(error or ''))[:MAX_MESSAGE_LENGTH]
+    }
+
+def take_failure():
+    """Return and clear the failure noted on this thread."""
+    failure = getattr(_last_failure, 'value', None)
+    _last_failure.value = None
+    return failure or {'error_class': 'Unknown', 'status_code': None, 'message': ''}
+
+def row_key(row):
+    """Key of a row in the store: its image_id, plus the variant key for one variant of an image."""
+    variant = row.get('variant')
+    return f"{row['image_id']}/{variant['key']}" if variant else str(row['image_id'])
+
+class DeadLetterStore:
+    """Rows that failed a stage, kept in SQLite with the error, attempt count and next retry time.
+
+    Retries back off exponentially with jitter: after n failed attempts a row is due
+    again after a random delay between half and all of base * 2**(n - 1), capped at
+    backoff_max. Rows that fail max_attempts times stay in the store for inspection but
+    are no longer due. Rows deferred by the scheduler's budget or deadline are due at once.
+    """
+
+    def __init__(self, path, max_attempts=DEFAULT_MAX_ATTEMPTS, backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS failures (stage TEXT, image_id TEXT, error_class TEXT, status_code INTEGER, "
+            "message TEXT, attempts INTEGER, first_failed REAL, last_failed REAL, next_attempt REAL, row TEXT, "
+            "PRIMARY KEY (stage, image_id))"
+        )
+        self.db.commit()
+        # Successful rows are checked against this set, so the common case costs no query
+        self.keys = set(self.db.execute("SELECT stage, image_id FROM failures"))
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def record(self, stage, row, error_class, status_code=None, message=''):
+        """Record a failed attempt at `stage` for row, scheduling its next retry."""
+        image_id = row_key(row)
+        now = time.time()
+        with self.lock:
+            found = self.db.execute("SELECT attempts FROM failures WHERE stage = ? AND image_id = ?", (stage, image_id)).fetchone()
+            attempts = (found[0] if found else 0) + 1
+            next_attempt = now + self._backoff(attempts) if attempts < self.max_attempts else None
+            self.db.execute(
+                "INSERT INTO failures (stage, image_id, error_class, status_code, message, attempts, first_failed, last_failed, next_attempt, row) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(stage, image_id) DO UPDATE SET "
+                "error_class = excluded.error_class, status_code = excluded.status_code, message = excluded.message, "
+                "attempts = excluded.attempts, last_failed = excluded.last_failed, next_attempt = excluded.next_attempt, row = excluded.row",
+                (stage, image_id, error_class, status_code, message, attempts, now, now, next_attempt, json.dumps(row, default=str))
+            )
+            self.db.commit()
+            self.keys.add((stage, image_id))
+        metrics.inc('dead_letters_total', stage=stage, error=error_class)
+        if next_attempt is None:
+            logging.warning(f"Giving up on {stage} for {image_id} after {attempts} attempts ({error_class})")
+
+    def record_failure(self, stage, row):
+        """record() with the failure noted on this thread by note_failure()."""
+        self.record(stage, row, **take_failure())
+
+    def defer(self, stage, row, reason):
+        """Record a row the run chose not to attempt (e.g. out of budget): due at once, no attempt counted."""
+        image_id = row_key(row)
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO failures (stage, image_id, error_class, status_code, message, attempts, first_failed, last_failed, next_attempt, row) "
+                "VALUES (?, ?, ?, NULL, '', 0, ?, ?, ?, ?) ON CONFLICT(stage, image_id) DO UPDATE SET "
+                "error_class = excluded.error_class, status_code = NULL, message = '', "
+                "last_failed = excluded.last_failed, next_attempt = excluded.next_attempt, row = excluded.row",
+                (stage, image_id, reason, now, now, now, json.dumps(row, default=str))
+            )
+            self.db.commit()
+            self.keys.add((stage, image_id))
+        metrics.inc('deferred_rows_total', stage=stage, reason=reason)
+
+    def resolve(self, stage, row):
+        """Drop a row that has now succeeded at `stage`."""
+        key = (stage, row_key(row))
+        if key not in self.keys:
+            return
+        with self.lock:
+            self.db.execute("DELETE FROM failures WHERE stage = ? AND image_id = ?", key)
+            self.db.commit()
+            self.keys.discard(key)
+
+    def due(self, stage, now=None):
+        """Rows failed at `stage` whose next retry time has passed, oldest failure first."""
+        with self.lock:
+            found = self.db.execute(
+                "SELECT row FROM failures WHERE stage = ? AND next_attempt IS NOT NULL AND next_attempt <= ? ORDER BY first_failed",
+                (stage, time.time() if now is None else now)
+            ).fetchall()
+        return [json.loads(row) for (row,) in found]
+
+    def next_due(self):
+        """Earliest next retry time of any row still being retried, or None."""
+        with self.lock:
+            return self.db.execute("SELECT MIN(next_attempt) FROM failures").fetchone()[0]
+
+    def summary(self):
+        """{(stage, error_class): (rows, rows given up on)} for reporting."""
+        with self.lock:
+            found = self.db.execute(
+                "SELECT stage, error_class, COUNT(*), SUM(next_attempt IS NULL) FROM failures GROUP BY stage, error_class"
+            ).fetchall()
+        return {(stage, error_class): (rows, exhausted) for stage, error_class, rows, exhausted in found}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def get_dead_letter_store(config):
+    """Return the process-wide dead-letter store, or None when it is disabled in the config."""
+    global _shared_store
+    settings = config.get('dead_letters', {})
+    if not settings.get('enabled', False):
+        return None
+    with _shared_store_lock:
+        if _shared_store is None:
+            _shared_store = DeadLetterStore(
+                settings.get('path', DEFAULT_DEAD_LETTER_PATH),
+                int(settings.get('max_attempts', DEFAULT_MAX_ATTEMPTS)),
+                float(settings.get('backoff_base', DEFAULT_BACKOFF_BASE)),
+                float(settings.get('backoff_max', DEFAULT_BACKOFF_MAX))
+            )
+        return _shared_store
@@ -0,0 +1,222 @@
+import os
+import re
+import random
+import shutil
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+import metrics
+from variants import load_variants
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Defaults, overridden by the `dedup` section of the config
+DEFAULT_DEDUP_THRESHOLD = 0.9
+DEFAULT_SHINGLE_SIZE = 3
+DEFAULT_NUM_PERM = 64
+
+# Seed of the MinHash permutations, fixed so clustering is the same on every run
+MINHASH_SEED = 1
+# Odd multiplier that combines consecutive word hashes into a shingle hash
+SHINGLE_MULTIPLIER = 0x9E3779B97F4A7C15
+
+def lsh_bands(threshold, num_perm):
+    """Number of LSH bands b for num_perm permutations, from the band threshold (1/b)**(1/r) with r = num_perm / b.
+
+    Prompts about (1/b)**(1/r) similar are found half the time, and more similar ones
+    almost always. The fewest bands whose band threshold is at or below `threshold` are
+    used, so prompts within the threshold are found while few others are compared.
+    """
+    divisors = [bands for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    return next((bands for bands in divisors if (1 / bands) ** (bands / num_perm) <= threshold), num_perm)
+
+def get_dedup_settings(config):
+    """Return the `dedup` section with defaults filled in, or None when it is disabled."""
+    settings = config.get('dedup', {})
+    if not settings.get('enabled'):
+        return None
+    threshold = float(settings.get('threshold', DEFAULT_DEDUP_THRESHOLD))
+    num_perm = int(settings.get('num_perm', DEFAULT_NUM_PERM))
+    bands = lsh_bands(threshold, num_perm)
+    if settings.get('bands') is not None and int(settings['bands']) != bands:
+        raise ValueError(f"dedup.bands ({settings['bands']}) does not match dedup.threshold ({threshold}) with "
+                         f"dedup.num_perm ({num_perm}); remove it to use the derived {bands} bands")
+    return {
+        'threshold': threshold,
+        'shingle_size': max(1, int(settings.get('shingle_size', DEFAULT_SHINGLE_SIZE))),
+        'num_perm': num_perm,
+        'bands': bands,
+        'ignore_phrases': [phrase.lower() for phrase in settings.get('ignore_phrases') or []],
+        'link': bool(settings.get('link', True))
+    }
+
+def normalize_prompt(prompt, ignore_phrases=()):
+    """Lowercase a prompt, drop boilerplate phrases and punctuation, and return its words."""
+    text = prompt.lower()
+    for phrase in ignore_phrases:
+        text = text.replace(phrase, ' ')
+    return re.findall(r"\w+", text)
+
+@lru_cache(maxsize=1 << 16)
+def _word_hash(word):
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+class NearDuplicateIndex:
+    """MinHash/LSH index that finds an earlier prompt within a similarity threshold.
+
+    Each prompt becomes a set of word shingles summarised by a MinHash signature.
+    Signatures are split into bands and only prompts sharing a band are compared, so
+    lookups stay roughly constant-time instead of scanning every earlier prompt.
+    Similarity is the Jaccard similarity of the shingle sets, estimated from the
+    signatures. Only unmatched prompts are added, so every match is within the
+    threshold of the prompt whose image it reuses.
+    """
+
+    def __init__(self, threshold=DEFAULT_DEDUP_THRESHOLD, shingle_size=DEFAULT_SHINGLE_SIZE,
+                 num_perm=DEFAULT_NUM_PERM, bands=None, ignore_phrases=()):
+        import numpy as np
+
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.num_perm = num_perm
+        bands = bands or lsh_bands(threshold, num_perm)
+        self.rows_per_band = num_perm // bands
+        self.ignore_phrases = ignore_phrases
+        # Each permutation is a random odd multiply-add modulo 2**64 followed by an xorshift
+        generator = random.Random(MINHASH_SEED)
+        self.multipliers = np.array([generator.getrandbits(64) | 1 for _ in range(num_perm)], dtype=np.uint64)
+        self.increments = np.array([generator.getrandbits(64) for _ in range(num_perm)], dtype=np.uint64)
+        self.buckets = [{} for _ in range(bands)]
+        self.keys = []
+        self.signatures = []
+        self.positions = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def signature(self, prompt):
+        """MinHash signature of a prompt's word shingles, or None if it has no words."""
+        import numpy as np
+
+        words = normalize_prompt(prompt, self.ignore_phrases)
+        if not words:
+            return None
+        codes = np.fromiter(map(_word_hash, words), dtype=np.uint64, count=len(words))
+        count = len(codes) - min(self.shingle_size, len(codes)) + 1
+        shingles = codes[:count].copy()
+        for offset in range(1, len(codes) - count + 1):
+            shingles = shingles * np.uint64(SHINGLE_MULTIPLIER) + codes[offset:offset + count]
+        hashed = shingles[:, None] * self.multipliers + self.increments
+        hashed ^= hashed >> np.uint64(32)
+        return hashed.min(axis=0)
+
+    def _bands(self, signature):
+        step = self.rows_per_band
+        return [signature[i:i + step].tobytes() for i in range(0, self.num_perm, step)]
+
+    def _find(self, signature, bands):
+        candidates = set()
+        for bucket, band in zip(self.buckets, bands):
+            candidates.update(bucket.get(band, ()))
+        best, best_similarity = None, self.threshold
+        for candidate in sorted(candidates):
+            similarity = (signature == self.signatures[candidate]).sum() / self.num_perm
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        return None if best is None else self.keys[best]
+
+    def _add(self, key, signature, bands):
+        position = len(self.keys)
+        self.keys.append(key)
+        self.signatures.append(signature)
+        self.positions[key] = position
+        for bucket, band in zip(self.buckets, bands):
+            bucket.setdefault(band, []).append(position)
+
+    def add(self, key, prompt):
+        """Index a prompt whose image already exists under key."""
+        signature = self.signature(prompt)
+        if signature is not None:
+            with self.lock:
+                self._add(key, signature, self._bands(signature))
+
+    def discard(self, key):
+        """Stop matching prompts against the image under key, e.g. because generating it failed."""
+        with self.lock:
+            position = self.positions.pop(key, None)
+            if position is None:
+                return
+            for bucket, band in zip(self.buckets, self._bands(self.signatures[position])):
+                bucket[band].remove(position)
+
+    def match_or_add(self, key, prompt):
+        """Return the key of an indexed near-duplicate of prompt, or index prompt under key and return None."""
+        signature = self.signature(prompt)
+        if signature is None:
+            return None
+        bands = self._bands(signature)
+        with self.lock:
+            match = self._find(signature, bands)
+            if match is None:
+                self._add(key, signature, bands)
+            return match
+
+def build_dedup_index(config):
+    """Return a NearDuplicateIndex for the config, or None when dedup is disabled."""
+    settings = get_dedup_settings(config)
+    if settings is None:
+        return None
+    return NearDuplicateIndex(settings['threshold'], settings['shingle_size'], settings['num_perm'],
+                              settings['bands'], settings['ignore_phrases'])
+
+def index_existing_images(index, rows, output_dir, variant_key=None):
+    """Add the prompts of rows whose image is already on disk, so new prompts can reuse them.
+
+    With a variant_key the row's image of that variant, from its variants column, is added instead of file_name.
+    """
+    for row in rows:
+        file_name = load_variants(row.get('variants')).get(variant_key) if variant_key else row.get('file_name')
+        if file_name and row.get('enhanced_description') and os.path.exists(os.path.join(output_dir, file_name)):
+            index.add(file_name, row['enhanced_description'])
+
+def build_variant_indexes(config, variants, manifest, output_dir):
+    """Return variant key -> NearDuplicateIndex seeded with the images in manifest, or None when dedup is disabled.
+
+    Prompts only reuse an image of the same variant, since seed and aspect ratio both
+    change the picture.
+    """
+    if get_dedup_settings(config) is None:
+        return None
+    indexes = {}
+    for variant in variants:
+        indexes[variant['key']] = build_dedup_index(config)
+        index_existing_images(indexes[variant['key']], manifest.rows(), output_dir, variant['key'] if len(variants) > 1 else None)
+    return indexes
+
+def reuse_image(source_name, job, output_dir, link=True):
+    """Give job the image stored under source_name, hard-linked when possible, else copied."""
+    source = os.path.join(output_dir, source_name)
+    file_path = os.path.join(output_dir, job['file_name'])
+    if not os.path.exists(source) or os.path.getsize(source) == 0:
+        return False
+    tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+    try:
+        if link:
+            try:
+                os.link(source, tmp_path)
+            except OSError:
+                shutil.copyfile(source, tmp_path)
+        else:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, file_path)
+    except OSError as e:
+        logging.error(f"Error reusing {source} for {job['image_id']}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    metrics.inc('dedup_reused_total')
+    logging.info(f"Reused {source} for near-duplicate prompt of {job['image_id']}")
+    return True
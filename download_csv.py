@@ -1,9 +1,7 @@
 import os
-import boto3
-from botocore.exceptions import ClientError
 import logging
 from dotenv import load_dotenv
-from config import CONFIG, INPUT_CSV, S3_BUCKET_NAME, S3_INPUT_KEY
+from clients import get_s3_client
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -11,9 +9,6 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Load environment variables
 load_dotenv()
 
-# Initialize S3 client
-s3 = boto3.client('s3')
-
 def download_csv_from_s3(bucket_name, s3_key, local_file_path):
     """
     Download a CSV file from S3 if it doesn't exist locally.
@@ -23,12 +18,14 @@ def download_csv_from_s3(bucket_name, s3_key, local_file_path):
     :param local_file_path: Local path to save the downloaded file
     :return: True if file was downloaded or already exists, False otherwise
     """
+    from botocore.exceptions import ClientError
+
     if os.path.exists(local_file_path):
         logging.info(f"File already exists locally: {local_file_path}")
         return True
     
     try:
-        s3.download_file(bucket_name, s3_key, local_file_path)
+        get_s3_client().download_file(bucket_name, s3_key, local_file_path)
         logging.info(f"Successfully downloaded {s3_key} from {bucket_name} to {local_file_path}")
         return True
     except ClientError as e:
@@ -36,6 +33,8 @@ def download_csv_from_s3(bucket_name, s3_key, local_file_path):
         return False
 
 if __name__ == "__main__":
+    from config import INPUT_CSV, S3_INPUT_KEY
+    
     bucket_name = os.getenv('S3_BUCKET_NAME')
     s3_key = S3_INPUT_KEY  # Adjust this if your S3 path is different
     local_file_path = INPUT_CSV
@@ -1,12 +1,22 @@
-import csv
 import os
-import yaml
-from openai import OpenAI
 from dotenv import load_dotenv
-from config import CONFIG, INPUT_CSV, ENHANCED_DESCRIPTIONS_CSV
+from config import SETTINGS
+from clients import get_openai_client
 import logging
-import pandas as pd
 import copy 
+import json
+import random
+import threading
+import time
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import build_concurrency_limiter, build_limiter, concurrency_slot
+from response_cache import get_response_cache, make_cache_key
+from progress_journal import ProgressJournal, journal_path_for, load_journal
+from manifest_store import MANIFEST_WRITE_BATCH, InOrderWriter, enhanced_columns, open_manifest
+from ingest import get_ingest_settings, iter_csv_rows, ordered_map, source_exists, source_signature
+from dead_letters import get_dead_letter_store, note_failure
+from scheduler import Deferred, get_budget, get_scheduler_settings, prioritized, reserve
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,83 +24,454 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI API client
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# OpenAI API client, created on first use; replace it with set_client() to run against a fake
+client = None
+
+# Concurrency defaults, overridden by the `concurrency.descriptions` section of the config
+DEFAULT_DESCRIPTION_WORKERS = 8
+DEFAULT_DESCRIPTION_REQUESTS_PER_MINUTE = 500
+DEFAULT_DESCRIPTION_TOKENS_PER_MINUTE = 30000
+DEFAULT_DESCRIPTION_MAX_RETRIES = 5
+DEFAULT_DESCRIPTION_BATCH_SIZE = 1
+
+# Rough completion size used when budgeting tokens/min before a request is sent
+EXPECTED_COMPLETION_TOKENS = 150
+
+def get_client():
+    """Return the shared OpenAI client, creating it on first use."""
+    global client
+    if client is None:
+        client = get_openai_client()
+    return client
+
+def set_client(new_client):
+    """Swap the OpenAI client, e.g. for a local fake when benchmarking offline."""
+    global client
+    client = new_client
 
 def load_gpt_prompts():
     """Load GPT prompts from YAML configuration file."""
-    with open('./configs/describe.yml', 'r') as file:
-        config = yaml.safe_load(file)
-    return config['messages']
+    return SETTINGS.prompts['messages']
+
+def load_batch_prompt():
+    """Load the message that replaces the last prompt message when descriptions are batched."""
+    return SETTINGS.prompts['batch_message']
+
+class UsageStats:
+    """Thread-safe totals of rows, tokens and request latency for the description stage."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.requests = 0
+        self.tokens = 0
+        self.seconds = 0.0
+
+    def record(self, rows, tokens, seconds):
+        with self.lock:
+            self.rows += rows
+            self.requests += 1
+            self.tokens += tokens
+            self.seconds += seconds
+
+    def log_summary(self, mode):
+        if not self.rows:
+            return
+        logging.info(f"Description usage ({mode}): {self.rows} rows in {self.requests} requests, "
+                     f"{self.tokens / self.rows:.0f} tokens/row, {self.seconds / self.rows:.2f}s API latency/row")
+
+def estimate_tokens(messages):
+    """Estimate the tokens a chat request will consume (about 4 characters per token)."""
+    prompt_chars = sum(len(message['content']) for message in messages)
+    return prompt_chars // 4 + EXPECTED_COMPLETION_TOKENS
+
+def get_retry_after(error):
+    """Return the Retry-After delay in seconds if the error is a 429, otherwise None."""
+    if getattr(error, 'status_code', None) != 429:
+        return None
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after', 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+def call_chat(messages, limiters=None, max_retries=DEFAULT_DESCRIPTION_MAX_RETRIES, **kwargs):
+    """Send one chat completion under the shared rate limits, retrying on 429. Returns None on failure."""
+    request_limiter, token_limiter, concurrency_limiter = limiters or (None, None, None)
+    
+    for attempt in range(max_retries + 1):
+        if request_limiter is not None:
+            request_limiter.acquire()
+        if token_limiter is not None:
+            token_limiter.acquire(estimate_tokens(messages))
+        
+        try:
+            with concurrency_slot(concurrency_limiter), metrics.in_flight('openai_requests_in_flight'), metrics.timer('openai_request_seconds'):
+                response = get_client().chat.completions.create(
+                    model="gpt-4o",
+                    messages=messages,
+                    **kwargs
+                )
+            metrics.inc('openai_requests_total', status=200)
+            metrics.inc('openai_tokens_total', total_tokens(response))
+            return response
+        except Exception as e:
+            metrics.inc('openai_requests_total', status=getattr(e, 'status_code', None) or 'error')
+            retry_after = get_retry_after(e)
+            if retry_after is None or attempt == max_retries:
+                logging.error(f"Error in GPT-4 API call: {str(e)}")
+                note_failure(e)
+                return None
+            metrics.inc('openai_retries_total')
+            
+            # Back off every worker sharing the limiter, not just this one
+            delay = retry_after + random.uniform(0, 0.5)
+            logging.warning(f"Rate limited by GPT-4 API, retrying in {delay:.1f}s (attempt {attempt + 1}/{max_retries})")
+            if request_limiter is not None:
+                request_limiter.pause(delay)
+            else:
+                time.sleep(delay)
+
+def total_tokens(response):
+    """Tokens billed for a response, or 0 if the backend did not report usage."""
+    usage = getattr(response, 'usage', None)
+    return getattr(usage, 'total_tokens', 0) or 0
 
-def improve_description(description, gpt_prompts):
-    """Enhance the image description using GPT-4."""
+def clean_description(text):
+    return text.encode("utf-8").decode().strip().strip('"')
+
+def improve_description(description, gpt_prompts, limiters=None, max_retries=DEFAULT_DESCRIPTION_MAX_RETRIES, cache=None, stats=None, budget=None):
+    """Enhance the image description using GPT-4.
+    
+    Raises Deferred if the request is not cached and the budget does not allow it.
+    """
     messages =  copy.deepcopy(gpt_prompts)
     messages[-1]['content'] = messages[-1]['content'].format(description=description)
     
+    # The fully rendered prompt identifies the request, whatever image_id it came from
+    cache_key = make_cache_key({'endpoint': "chat.completions", 'model': "gpt-4o", 'messages': messages})
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached.decode('utf-8')
+    
+    with reserve(budget, 'describe') as refusal:
+        if refusal is not None:
+            raise Deferred(refusal)
+        start = time.perf_counter()
+        response = call_chat(messages, limiters, max_retries)
+        if response is None:
+            return None
+        
+        seconds = time.perf_counter() - start
+        if budget is not None:
+            budget.charge('describe', total_tokens(response), seconds)
+    if stats is not None:
+        stats.record(1, total_tokens(response), seconds)
+    logging.debug(f"Enhanced 1 description: {total_tokens(response)} tokens, {seconds:.2f}s")
+    
+    enhanced_description = clean_description(response.choices[0].message.content)
+    if cache is not None:
+        cache.put(cache_key, enhanced_description.encode('utf-8'))
+    return enhanced_description
+
+def improve_descriptions_batch(rows, gpt_prompts, batch_prompt, limiters=None, max_retries=DEFAULT_DESCRIPTION_MAX_RETRIES, cache=None, stats=None, budget=None):
+    """Enhance several descriptions in one request, sharing the system prompt, cheat sheet and examples.
+    
+    Returns image_id -> enhanced description for every row that came back parseable;
+    rows missing from the result, including all uncached ones if the budget does not
+    allow the request, are left for the caller to retry individually.
+    """
+    messages = copy.deepcopy(gpt_prompts[:-1])
+    results = {}
+    cache_keys = {}
+    for row in rows:
+        cache_keys[row['image_id']] = make_cache_key({'endpoint': "chat.completions/batch", 'model': "gpt-4o",
+                                                      'messages': messages + [batch_prompt], 'description': row['original_description']})
+        cached = cache.get(cache_keys[row['image_id']]) if cache is not None else None
+        if cached is not None:
+            results[row['image_id']] = cached.decode('utf-8')
+    
+    remaining = [row for row in rows if row['image_id'] not in results]
+    if not remaining:
+        return results
+    
+    items = [{'id': row['image_id'], 'description': row['original_description']} for row in remaining]
+    messages.append({'role': batch_prompt['role'],
+                     'content': batch_prompt['content'].format(items=json.dumps(items, ensure_ascii=False, indent=1))})
+    
+    with reserve(budget, 'describe', len(remaining)) as refusal:
+        if refusal is not None:
+            return results
+        start = time.perf_counter()
+        response = call_chat(messages, limiters, max_retries, response_format={"type": "json_object"})
+        if response is None:
+            return results
+        
+        seconds = time.perf_counter() - start
+        if budget is not None:
+            budget.charge('describe', total_tokens(response), seconds, len(remaining))
+    try:
+        parsed = json.loads(response.choices[0].message.content)['results']
+        enhanced = {str(item['id']): clean_description(item['enhanced_description'])
+                    for item in parsed if isinstance(item, dict) and item.get('enhanced_description')}
+    except (ValueError, KeyError, TypeError) as e:
+        logging.warning(f"Could not parse batched GPT-4 response for {len(remaining)} descriptions: {e}")
+        enhanced = {}
+    
+    if stats is not None:
+        stats.record(len(remaining), total_tokens(response), seconds)
+    logging.debug(f"Enhanced {len(remaining)} descriptions in one request: "
+                  f"{total_tokens(response) / len(remaining):.0f} tokens/row, {seconds / len(remaining):.2f}s/row")
+    
+    for row in remaining:
+        enhanced_description = enhanced.get(row['image_id'])
+        if enhanced_description:
+            results[row['image_id']] = enhanced_description
+            if cache is not None:
+                cache.put(cache_keys[row['image_id']], enhanced_description.encode('utf-8'))
+    return results
+
+def enhance_row(row, gpt_prompts, limiters, max_retries, journal=None, cache=None, stats=None, dead_letters=None, budget=None):
+    """Enhance one pending row and journal the result as soon as it arrives.
+
+    Failures, and rows the budget does not allow, go to dead_letters.
+    """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages
-        )
-        return response.choices[0].message.content.encode("utf-8").decode().strip().strip('"')
-    except Exception as e:
-        logging.error(f"Error in GPT-4 API call: {str(e)}")
+        with metrics.span(row['image_id'], 'describe'):
+            enhanced_description = improve_description(row['original_description'], gpt_prompts, limiters, max_retries, cache, stats, budget)
+    except Deferred as e:
+        if dead_letters is not None:
+            dead_letters.defer('describe', row, e.reason)
         return None
+    if enhanced_description is None:
+        if dead_letters is not None:
+            dead_letters.record_failure('describe', row)
+        return None
+    if journal is not None:
+        journal.record(dict(row, enhanced_description=enhanced_description))
+    if dead_letters is not None:
+        dead_letters.resolve('describe', row)
+    return enhanced_description
+
+def enhance_batch(rows, gpt_prompts, batch_prompt, limiters, max_retries, journal=None, cache=None, stats=None, dead_letters=None, budget=None):
+    """Enhance a batch of pending rows in one request, falling back to single calls for rows it missed."""
+    start = time.perf_counter()
+    results = improve_descriptions_batch(rows, gpt_prompts, batch_prompt, limiters, max_retries, cache, stats, budget)
+    # Spread the shared request time evenly over the rows it covered
+    for row in rows:
+        metrics.get_registry().record_span(row['image_id'], 'describe', (time.perf_counter() - start) / len(rows))
+    enhanced = []
+    for row in rows:
+        if row['image_id'] in results:
+            enhanced_description = results[row['image_id']]
+            if journal is not None:
+                journal.record(dict(row, enhanced_description=enhanced_description))
+            if dead_letters is not None:
+                dead_letters.resolve('describe', row)
+        else:
+            logging.info(f"Falling back to a single request for image {row['image_id']}")
+            enhanced_description = enhance_row(row, gpt_prompts, limiters, max_retries, journal, cache, stats, dead_letters, budget)
+        enhanced.append(enhanced_description)
+    return enhanced
+
+def get_description_concurrency(config):
+    """Return (workers, (request_limiter, token_limiter, concurrency_limiter), max_retries) for the description stage."""
+    settings = config.get('concurrency', {}).get('descriptions', {})
+    workers = max(1, int(settings.get('workers', DEFAULT_DESCRIPTION_WORKERS)))
+    limiters = (
+        build_limiter(settings.get('requests_per_minute', DEFAULT_DESCRIPTION_REQUESTS_PER_MINUTE)),
+        build_limiter(settings.get('tokens_per_minute', DEFAULT_DESCRIPTION_TOKENS_PER_MINUTE)),
+        build_concurrency_limiter('descriptions', config, workers)
+    )
+    max_retries = int(settings.get('max_retries', DEFAULT_DESCRIPTION_MAX_RETRIES))
+    return workers, limiters, max_retries
+
+def get_description_batch_size(config):
+    """Number of descriptions packed into one GPT request; 1 disables batching."""
+    settings = config.get('concurrency', {}).get('descriptions', {})
+    return max(1, int(settings.get('batch_size', DEFAULT_DESCRIPTION_BATCH_SIZE)))
+
+def group_units(rows, batch_size, max_rows):
+    """Group consecutive rows into units holding at most batch_size rows that still need enhancement.
+
+    Rows that already have a description ride along in the unit they fall into, so units
+    complete in input order; a unit is also closed after max_rows rows.
+    """
+    unit, pending = [], 0
+    for row in rows:
+        unit.append(row)
+        if not row['enhanced_description']:
+            pending += 1
+        if pending == batch_size or len(unit) >= max_rows:
+            yield unit
+            unit, pending = [], 0
+    if unit:
+        yield unit
+
+def descriptions_complete(input_source, output_file, config=None):
+    """True if output_file holds a description for every row of the unchanged input.
 
-def process_csv(input_file, output_file):
-    """Process input CSV and create or update output CSV with enhanced descriptions."""
+    Uses the row counts recorded in the manifest by process_csv(), so neither CSV is parsed.
+    """
+    if not os.path.exists(output_file):
+        return False
+    manifest = open_manifest(output_file, config)
+    try:
+        signature = manifest.get_meta('input_signature')
+        input_rows = manifest.get_meta('input_rows')
+        enhanced_rows = manifest.get_meta('input_enhanced_rows')
+    finally:
+        manifest.close()
+    return signature is not None and signature == source_signature(input_source) and input_rows == enhanced_rows
+
+def process_csv(input_file, output_file, config=None, workers=None, batch_size=None):
+    """Process input CSV and create or update output CSV with enhanced descriptions.
+
+    The input (a local path or s3:// URL) is read in chunks and rows are written to the
+    manifest as they complete, so memory stays bounded however large the input is. With
+    the scheduler enabled the most important rows are enhanced first, within its token
+    budget and deadline; rows it does not get to are deferred to --retry-failed.
+    """
+    config = config or SETTINGS.config
     gpt_prompts = load_gpt_prompts()
+    configured_workers, limiters, max_retries = get_description_concurrency(config)
+    workers = workers or configured_workers
+    batch_size = batch_size or get_description_batch_size(config)
+    window = workers * get_ingest_settings(config)[2]
+    cache = get_response_cache(config)
+    dead_letters = get_dead_letter_store(config)
+    budget = get_budget(config)
+    scheduler_settings = get_scheduler_settings(config)
+    stats = UsageStats()
     
-    if not os.path.exists(input_file):
+    if not source_exists(input_file):
         logging.error(f"Input file {input_file} not found.")
         return False
+    signature = source_signature(input_file)
     
-    # Read existing output file if it exists
-    if os.path.exists(output_file):
-        existing_df = pd.read_csv(output_file)
-        existing_df.set_index('image_id', inplace=True)
-    else:
-        existing_df = pd.DataFrame()
+    # Rows of the existing output file, keyed by image_id
+    manifest = open_manifest(output_file, config)
     
-    updated_rows = []
+    # Enhancements that landed in a previous run that crashed before the CSV was written
+    journal_path = journal_path_for(output_file)
+    journaled = load_journal(journal_path)
     
-    with open(input_file, 'r') as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
+    def read_rows():
+        for index, row in enumerate(iter_csv_rows(input_file, config)):
             image_id = row['image_id'].strip()
-            context = row['context'].strip().replace(' ', '_')
-            original_description = row['description'].strip().strip('"')
+            updated_row = {
+                'index': index,
+                'image_id': image_id,
+                'context': row['context'].strip().replace(' ', '_'),
+                'original_description': row['description'].strip().strip('"'),
+                'enhanced_description': None
+            }
+            if scheduler_settings is not None:
+                updated_row['priority'] = (row.get(scheduler_settings['priority_column']) or '').strip() or None
             
             # Check if this image_id already has an enhanced description
-            if image_id in existing_df.index and pd.notna(existing_df.loc[image_id, 'enhanced_description']):
-                enhanced_description = existing_df.loc[image_id, 'enhanced_description']
+            existing_description = manifest.get_value(image_id, 'enhanced_description')
+            if existing_description:
+                updated_row['enhanced_description'] = existing_description
                 logging.info(f"Using existing enhanced description for image {image_id}")
-            else:
-                enhanced_description = improve_description(original_description, gpt_prompts)
-                logging.info(f"Generated new enhanced description for image {image_id}")
-            
-            updated_rows.append({
-                'image_id': image_id,
-                'context': context,
-                'original_description': original_description,
-                'enhanced_description': enhanced_description
-            })
+            elif image_id in journaled:
+                updated_row['enhanced_description'] = journaled[image_id]['enhanced_description']
+                logging.info(f"Using journaled enhanced description for image {image_id}")
+            yield updated_row
+    
+    journal = ProgressJournal(journal_path)
+    batch_prompt = load_batch_prompt() if batch_size > 1 else None
+    
+    def enhance_unit(unit):
+        pending = [row for row in unit if not row['enhanced_description']]
+        if not pending:
+            return
+        if batch_size > 1:
+            results = enhance_batch(pending, gpt_prompts, batch_prompt, limiters, max_retries, journal, cache, stats, dead_letters, budget)
+        else:
+            results = [enhance_row(row, gpt_prompts, limiters, max_retries, journal, cache, stats, dead_letters, budget) for row in pending]
+        for row, enhanced_description in zip(pending, results):
+            row['enhanced_description'] = enhanced_description
+            if enhanced_description:
+                logging.info(f"Generated new enhanced description for image {row['image_id']}")
+    
+    logging.info(f"Enhancing descriptions from {input_file} with {workers} workers, {batch_size} per request")
+    
+    rows = read_rows()
+    if scheduler_settings is not None:
+        rows = prioritized(rows, scheduler_settings)
+    
+    # Upsert this run's rows over the existing ones in input order as they complete
+    input_rows = enhanced_rows = 0
+    writer = InOrderWriter(manifest)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for unit, future in ordered_map(executor, enhance_unit, group_units(rows, batch_size, MANIFEST_WRITE_BATCH), window):
+            future.result()
+            input_rows += len(unit)
+            enhanced_rows += sum(1 for row in unit if row['enhanced_description'])
+            for row in unit:
+                writer.add(row['index'], row)
+    writer.flush()
     
-    # Create a new DataFrame with updated rows
-    updated_df = pd.DataFrame(updated_rows)
-    updated_df.set_index('image_id', inplace=True)
+    stats.log_summary("batched" if batch_size > 1 else "unbatched")
     
-    # Combine existing and new data, giving priority to new data
-    final_df = existing_df.combine_first(updated_df)
+    # Compact into the CSV and drop the journal; the counts let the next run skip this stage cheaply
+    manifest.export_csv(output_file, enhanced_columns(config))
+    manifest.set_meta('input_signature', signature)
+    manifest.set_meta('input_rows', input_rows)
+    manifest.set_meta('input_enhanced_rows', enhanced_rows)
+    manifest.close()
+    journal.discard()
+    logging.info(f"Updated CSV saved to {output_file}: {enhanced_rows} of {input_rows} rows enhanced")
     
-    # Save the updated DataFrame to CSV
-    final_df.reset_index().to_csv(output_file, index=False)
-    logging.info(f"Updated CSV saved to {output_file}")
+    if cache is not None:
+        cache.log_stats("descriptions")
     
     return True
 
+def retry_descriptions(rows, output_file, config=None, workers=None):
+    """Enhance only the given rows (failed ones being retried) and upsert them into output_file.
+
+    Returns the rows that now have a description; rows that fail again go back to the dead-letter store.
+    """
+    config = config or SETTINGS.config
+    gpt_prompts = load_gpt_prompts()
+    configured_workers, limiters, max_retries = get_description_concurrency(config)
+    cache = get_response_cache(config)
+    dead_letters = get_dead_letter_store(config)
+    budget = get_budget(config)
+    scheduler_settings = get_scheduler_settings(config)
+    if scheduler_settings is not None:
+        rows = list(prioritized(rows, scheduler_settings))
+
+    manifest = open_manifest(output_file, config)
+    journal = ProgressJournal(journal_path_for(output_file))
+
+    def enhance(row):
+        return enhance_row(row, gpt_prompts, limiters, max_retries, journal, cache, None, dead_letters, budget)
+
+    logging.info(f"Retrying {len(rows)} failed descriptions")
+    with ThreadPoolExecutor(max_workers=workers or configured_workers) as executor:
+        for row, enhanced_description in zip(rows, executor.map(enhance, rows)):
+            row['enhanced_description'] = enhanced_description
+    recovered = [row for row in rows if row['enhanced_description']]
+    manifest.upsert_many(recovered)
+
+    # Keep the counts used by descriptions_complete() in step with the rows just recovered
+    enhanced_rows = manifest.get_meta('input_enhanced_rows')
+    if enhanced_rows is not None:
+        manifest.set_meta('input_enhanced_rows', int(enhanced_rows) + len(recovered))
+    manifest.export_csv(output_file, enhanced_columns(config))
+    manifest.close()
+    journal.discard()
+    logging.info(f"Recovered {len(recovered)} of {len(rows)} failed descriptions")
+    return recovered
+
 if __name__ == "__main__":
+    from config import INPUT_CSV, ENHANCED_DESCRIPTIONS_CSV
+
     input_file = INPUT_CSV
     output_file = ENHANCED_DESCRIPTIONS_CSV
     
@@ -1,11 +1,22 @@
 import os
-import yaml
-import pandas as pd
 import logging
-import requests
+import tempfile
 from dotenv import load_dotenv
-from config import CONFIG, ENHANCED_DESCRIPTIONS_CSV, IMAGES_CSV, OUTPUT_DIR, OUTPUT_FORMAT
+from config import SETTINGS
 import hashlib
+import time
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import THROTTLE_STATUSES, build_concurrency_limiter, build_limiter, concurrency_slot
+from http_session import get_http_settings, get_stability_session
+from response_cache import get_response_cache, make_cache_key
+from progress_journal import ProgressJournal, journal_path_for, load_journal
+from manifest_store import InOrderWriter, image_columns, open_manifest
+from dedup import build_variant_indexes, get_dedup_settings, reuse_image
+from ingest import get_ingest_settings, iter_csv_rows, ordered_map
+from variants import get_variants, variant_file_name, variant_row, load_variants
+from dead_letters import get_dead_letter_store, note_failure
+from scheduler import Deferred, get_budget, get_scheduler_settings, prioritized, reserve
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -13,62 +24,121 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Load environment variables
 load_dotenv()
 
-# Load configuration
-with open('./configs/images.yml', 'r') as config_file:
-    config = yaml.safe_load(config_file)
-
 # Initialize Stability AI API endpoint
-STABILITY_API_URL = "https://api.stability.ai/v2beta/stable-image/generate/sd3"
+STABILITY_API_URL = os.getenv('STABILITY_API_URL', "https://api.stability.ai/v2beta/stable-image/generate/sd3")
+
+# Concurrency defaults, overridden by the `concurrency.images` section of the config
+DEFAULT_IMAGE_WORKERS = 4
+DEFAULT_IMAGE_REQUESTS_PER_MINUTE = 600
+
+def stream_to_file(chunks, file_path):
+    """Write chunks to a temp file next to file_path and atomically rename it into place."""
+    directory = os.path.dirname(os.path.abspath(file_path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
-def generate_image(prompt, config):
-    """Generate an image using Stable Diffusion 3 Large Turbo based on the given prompt and configuration."""
+def build_image_request(prompt, config, variant=None):
+    """Form fields of a Stable Diffusion 3 request for one variant of a prompt.
+
+    The variant sets seed and aspect ratio (the first configured variant by default).
+    Only fields the SD3 endpoint documents are sent: the other `stability_ai` settings
+    (cfg_scale, style_preset, steps, ...) have no SD3 equivalent, and negative_prompt
+    does not work with sd3-large-turbo.
+    """
+    variant = variant or get_variants(config)[0]
+    data = {
+        "prompt": prompt,
+        "model": "sd3-large-turbo",
+        "output_format": config['output']['format'],
+        "aspect_ratio": variant['aspect_ratio'],
+        "seed": variant['seed'],
+        "mode": "text-to-image"
+    }
+    return data
+
+def generate_image(prompt, config, file_path=None, concurrency_limiter=None, variant=None, limiter=None):
+    """Generate an image using Stable Diffusion 3 Large Turbo based on the given prompt and configuration.
+    
+    With file_path the response body is streamed to disk and file_path is returned;
+    otherwise the image bytes are returned. A concurrency_limiter is told about 429/503
+    responses, including ones that urllib3 retried away; a limiter only paces requests
+    that are not cached. Raises Deferred if the request is not cached and the
+    scheduler's budget or deadline does not allow it.
+    """
     try:
-        headers = {
-            "Authorization": f"Bearer {os.getenv('STABILITY_API_KEY')}",
-            "Accept": "image/*"
-        }
-
-        aspect_ratio = "1:1" #@param ["21:9", "16:9", "3:2", "5:4", "1:1", "4:5", "2:3", "9:16", "9:21"]
-        seed = 0 #@param {type:"integer"}
-        output_format = "png" #@param ["jpeg", "png"]
-
-        params = {
-            "prompt" : prompt,
-            "aspect_ratio" : aspect_ratio,
-            "seed" : seed,
-            "output_format" : output_format,
-            "model" : "sd3-large-turbo"
-        }
-
-        # Encode parameters
-        files = {}
-        image = params.pop("image", None)
-        mask = params.pop("mask", None)
-        if image is not None and image != '':
-            files["image"] = open(image, 'rb')
-        if mask is not None and mask != '':
-            files["mask"] = open(mask, 'rb')
-        if len(files)==0:
-            files["none"] = ''
+        # The endpoint only takes multipart form data, so send an empty file part
+        files = {"none": ''}
+        data = build_image_request(prompt, config, variant)
         
-        data = {
-            "prompt": prompt,
-            "model": "sd3-large-turbo",
-            "output_format": config['output']['format'],
-            "aspect_ratio": "1:1",  # Default to 1:1, adjust as needed
-            "seed": 0,  # Use random seed
-            "mode": "text-to-image"
-        }
+        # Identical requests produce identical images, so reuse any earlier result; seed 0
+        # asks the API for a random seed, so its images are not reproducible and not cached
+        cache = get_response_cache(config) if data['seed'] else None
+        cache_key = make_cache_key(dict(data, endpoint="stability/sd3"))
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                if file_path is None:
+                    return cached
+                with metrics.timer('image_write_seconds'):
+                    stream_to_file([cached], file_path)
+                return file_path
         
-        response = requests.post(STABILITY_API_URL, headers=headers, files=files, data=data)
+        settings = get_http_settings(config)
+        session = get_stability_session(config)
+        budget = get_budget(config)
+        # Extra variants are the first work dropped when the budget runs low
+        optional = variant is not None and variant['key'] != get_variants(config)[0]['key']
+        with reserve(budget, 'generate', optional=optional) as refusal:
+            if refusal is not None:
+                raise Deferred(refusal)
+            if limiter is not None:
+                limiter.acquire()
+            with concurrency_slot(concurrency_limiter) as slot, metrics.in_flight('stability_requests_in_flight'):
+                start = time.perf_counter()
+                response = session.post(STABILITY_API_URL, files=files, data=data, timeout=settings['timeout'], stream=file_path is not None)
+                seconds = time.perf_counter() - start
+                metrics.observe('stability_request_seconds', seconds)
+                retries = getattr(response.raw, 'retries', None)
+                history = retries.history if retries is not None else ()
+                slot.throttled = response.status_code in THROTTLE_STATUSES or any(attempt.status in THROTTLE_STATUSES for attempt in history)
+            # Only successful generations are billed
+            if budget is not None and response.status_code == 200:
+                budget.charge('generate', budget.credits_per_image, seconds)
+        metrics.inc('stability_requests_total', status=response.status_code)
+        if history:
+            metrics.inc('stability_retries_total', len(history))
         
-        if response.status_code == 200:
-            return response.content
-        else:
-            logging.error(f"Error generating image. Status code: {response.status_code}, Response: {response.text}")
-            return None
+        with response:
+            if response.status_code != 200:
+                logging.error(f"Error generating image. Status code: {response.status_code}, Response: {response.text}")
+                note_failure(status_code=response.status_code, message=response.text)
+                return None
+            
+            if file_path is None:
+                if cache is not None:
+                    cache.put(cache_key, response.content)
+                return response.content
+            
+            # Streams the body as it arrives, so this covers download and disk write together
+            with metrics.timer('image_write_seconds'):
+                stream_to_file(response.iter_content(chunk_size=settings['chunk_size']), file_path)
+        
+        if cache is not None:
+            cache.put_file(cache_key, file_path)
+        return file_path
+    except Deferred:
+        raise
     except Exception as e:
         logging.error(f"Error generating image for prompt: {prompt}. Error: {str(e)}")
+        note_failure(e)
         return None
 
 def generate_deterministic_guid(image_id, context, original_description):
@@ -80,63 +150,269 @@ def generate_deterministic_guid(image_id, context, original_description):
     
     return guid
 
-def process_descriptions(input_csv, output_csv, config):
-    """Process the enhanced descriptions CSV and generate images."""
-    output_dir = OUTPUT_DIR
+def image_file_name(image_id, context, original_description, config):
+    """Deterministic file name of a row's image, so reruns find and overwrite the same file."""
+    return f"{image_id}_{context}_{generate_deterministic_guid(image_id, context, original_description)}.{config['output']['format']}"
+
+def get_image_concurrency(config):
+    """Return (workers, requests_per_minute) for the image stage from the configuration."""
+    settings = config.get('concurrency', {}).get('images', {})
+    workers = max(1, int(settings.get('workers', DEFAULT_IMAGE_WORKERS)))
+    requests_per_minute = settings.get('requests_per_minute', DEFAULT_IMAGE_REQUESTS_PER_MINUTE)
+    return workers, requests_per_minute
+
+def generate_and_save(job, output_dir, config, limiter=None, journal=None, concurrency_limiter=None):
+    """Generate the image for a job row and write it to disk. Safe to call from worker threads.
+
+    Returns True on success, False on failure, and None if the scheduler's budget or
+    deadline did not allow the request. Failed and deferred jobs are recorded in the
+    dead-letter store (if enabled) for a later --retry-failed run.
+    """
+    dead_letters = get_dead_letter_store(config)
+    file_path = os.path.join(output_dir, job['file_name'])
+    try:
+        with metrics.span(job['image_id'], 'generate'):
+            generated = generate_image(job['enhanced_description'], config, file_path, concurrency_limiter, job.get('variant'), limiter)
+    except Deferred as e:
+        metrics.inc('images_deferred_total')
+        if dead_letters is not None:
+            dead_letters.defer('generate', job, e.reason)
+        return None
+    if not generated:
+        metrics.inc('images_failed_total')
+        if dead_letters is not None:
+            dead_letters.record_failure('generate', job)
+        return False
+    metrics.inc('images_generated_total')
+    logging.info(f"Generated image saved to {file_path}")
+    
+    # Journal the paid-for image immediately so a crash later in the run cannot lose it
+    if journal is not None:
+        journal.record(job)
+    if dead_letters is not None:
+        dead_letters.resolve('generate', job)
+    return True
+
+def image_exists(output_dir, file_name):
+    return os.path.exists(os.path.join(output_dir, file_name)) and os.path.getsize(os.path.join(output_dir, file_name)) > 0
+
+def variant_jobs(row, config, variants, output_dir):
+    """Split a row into (files, jobs): the variant images already on disk and a job for each missing one.
+
+    File names are deterministic, so a variant finished by an earlier run, even one that
+    crashed before it was written to the CSV, is found on disk and not generated again.
+    """
+    file_name = image_file_name(row['image_id'], row['context'], row['original_description'], config)
+    files, jobs = {}, []
+    for variant in variants:
+        variant_file = variant_file_name(file_name, variant, variants)
+        if image_exists(output_dir, variant_file):
+            files[variant['key']] = variant_file
+        else:
+            jobs.append(dict(row, file_name=variant_file, variant=variant))
+    return files, jobs
+
+def process_descriptions(input_csv, output_csv, config, workers=None):
+    """Process the enhanced descriptions CSV and generate images concurrently.
+
+    Every configured variant of a row is its own job, so variants run concurrently and
+    are resumed and cached independently. Rows are read and generated as a stream with a
+    bounded number of jobs in flight, and written to the manifest in input order, so
+    memory does not grow with the size of the input. With `bundles.enabled` the images
+    are bundled by sync_to_s3(), after post-processing has rewritten them.
+    With the scheduler enabled the most important rows are generated first, within its
+    credit budget and deadline; jobs it does not get to are deferred to --retry-failed.
+    """
+    output_dir = SETTINGS.config['output']['directory']
     os.makedirs(output_dir, exist_ok=True)
     
-    # Read input CSV
-    input_df = pd.read_csv(input_csv, encoding='utf-8')
+    configured_workers, requests_per_minute = get_image_concurrency(config)
+    workers = workers or configured_workers
+    window = workers * get_ingest_settings(config)[2]
+    limiter = build_limiter(requests_per_minute)
+    concurrency_limiter = build_concurrency_limiter('images', config, workers)
+    variants = get_variants(config)
     
-    # Check if output CSV exists and read it, otherwise create an empty DataFrame
-    if os.path.exists(output_csv):
-        output_df = pd.read_csv(output_csv)
-        output_df.set_index('image_id', inplace=True)
-    else:
-        output_df = pd.DataFrame(columns=['image_id', 'context', 'original_description', 'enhanced_description', 'file_name'])
-        output_df.set_index('image_id', inplace=True)
+    # Rows of the existing output CSV, keyed by image_id
+    manifest = open_manifest(output_csv, config)
     
-    # Process each row in the input DataFrame
-    for _, row in input_df.iterrows():
-        image_id = row['image_id']
-        
-        # Check if this image_id already exists in the output DataFrame
-        if image_id in output_df.index and pd.notna(output_df.loc[image_id, 'file_name']):
-            file_path = os.path.join(output_dir, output_df.loc[image_id, 'file_name'])
-            if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                logging.info(f"Skipping image_id {image_id}: Already generated")
+    # Fold in images completed by a previous run that crashed before compaction
+    journal_path = journal_path_for(output_csv)
+    manifest.upsert_many(load_journal(journal_path).values())
+    journal = ProgressJournal(journal_path)
+    
+    # Near-duplicate prompts reuse the image of the first similar prompt instead of calling the API
+    dedup_settings = get_dedup_settings(config)
+    dedup_indexes = build_variant_indexes(config, variants, manifest, output_dir)
+    dead_letters = get_dead_letter_store(config)
+    scheduler_settings = get_scheduler_settings(config)
+    writer = InOrderWriter(manifest)
+    
+    def read_rows():
+        for index, row in enumerate(iter_csv_rows(input_csv, config)):
+            normalised = {column: (row[column] or '').strip() for column in ('image_id', 'context', 'original_description', 'enhanced_description')}
+            normalised['index'] = index
+            if scheduler_settings is not None:
+                normalised['priority'] = (row.get('priority') or '').strip() or None
+            yield normalised
+    
+    def read_jobs():
+        """Yield (state, job, reuse_from) for each variant still missing an image, in input order
+        or, with the scheduler enabled, highest priority first.
+
+        state is shared by the jobs of one row and collects its variant files; a row whose
+        variants are all on disk but not yet in the manifest is yielded once with no job.
+        """
+        rows = read_rows()
+        if scheduler_settings is not None:
+            rows = prioritized(rows, scheduler_settings)
+        for row in rows:
+            image_id = row['image_id']
+            if not row['enhanced_description']:
+                logging.warning(f"No enhanced description for {image_id}; skipping image generation")
+                writer.add(row['index'], None)
                 continue
+            
+            files, jobs = variant_jobs(row, config, variants, output_dir)
+            state = {'row': row, 'files': files, 'pending': len(jobs)}
+            if not jobs:
+                existing = manifest.get(image_id)
+                if existing and all(existing[column] == value for column, value in variant_row(row, files, variants).items() if column != 'image_id'):
+                    logging.info(f"Skipping image_id {image_id}: Already generated")
+                    writer.add(row['index'], None)
+                    continue
+                yield state, None, None
+            for job in jobs:
+                index = dedup_indexes[job['variant']['key']] if dedup_indexes is not None else None
+                reuse_from = index.match_or_add(job['file_name'], job['enhanced_description']) if index is not None else None
+                yield state, job, reuse_from
+    
+    def generate(item):
+        state, job, reuse_from = item
+        if job is None or reuse_from is not None:
+            return None
+        return generate_and_save(job, output_dir, config, limiter, journal, concurrency_limiter)
+    
+    logging.info(f"Generating images from {input_csv} with {workers} workers, {len(variants)} variants per row")
+    
+    generated = reused = failed = deferred = 0
+    
+    def result_of(state, future):
+        try:
+            return future.result()
+        except Exception as e:
+            logging.error(f"Exception occurred while generating image for {state['row']['image_id']}: {e}")
+            return False
+    
+    def finish(state, job, success, reused_image=False):
+        nonlocal generated, failed, deferred
+        if job is not None:
+            if not reused_image:
+                generated += bool(success)
+            state['pending'] -= 1
+            if success:
+                state['files'][job['variant']['key']] = job['file_name']
+            elif success is None:
+                deferred += 1
+            else:
+                failed += 1
+                logging.warning(f"Failed to generate image for {job['image_id']} ({job['variant']['key']})")
         
-        context = row['context'].strip()
-        original_description = row['original_description'].strip()
-        enhanced_description = row['enhanced_description'].strip()
-        
-        output_file = f"{image_id}_{context}_{generate_deterministic_guid(image_id, context, original_description)}.{config['output']['format']}"
-        file_path = os.path.join(output_dir, output_file)
-        
-        image_data = generate_image(enhanced_description, config)
-        
-        if image_data:
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, 'wb') as f:
-                f.write(image_data)
-            logging.info(f"Generated image saved to {file_path}")
+        # A row is written once its last variant is done
+        if state['pending'] == 0:
+            writer.add(state['row']['index'], variant_row(state['row'], state['files'], variants))
+    
+    # Near-duplicates whose original failed, generated in the pool after all: (state, job, future)
+    retries = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Results come back in the order jobs were read, so a near-duplicate's original has always finished first
+        for (state, job, reuse_from), future in ordered_map(executor, generate, read_jobs(), window):
+            for retry in [retry for retry in retries if retry[2].done()]:
+                retries.remove(retry)
+                finish(retry[0], retry[1], result_of(retry[0], retry[2]))
             
-            # Update or append the row in the output DataFrame
-            output_df.loc[image_id] = {
-                'context': context,
-                'original_description': original_description,
-                'enhanced_description': enhanced_description,
-                'file_name': output_file
-            }
-        else:
-            logging.warning(f"Failed to generate image for {image_id}")
+            success = result_of(state, future)
+            if job is not None and reuse_from is not None:
+                success = reuse_image(reuse_from, job, output_dir, dedup_settings['link'])
+                if not success:
+                    # The original failed: later duplicates must not match it, and this one is generated after all
+                    dedup_indexes[job['variant']['key']].discard(reuse_from)
+                    retries.append((state, job, executor.submit(generate, (state, job, None))))
+                    continue
+                journal.record(job)
+                reused += 1
+                if dead_letters is not None:
+                    dead_letters.resolve('generate', job)
+            finish(state, job, success, reused_image=reuse_from is not None)
+        for state, job, future in retries:
+            finish(state, job, result_of(state, future))
+    writer.flush()
     
-    # Save the updated DataFrame to CSV
-    output_df.reset_index().to_csv(output_csv, index=False)
+    logging.info(f"Generated {generated} images, {failed} failed" + (f", {deferred} deferred by the scheduler" if deferred else ""))
+    if dedup_indexes is not None:
+        logging.info(f"Near-duplicate detection saved {reused} API calls")
+    
+    # Compact the journal into the CSV atomically, then drop the journal
+    manifest.export_csv(output_csv, image_columns(config))
+    manifest.close()
+    journal.discard()
     logging.info(f"Updated CSV saved to {output_csv}")
+    
+    cache = get_response_cache(config)
+    if cache is not None:
+        cache.log_stats("images")
+
+def retry_images(jobs, output_csv, config, workers=None):
+    """Generate images for only the given jobs (failed rows being retried) and upsert them into output_csv.
+
+    Each job is a row with an enhanced description, and file_name and variant if it came
+    from the dead-letter store; a row without them gets a job per missing variant. Jobs
+    that fail again go back to the dead-letter store. Returns the number of images generated.
+    """
+    output_dir = SETTINGS.config['output']['directory']
+    os.makedirs(output_dir, exist_ok=True)
+    
+    configured_workers, requests_per_minute = get_image_concurrency(config)
+    workers = workers or configured_workers
+    limiter = build_limiter(requests_per_minute)
+    concurrency_limiter = build_concurrency_limiter('images', config, workers)
+    variants = get_variants(config)
+    manifest = open_manifest(output_csv, config)
+    journal = ProgressJournal(journal_path_for(output_csv))
+    
+    jobs = [job for row in jobs for job in ([row] if row.get('variant') else variant_jobs(row, config, variants, output_dir)[1])]
+    scheduler_settings = get_scheduler_settings(config)
+    if scheduler_settings is not None:
+        jobs = list(prioritized(jobs, scheduler_settings))
+    
+    def generate(job):
+        return generate_and_save(job, output_dir, config, limiter, journal, concurrency_limiter)
+    
+    logging.info(f"Retrying {len(jobs)} failed images")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        generated = [job for job, success in zip(jobs, executor.map(generate, jobs)) if success]
+    
+    # Merge the recovered variants with the ones each row already has
+    updates = {}
+    for job in generated:
+        if job['image_id'] not in updates:
+            existing = manifest.get(job['image_id']) or {}
+            files = load_variants(existing.get('variants'))
+            if not files and existing.get('file_name') and len(variants) == 1:
+                files = {variants[0]['key']: existing['file_name']}
+            updates[job['image_id']] = (job, files)
+        updates[job['image_id']][1][job['variant']['key']] = job['file_name']
+    manifest.upsert_many([row for row in (variant_row(job, files, variants) for job, files in updates.values()) if row])
+    manifest.export_csv(output_csv, image_columns(config))
+    manifest.close()
+    journal.discard()
+    logging.info(f"Recovered {len(generated)} of {len(jobs)} failed images")
+    return len(generated)
 
 if __name__ == "__main__":
+    from config import ENHANCED_DESCRIPTIONS_CSV, IMAGES_CSV
+
+    config = SETTINGS.images
     input_csv = ENHANCED_DESCRIPTIONS_CSV
     output_csv = IMAGES_CSV
     
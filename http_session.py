@@ -0,0 +1,62 @@
+import os
+import threading
+
+# Defaults, overridden by the `http` section of the config
+DEFAULT_POOL_SIZE = 16
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 1.0
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_http_settings(config):
+    """Return the `http` section of the config with defaults filled in."""
+    settings = config.get('http', {})
+    return {
+        'pool_size': int(settings.get('pool_size', DEFAULT_POOL_SIZE)),
+        'timeout': (float(settings.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT)),
+                    float(settings.get('read_timeout', DEFAULT_READ_TIMEOUT))),
+        'max_retries': int(settings.get('max_retries', DEFAULT_MAX_RETRIES)),
+        'backoff_factor': float(settings.get('backoff_factor', DEFAULT_BACKOFF_FACTOR)),
+        'chunk_size': int(settings.get('chunk_size', DEFAULT_CHUNK_SIZE))
+    }
+
+def build_session(pool_size, max_retries, backoff_factor, headers=None):
+    """Create a keep-alive session whose pool and retry policy are shared by all threads."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,  # generation requests are POSTs; retry them too
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+def get_stability_session(config):
+    """Return the shared Stability AI session, built once with the API key and pool settings."""
+    with _sessions_lock:
+        if 'stability' not in _sessions:
+            settings = get_http_settings(config)
+            headers = {
+                "Authorization": f"Bearer {os.getenv('STABILITY_API_KEY')}",
+                "Accept": "image/*"
+            }
+            _sessions['stability'] = build_session(settings['pool_size'], settings['max_retries'],
+                                                   settings['backoff_factor'], headers)
+        return _sessions['stability']
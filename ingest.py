@@ -0,0 +1,131 @@
+import io
+import os
+import csv
+import logging
+import collections
+from dotenv import load_dotenv
+import metrics
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Load environment variables
+load_dotenv()
+
+# Defaults, overridden by the `ingest` section of the config
+DEFAULT_CHUNK_SIZE_MB = 8
+DEFAULT_WINDOW_PER_WORKER = 4
+
+S3_SCHEME = "s3://"
+
+def get_ingest_settings(config):
+    """Return (chunk_size_bytes, stream_from_s3, window_per_worker) from the `ingest` section of the config."""
+    settings = (config or {}).get('ingest', {})
+    chunk_size = max(1, int(float(settings.get('chunk_size_mb', DEFAULT_CHUNK_SIZE_MB)) * 1024 * 1024))
+    window = max(1, int(settings.get('window_per_worker', DEFAULT_WINDOW_PER_WORKER)))
+    return chunk_size, bool(settings.get('stream_from_s3', False)), window
+
+def s3_url(bucket_name, key):
+    return f"{S3_SCHEME}{bucket_name}/{key}"
+
+def parse_s3_url(source):
+    """Split s3://bucket/key into (bucket, key), or return None for a local path."""
+    if not str(source).startswith(S3_SCHEME):
+        return None
+    bucket_name, _, key = source[len(S3_SCHEME):].partition('/')
+    return bucket_name, key
+
+class S3RangeReader(io.RawIOBase):
+    """Read-only raw file over an S3 object that fetches byte ranges as they are read.
+
+    Only the ranges being parsed are ever in memory. Every range is requested with the
+    ETag seen when the reader was opened, so an object replaced mid-read fails loudly
+    instead of yielding a mix of two files.
+    """
+
+    def __init__(self, bucket_name, key):
+        from clients import get_s3_client
+
+        self.client = get_s3_client()
+        self.bucket_name = bucket_name
+        self.key = key
+        head = self.client.head_object(Bucket=bucket_name, Key=key)
+        self.size = head['ContentLength']
+        self.etag = head['ETag']
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        end = min(self.position + len(buffer), self.size) - 1
+        with metrics.timer('ingest_range_seconds'):
+            response = self.client.get_object(Bucket=self.bucket_name, Key=self.key,
+                                              Range=f"bytes={self.position}-{end}", IfMatch=self.etag)
+            data = response['Body'].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        metrics.inc('ingest_bytes_total', len(data), source='s3')
+        return len(data)
+
+def source_exists(source):
+    """True if a local path or s3:// URL points at an existing object."""
+    location = parse_s3_url(source)
+    if location is None:
+        return os.path.exists(source)
+    from botocore.exceptions import ClientError
+    from clients import get_s3_client
+
+    try:
+        get_s3_client().head_object(Bucket=location[0], Key=location[1])
+        return True
+    except ClientError:
+        return False
+
+def source_signature(source):
+    """Cheap identity of an input: size and mtime for a local file, the ETag for S3; None if missing."""
+    location = parse_s3_url(source)
+    if location is None:
+        try:
+            stat = os.stat(source)
+        except FileNotFoundError:
+            return None
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+    from botocore.exceptions import ClientError
+    from clients import get_s3_client
+
+    try:
+        return get_s3_client().head_object(Bucket=location[0], Key=location[1])['ETag']
+    except ClientError:
+        return None
+
+def open_csv_source(source, config=None):
+    """Open a local path or s3:// URL as a text stream read in chunks of `ingest.chunk_size_mb`."""
+    chunk_size = get_ingest_settings(config)[0]
+    location = parse_s3_url(source)
+    if location is None:
+        raw = io.FileIO(source, 'r')
+    else:
+        raw = S3RangeReader(*location)
+    return io.TextIOWrapper(io.BufferedReader(raw, buffer_size=chunk_size), encoding='utf-8', newline='')
+
+def iter_csv_rows(source, config=None):
+    """Yield the rows of a CSV as dicts while it is read, without loading the whole file."""
+    with open_csv_source(source, config) as file:
+        yield from csv.DictReader(file)
+
+def ordered_map(executor, fn, items, window):
+    """Yield (item, future) for fn(item) in input order, with at most `window` items in flight.
+
+    Unlike executor.map(), items are pulled from the iterable only as earlier ones are
+    consumed, so memory stays bounded however long the input is.
+    """
+    in_flight = collections.deque()
+    for item in items:
+        in_flight.append((item, executor.submit(fn, item)))
+        if len(in_flight) >= window:
+            yield in_flight.popleft()
+    while in_flight:
+        yield in_flight.popleft()
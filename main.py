@@ -1,13 +1,21 @@
 import os
+import time
 import logging
-import csv
+import argparse
 from dotenv import load_dotenv
-from config import CONFIG, INPUT_CSV, ENHANCED_DESCRIPTIONS_CSV, IMAGES_CSV, OUTPUT_DIR, S3_BUCKET_NAME, S3_INPUT_KEY
+import config
 from download_csv import download_csv_from_s3
-from generate_descriptions import process_csv as generate_descriptions
-from generate_images import process_descriptions as generate_images
+from generate_descriptions import process_csv as generate_descriptions, descriptions_complete, retry_descriptions
+from generate_images import process_descriptions as generate_images, retry_images
+from postprocess import postprocess_images
 from sync_to_s3 import sync_to_s3
 from validate_artifacts import validate_artifacts
+from pipeline import run_streaming_pipeline
+import metrics
+from sharding import parse_shard, run_shard, run_leased_worker, merge_partials
+from ingest import get_ingest_settings, s3_url
+from dead_letters import get_dead_letter_store
+from scheduler import close_budget, get_budget
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -16,48 +24,150 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 load_dotenv()
 
 
-def count_csv_rows(file_path):
-    """Count the number of valid rows in a CSV file."""
-    if not os.path.exists(file_path):
-        return 0
-    with open(file_path, 'r') as file:
-        reader = csv.reader(file)
-        return sum(1 for row in reader if row)
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate images from descriptions and sync them to S3.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Overlap enhancement, generation and upload through bounded queues instead of running them as separate passes")
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N',
+                        help="Only process rows whose image_id hashes to shard I of N, writing partial output CSVs")
+    parser.add_argument('--lease-db', metavar='PATH',
+                        help="Claim rows in batches from a shared SQLite lease database instead of a fixed shard")
+    parser.add_argument('--worker-id', help="Identifier for this worker in lease mode (default: host-pid)")
+    parser.add_argument('--merge-shards', action='store_true',
+                        help="Merge partial output CSVs from shard or lease workers, then validate and sync")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="Retry only the rows recorded in the dead-letter store, with exponential backoff, then sync")
+    parser.add_argument('--refresh-sync-state', action='store_true',
+                        help="Rebuild the local index of uploaded files from a full listing of the S3 prefix before syncing")
+    return parser.parse_args(argv)
 
-def file_size_equal(file1, file2):
-    """Check if two CSV files have the same number of valid rows."""
-    return count_csv_rows(file1) == count_csv_rows(file2)
+def resolve_input_source():
+    """Return where to read the input CSV: the local file, or an s3:// URL read in ranges
+    when `ingest.stream_from_s3` is set; otherwise download it first. None on failure."""
+    if os.path.exists(config.INPUT_CSV):
+        return config.INPUT_CSV
+    bucket_name = os.getenv('S3_BUCKET_NAME')
+    if not bucket_name:
+        logging.error("S3_BUCKET_NAME environment variable is not set")
+        return None
+    if get_ingest_settings(config.CONFIG)[1]:
+        logging.info(f"Streaming input from s3://{bucket_name}/{config.S3_INPUT_KEY}")
+        return s3_url(bucket_name, config.S3_INPUT_KEY)
+    if not download_csv_from_s3(bucket_name, config.S3_INPUT_KEY, config.INPUT_CSV):
+        logging.error("Failed to download input CSV")
+        return None
+    return config.INPUT_CSV
+
+def run_distributed(args):
+    """Run one worker of a sharded batch; merging and syncing happen later via --merge-shards."""
+    input_source = resolve_input_source()
+    if input_source is None:
+        return False
+    if args.shard:
+        shard_index, shard_count = args.shard
+        return run_shard(input_source, config.ENHANCED_DESCRIPTIONS_CSV, config.IMAGES_CSV, shard_index, shard_count, config.CONFIG)
+    return run_leased_worker(input_source, config.ENHANCED_DESCRIPTIONS_CSV, config.IMAGES_CSV, args.lease_db, config.CONFIG, args.worker_id)
+
+def retry_failed():
+    """Retry the rows that failed earlier runs until they succeed or reach dead_letters.max_attempts.
+
+    Rows are retried in rounds as their backoff expires; a row whose description is
+    recovered has its image generated in the same round. Rows deferred by the scheduler
+    are due at once, so retrying stops when the budget or deadline runs out again.
+    """
+    dead_letters = get_dead_letter_store(config.CONFIG)
+    if dead_letters is None:
+        logging.error("dead_letters.enabled is false; there are no recorded failures to retry")
+        return False
+    
+    while True:
+        now = time.time()
+        described = dead_letters.due('describe', now)
+        jobs = dead_letters.due('generate', now)
+        if described:
+            # Recovered rows get a job for each of their variants
+            jobs.extend(retry_descriptions(described, config.ENHANCED_DESCRIPTIONS_CSV, config.CONFIG))
+        if jobs:
+            retry_images(jobs, config.IMAGES_CSV, config.CONFIG)
+        
+        budget = get_budget(config.CONFIG)
+        if budget is not None and budget.exhausted():
+            logging.warning("Scheduler budget or deadline reached; stopping retries")
+            break
+        next_due = dead_letters.next_due()
+        if next_due is None:
+            break
+        delay = max(0, next_due - time.time())
+        logging.info(f"Waiting {delay:.0f}s for the next failed rows to be due")
+        time.sleep(delay)
+    
+    for (stage, error_class), (rows, exhausted) in sorted(dead_letters.summary().items()):
+        logging.warning(f"{rows} rows still failing at {stage} with {error_class}; gave up on {exhausted}")
+    return True
+
+def main(argv=None):
+    args = parse_args(argv)
+    metrics.start_metrics_server(config.CONFIG)
+    # The scheduler's deadline counts from here
+    get_budget(config.CONFIG)
+    try:
+        run(args)
+    finally:
+        close_budget()
+        metrics.write_summary(config.CONFIG)
 
-def main():
+def run(args):
+    if args.shard or args.lease_db:
+        if run_distributed(args):
+            logging.info("Worker finished; run with --merge-shards once all workers are done")
+        else:
+            logging.error("Worker finished with failures")
+        return
+    
+    if args.merge_shards:
+        if not (merge_partials(config.ENHANCED_DESCRIPTIONS_CSV, config.CONFIG) and merge_partials(config.IMAGES_CSV, config.CONFIG)):
+            return
+    
     # Validate artifacts
-    artifacts_valid = validate_artifacts(IMAGES_CSV, CONFIG)
-    if artifacts_valid:
+    if args.retry_failed:
+        if not retry_failed():
+            return
+        # Only the recovered images still need derivatives and uploading
+        postprocess_images(config.IMAGES_CSV, config.CONFIG)
+    elif validate_artifacts(config.IMAGES_CSV, config.CONFIG):
         logging.info("Artifacts are valid. Skipping download and generation.")
     else:
-        # Download the CSV file
-        csv_exists = os.path.exists(INPUT_CSV)
-        if not csv_exists:
+        # Find the input CSV, downloading it unless it is streamed from S3
+        input_source = resolve_input_source()
+        if input_source is None:
+            return
+        
+        if args.stream:
             bucket_name = os.getenv('S3_BUCKET_NAME')
             if not bucket_name:
                 logging.error("S3_BUCKET_NAME environment variable is not set")
                 return
-            csv_downloaded = download_csv_from_s3(bucket_name, S3_INPUT_KEY, INPUT_CSV)
-            if not csv_downloaded:
-                logging.error("Failed to download input CSV")
-                return
+            if run_streaming_pipeline(input_source, config.ENHANCED_DESCRIPTIONS_CSV, config.IMAGES_CSV, bucket_name, config.CONFIG['s3']['folder'], config.CONFIG,
+                                      args.refresh_sync_state):
+                logging.info("Streaming pipeline completed successfully")
+            else:
+                logging.error("Streaming pipeline failed")
+            return
         
-        # Generate enhanced descriptions
-        descriptions_exist = os.path.exists(ENHANCED_DESCRIPTIONS_CSV)  and file_size_equal(INPUT_CSV, ENHANCED_DESCRIPTIONS_CSV)
-        if not descriptions_exist:
-            descriptions_generated = generate_descriptions(INPUT_CSV, ENHANCED_DESCRIPTIONS_CSV)
+        # Generate enhanced descriptions, unless the manifest's row counts show they are complete
+        if not descriptions_complete(input_source, config.ENHANCED_DESCRIPTIONS_CSV, config.CONFIG):
+            descriptions_generated = generate_descriptions(input_source, config.ENHANCED_DESCRIPTIONS_CSV)
             if not descriptions_generated:
                 logging.error("Failed to generate enhanced descriptions")
                 return
         
         # Generate images
-        images_exist = os.path.exists(IMAGES_CSV)
+        images_exist = os.path.exists(config.IMAGES_CSV)
         if not images_exist:
-            generate_images(ENHANCED_DESCRIPTIONS_CSV, IMAGES_CSV, CONFIG)
+            generate_images(config.ENHANCED_DESCRIPTIONS_CSV, config.IMAGES_CSV, config.CONFIG)
+        
+        # Write missing or outdated derivatives (only if output.postprocess is enabled)
+        postprocess_images(config.IMAGES_CSV, config.CONFIG)
     
     # Sync to S3
     bucket_name = os.getenv('S3_BUCKET_NAME')
@@ -65,7 +175,8 @@ def main():
         logging.error("S3_BUCKET_NAME environment variable is not set")
         return
     
-    sync_successful = sync_to_s3(OUTPUT_DIR, bucket_name, CONFIG['s3']['folder'], IMAGES_CSV)
+    sync_successful = sync_to_s3(config.OUTPUT_DIR, bucket_name, config.CONFIG['s3']['folder'], config.IMAGES_CSV, config.CONFIG,
+                                 args.refresh_sync_state)
     if sync_successful:
         logging.info("Sync to S3 completed successfully")
     else:
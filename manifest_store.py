@@ -0,0 +1,213 @@
+import csv
+import hashlib
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+from progress_journal import atomic_write_rows
+
+# Column order of the output CSVs: enhanced_descriptions.csv stops before file_name and
+# only has priority when the scheduler is enabled; images.csv only has variants with
+# several variants configured and derivatives when post-processing is enabled
+MANIFEST_COLUMNS = ['image_id', 'context', 'original_description', 'enhanced_description', 'file_name', 'variants', 'derivatives', 'priority']
+ENHANCED_COLUMNS = MANIFEST_COLUMNS[:4]
+IMAGE_COLUMNS = MANIFEST_COLUMNS[:5]
+
+# Defaults, overridden by the `manifest` section of the config
+DEFAULT_MANIFEST_DIRECTORY = ".cache/manifests"
+
+# Finished rows buffered before they are written to a manifest in one transaction
+MANIFEST_WRITE_BATCH = 500
+
+def manifest_path_for(csv_path, directory=DEFAULT_MANIFEST_DIRECTORY):
+    """Return the SQLite file that backs the given output CSV."""
+    digest = hashlib.sha1(os.path.abspath(csv_path).encode('utf-8')).hexdigest()[:8]
+    return os.path.join(directory, f"{os.path.basename(csv_path)}-{digest}.sqlite")
+
+def _csv_signature(csv_path):
+    try:
+        stat = os.stat(csv_path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+class ManifestStore:
+    """Output rows keyed by image_id in SQLite, exported in bulk to the CSV schema.
+
+    Lookups and upserts are single indexed statements, so resuming or updating a
+    100k-row batch never scans or copies the whole table. Rows keep the position of
+    their first insert, which is the order they are exported in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        columns = ", ".join(f"{column} TEXT" for column in MANIFEST_COLUMNS[1:])
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS rows (image_id TEXT PRIMARY KEY, {columns})")
+        existing = {row[1] for row in self.conn.execute("PRAGMA table_info(rows)")}
+        for column in MANIFEST_COLUMNS:
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE rows ADD COLUMN {column} TEXT")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+
+    def _upsert(self, rows):
+        # Consecutive rows carrying the same columns go through one executemany()
+        for columns, group in itertools.groupby(rows, key=lambda row: tuple(column for column in MANIFEST_COLUMNS if column in row)):
+            values = [
+                [str(row['image_id']).strip()] + [None if row[column] in (None, '') else str(row[column]) for column in columns[1:]]
+                for row in group
+            ]
+            updates = ", ".join(f"{column} = excluded.{column}" for column in columns[1:])
+            self.conn.executemany(
+                f"INSERT INTO rows ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT(image_id) DO {'UPDATE SET ' + updates if updates else 'NOTHING'}",
+                values
+            )
+
+    def upsert(self, row):
+        """Insert a row, or update only the columns present in `row` if image_id exists."""
+        self.upsert_many([row])
+
+    def upsert_many(self, rows):
+        with self.lock:
+            self._upsert(rows)
+            self.conn.commit()
+
+    def get(self, image_id):
+        """Return the row for image_id as a dict (missing values are None), or None."""
+        with self.lock:
+            found = self.conn.execute(
+                f"SELECT {', '.join(MANIFEST_COLUMNS)} FROM rows WHERE image_id = ?", (str(image_id).strip(),)
+            ).fetchone()
+        return dict(zip(MANIFEST_COLUMNS, found)) if found else None
+
+    def get_value(self, image_id, column):
+        """Return one column of a row, or None if the row or value is missing."""
+        row = self.get(image_id)
+        return row[column] if row else None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+
+    def count(self, column):
+        """Number of rows with a non-empty value in column, without reading the rows."""
+        if column not in MANIFEST_COLUMNS:
+            raise ValueError(f"Unknown manifest column: {column}")
+        with self.lock:
+            return self.conn.execute(f"SELECT COUNT({column}) FROM rows").fetchone()[0]
+
+    def get_meta(self, key):
+        with self.lock:
+            found = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return found[0] if found else None
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, None if value is None else str(value)))
+            self.conn.commit()
+
+    def rows(self, columns=MANIFEST_COLUMNS):
+        """Yield every row as a dict, in insertion order."""
+        with self.lock:
+            cursor = self.conn.execute(f"SELECT {', '.join(columns)} FROM rows ORDER BY rowid")
+            while True:
+                batch = cursor.fetchmany(1000)
+                if not batch:
+                    break
+                for values in batch:
+                    yield dict(zip(columns, values))
+
+    def sync_from_csv(self, csv_path):
+        """Make the store match csv_path, re-importing it only if it changed since the last export."""
+        signature = _csv_signature(csv_path)
+        with self.lock:
+            stored = self.conn.execute("SELECT value FROM meta WHERE key = 'csv_signature'").fetchone()
+            if signature is not None and stored and stored[0] == signature:
+                return
+            self.conn.execute("DELETE FROM rows")
+            if signature is not None:
+                with open(csv_path, 'r', newline='', encoding='utf-8') as file:
+                    self._upsert(csv.DictReader(file))
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('csv_signature', ?)", (signature,))
+            self.conn.commit()
+        if signature is not None:
+            logging.info(f"Loaded {len(self)} rows from {csv_path} into manifest {self.path}")
+
+    def export_csv(self, csv_path, columns=MANIFEST_COLUMNS):
+        """Atomically write every row to csv_path in the given column order."""
+        atomic_write_rows(self.rows(columns), columns, csv_path)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('csv_signature', ?)",
+                              (_csv_signature(csv_path),))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class InOrderWriter:
+    """Upserts finished rows into a manifest in input order, as soon as every earlier row is done.
+
+    Rows finish out of order, so only the ones ahead of the oldest unfinished row are
+    held; memory is bounded by how far the stages run ahead, not by the input size.
+    """
+
+    def __init__(self, manifest, batch_size=MANIFEST_WRITE_BATCH):
+        self.manifest = manifest
+        self.batch_size = batch_size
+        self.finished = {}
+        self.ready = []
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def add(self, index, row):
+        """Mark input row `index` finished; row is what to write for it, or None for nothing."""
+        with self.lock:
+            self.finished[index] = row
+            while self.next_index in self.finished:
+                row = self.finished.pop(self.next_index)
+                self.next_index += 1
+                if row is not None:
+                    self.ready.append(row)
+            if len(self.ready) >= self.batch_size:
+                self.manifest.upsert_many(self.ready)
+                self.ready = []
+
+    def flush(self):
+        """Write everything still held, including rows after any that never finished."""
+        with self.lock:
+            rows = self.ready + [self.finished[index] for index in sorted(self.finished) if self.finished[index] is not None]
+            self.manifest.upsert_many(rows)
+            self.ready = []
+            self.finished = {}
+
+def enhanced_columns(config):
+    """Columns of enhanced_descriptions.csv for this configuration."""
+    columns = list(ENHANCED_COLUMNS)
+    if (config or {}).get('scheduler', {}).get('enabled'):
+        columns.append('priority')
+    return columns
+
+def image_columns(config):
+    """Columns of images.csv for this configuration."""
+    from variants import get_variants
+
+    columns = list(IMAGE_COLUMNS)
+    if len(get_variants(config)) > 1:
+        columns.append('variants')
+    if config.get('output', {}).get('postprocess', {}).get('enabled'):
+        columns.append('derivatives')
+    return columns
+
+def open_manifest(csv_path, config=None):
+    """Open the manifest for an output CSV, refreshed from the CSV if it was changed outside the store."""
+    directory = (config or {}).get('manifest', {}).get('directory', DEFAULT_MANIFEST_DIRECTORY)
+    store = ManifestStore(manifest_path_for(csv_path, directory))
+    store.sync_from_csv(csv_path)
+    return store
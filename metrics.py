@@ -0,0 +1,235 @@
+import json
+import heapq
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+DEFAULT_SLOWEST_ROWS = 10
+# Rows whose spans are still adding up; the least recently timed one is then ranked for the slowest rows
+DEFAULT_OPEN_ROWS = 1024
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+def _bucket_quantile(buckets, histogram, quantile):
+    """Estimate a quantile from cumulative bucket counts, interpolating within the bucket it falls in."""
+    rank = quantile * histogram['count']
+    lower, below = 0.0, 0
+    for bound, count in zip(buckets, histogram['counts']):
+        if count >= rank and count > below:
+            return min(lower + (bound - lower) * (rank - below) / (count - below), histogram['max'])
+        lower, below = bound, count
+    return histogram['max']
+
+class MetricsRegistry:
+    """In-process counters, gauges, latency histograms and per-image_id spans.
+
+    Memory does not grow with the number of rows: histograms keep bucket counts only and
+    quantiles are estimated from them, and only the slowest_rows slowest image_ids are
+    kept once their spans stop adding up. Every method is thread-safe. Replace the
+    active registry with set_registry() to send the same instrumentation somewhere else.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, slowest_rows=DEFAULT_SLOWEST_ROWS, open_rows=DEFAULT_OPEN_ROWS):
+        self.buckets = buckets
+        self.slowest_rows = slowest_rows
+        self.open_rows = open_rows
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # image_id -> {stage: seconds}, least recently timed first
+        self.spans = {}
+        # Min-heap of (total seconds, sequence, image_id, stages) holding the slowest rows no longer open
+        self.slowest = []
+        self.sequence = 0
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    def add_gauge(self, name, delta, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'counts': [0] * len(self.buckets), 'count': 0, 'sum': 0.0, 'max': 0.0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['counts'][i] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+
+    def record_span(self, image_id, stage, seconds):
+        with self.lock:
+            image_id = str(image_id)
+            # Re-inserting keeps self.spans ordered by when each row was last timed
+            stages = self.spans.pop(image_id, {})
+            stages[stage] = stages.get(stage, 0.0) + seconds
+            self.spans[image_id] = stages
+            if len(self.spans) > self.open_rows:
+                oldest = next(iter(self.spans))
+                self._rank_row(oldest, self.spans.pop(oldest))
+
+    def _rank_row(self, image_id, stages):
+        self.sequence += 1
+        entry = (sum(stages.values()), self.sequence, image_id, stages)
+        if len(self.slowest) < self.slowest_rows:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+    def render_prometheus(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for bound, count in zip(self.buckets, histogram['counts']):
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, slowest_rows=None):
+        """Return a JSON-serialisable summary, including the slowest image_ids by total span time.
+
+        p50/p95 are estimated from the histogram buckets. At most the registry's slowest_rows
+        rows are reported.
+        """
+        def series(name, labels):
+            return name + _format_labels(labels)
+
+        with self.lock:
+            histograms = {}
+            for (name, labels), histogram in self.histograms.items():
+                histograms[series(name, labels)] = {
+                    'count': histogram['count'],
+                    'sum_s': histogram['sum'],
+                    'p50_s': _bucket_quantile(self.buckets, histogram, 0.50),
+                    'p95_s': _bucket_quantile(self.buckets, histogram, 0.95),
+                    'max_s': histogram['max']
+                }
+            ranked = [(image_id, stages) for _, _, image_id, stages in self.slowest] + list(self.spans.items())
+            ranked.sort(key=lambda item: sum(item[1].values()), reverse=True)
+            slowest = ranked[:min(slowest_rows or self.slowest_rows, self.slowest_rows)]
+            return {
+                'counters': {series(name, labels): value for (name, labels), value in self.counters.items()},
+                'gauges': {series(name, labels): value for (name, labels), value in self.gauges.items()},
+                'histograms': histograms,
+                'slowest_rows': [{'image_id': image_id, 'total_s': sum(stages.values()), 'stages': stages}
+                                 for image_id, stages in slowest]
+            }
+
+_registry = MetricsRegistry()
+
+def get_registry():
+    return _registry
+
+def set_registry(registry):
+    """Swap the active registry, e.g. for one that forwards to another metrics backend."""
+    global _registry
+    _registry = registry
+
+def inc(name, value=1, **labels):
+    _registry.inc(name, value, **labels)
+
+def set_gauge(name, value, **labels):
+    _registry.set_gauge(name, value, **labels)
+
+def observe(name, seconds, **labels):
+    _registry.observe(name, seconds, **labels)
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the duration of the with-block in the named histogram."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _registry.observe(name, time.perf_counter() - start, **labels)
+
+@contextmanager
+def in_flight(name, **labels):
+    """Track how many with-blocks are currently running in the named gauge."""
+    _registry.add_gauge(name, 1, **labels)
+    try:
+        yield
+    finally:
+        _registry.add_gauge(name, -1, **labels)
+
+@contextmanager
+def span(image_id, stage):
+    """Attribute the duration of the with-block to image_id, so slow rows can be found."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _registry.record_span(image_id, stage, time.perf_counter() - start)
+
+def start_metrics_server(config):
+    """Serve /metrics in the Prometheus text format if `metrics.prometheus_port` is set.
+
+    Also sizes the active registry's slowest-rows heap from `metrics.slowest_rows`.
+    """
+    _registry.slowest_rows = int(config.get('metrics', {}).get('slowest_rows', DEFAULT_SLOWEST_ROWS))
+    port = config.get('metrics', {}).get('prometheus_port')
+    if not port:
+        return None
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _PrometheusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = get_registry().render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', int(port)), _PrometheusHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving Prometheus metrics on port {port}")
+    return server
+
+def write_summary(config):
+    """Write the end-of-run JSON summary to `metrics.json_summary` and log the slowest rows."""
+    settings = config.get('metrics', {})
+    summary = get_registry().summary(int(settings.get('slowest_rows', DEFAULT_SLOWEST_ROWS)))
+    path = settings.get('json_summary')
+    if path:
+        with open(path, 'w') as file:
+            json.dump(summary, file, indent=2)
+        logging.info(f"Metrics summary written to {path}")
+    for row in summary['slowest_rows'][:3]:
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in row['stages'].items())
+        logging.info(f"Slow row {row['image_id']}: {row['total_s']:.2f}s ({stages})")
+    return summary
@@ -0,0 +1,373 @@
+import logging
+import os
+import math
+import queue
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dotenv import load_dotenv
+import metrics
+from config import SETTINGS
+from generate_descriptions import (load_batch_prompt, load_gpt_prompts, enhance_batch, enhance_row, get_description_batch_size,
+                                   get_description_concurrency, group_units)
+from generate_images import generate_and_save, get_image_concurrency, variant_jobs
+from rate_limiter import build_concurrency_limiter, build_limiter
+from progress_journal import ProgressJournal, journal_path_for, load_journal
+from manifest_store import MANIFEST_COLUMNS, InOrderWriter, enhanced_columns, image_columns, open_manifest
+from ingest import iter_csv_rows, source_exists
+from dedup import build_variant_indexes, get_dedup_settings, reuse_image
+from variants import get_variants, image_files, variant_row
+from postprocess import get_postprocess_settings, load_derivatives, pending_files, process_image, record_result
+from response_cache import get_response_cache
+from dead_letters import get_dead_letter_store
+from scheduler import get_budget, get_scheduler_settings, prioritized, row_priority
+from sync_to_s3 import get_transfer_config, needs_upload, open_sync_state, save_sync_state, upload_file
+from bundles import get_bundle_settings, open_bundle_writer, upload_shard
+from validate_artifacts import is_valid_image
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Load environment variables
+load_dotenv()
+
+# Defaults, overridden by the `concurrency` section of the config
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_UPLOAD_WORKERS = 8
+
+# Marks the end of a stage's input; one is queued per worker
+_DONE = object()
+
+class Stage:
+    """A pool of worker threads reading from a bounded queue and feeding the next stage.
+
+    A full input queue blocks the previous stage's put(), which is what gives the
+    pipeline backpressure: a slow stage throttles everything upstream of it. Items that
+    leave the pipeline here (the last stage, a handler returning None or raising) are
+    passed to on_exit. A stage fed lists of items passes on the list its handler returns,
+    one item at a time, and hands the rest of the input list to on_exit. With an order
+    key, queued items are handled lowest key first instead of first in, first out.
+    """
+
+    def __init__(self, name, handler, workers, queue_size, next_stage=None, on_exit=None, order=None):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.next_stage = next_stage
+        self.on_exit = on_exit
+        self.order = order
+        self.sequence = itertools.count()
+        self.input = queue.PriorityQueue(maxsize=queue_size) if order is not None else queue.Queue(maxsize=queue_size)
+        self.remaining = workers
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item):
+        if self.order is not None:
+            # The sequence number keeps equal keys first in, first out and items from being compared
+            item = (self.order(item), next(self.sequence), item)
+        self.input.put(item)
+
+    def close(self):
+        for _ in range(self.workers):
+            self.input.put(_DONE if self.order is None else (math.inf, next(self.sequence), _DONE))
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self.input.get()
+            if self.order is not None:
+                item = item[2]
+            if item is _DONE:
+                break
+            items = item if isinstance(item, list) else [item]
+            try:
+                result = self.handler(item)
+            except Exception as e:
+                image_ids = ', '.join(str(entry.get('image_id')) for entry in items)
+                logging.error(f"Exception in {self.name} stage for image_id {image_ids}: {e}")
+                result = None
+            if self.next_stage is None or result is None:
+                passed, exits = [], items
+            elif isinstance(item, list):
+                passed = result
+                exits = [entry for entry in items if not any(entry is kept for kept in passed)]
+            else:
+                passed, exits = [result], []
+            for entry in passed:
+                self.next_stage.put(entry)
+                metrics.set_gauge('pipeline_queue_depth', self.next_stage.input.qsize(), stage=self.next_stage.name)
+            if self.on_exit is not None:
+                for entry in exits:
+                    self.on_exit(entry)
+
+        # The last worker out closes the next stage
+        with self.lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+        if last and self.next_stage is not None:
+            self.next_stage.close()
+
+def read_input_rows(input_csv, config=None):
+    """Yield normalised rows from the input CSV (local path or s3:// URL) in file order, as it is read.
+
+    With the scheduler enabled rows also carry the input's priority column.
+    """
+    scheduler_settings = get_scheduler_settings(config)
+    for index, row in enumerate(iter_csv_rows(input_csv, config)):
+        normalised = {
+            'index': index,
+            'image_id': row['image_id'].strip(),
+            'context': row['context'].strip().replace(' ', '_'),
+            'original_description': row['description'].strip().strip('"'),
+            'enhanced_description': None
+        }
+        if scheduler_settings is not None:
+            normalised['priority'] = (row.get(scheduler_settings['priority_column']) or '').strip() or None
+        yield normalised
+
+def export_manifest(manifest, columns, csv_path):
+    """Export the whole manifest to csv_path and close it."""
+    manifest.export_csv(csv_path, columns)
+    manifest.close()
+    logging.info(f"Updated CSV saved to {csv_path}")
+
+def run_streaming_pipeline(input_csv, enhanced_csv, images_csv, bucket_name, s3_directory, config, refresh=False):
+    """Stream each input row through enhancement, generation, post-processing, validation and upload.
+
+    Stages overlap instead of running as barriers, so a batch takes roughly as long as
+    its slowest stage rather than the sum of all of them. Uploads are checked against
+    and recorded in the same sync index as sync_to_s3(); refresh rebuilds it first.
+    """
+    if not source_exists(input_csv):
+        logging.error(f"Input file {input_csv} not found.")
+        return False
+    
+    output_dir = SETTINGS.config['output']['directory']
+    os.makedirs(output_dir, exist_ok=True)
+    settings = config.get('concurrency', {})
+    queue_size = int(settings.get('queue_size', DEFAULT_QUEUE_SIZE))
+    upload_workers = max(1, int(settings.get('uploads', {}).get('workers', DEFAULT_UPLOAD_WORKERS)))
+    describe_workers, limiters, max_retries = get_description_concurrency(config)
+    image_workers, requests_per_minute = get_image_concurrency(config)
+    image_limiter = build_limiter(requests_per_minute)
+    image_concurrency_limiter = build_concurrency_limiter('images', config, image_workers)
+    postprocess_settings = get_postprocess_settings(config)
+    dedup_settings = get_dedup_settings(config)
+    gpt_prompts = load_gpt_prompts()
+    batch_size = get_description_batch_size(config)
+    batch_prompt = load_batch_prompt() if batch_size > 1 else None
+    cache = get_response_cache(config)
+    dead_letters = get_dead_letter_store(config)
+    budget = get_budget(config)
+    scheduler_settings = get_scheduler_settings(config)
+    
+    # Resume state: finished CSVs plus anything journaled by a crashed run
+    existing_enhanced = open_manifest(enhanced_csv, config)
+    existing_enhanced.upsert_many(load_journal(journal_path_for(enhanced_csv)).values())
+    existing_images = open_manifest(images_csv, config)
+    existing_images.upsert_many(load_journal(journal_path_for(images_csv)).values())
+    bundle_settings = get_bundle_settings(config)
+    sync_state = open_sync_state(bucket_name, s3_directory, config, refresh) if bundle_settings is None else None
+    
+    # Near-duplicate prompts wait for the first similar prompt's image of the same variant and reuse it
+    variants = get_variants(config)
+    dedup_indexes = build_variant_indexes(config, variants, existing_images, output_dir)
+    generated_events = {}
+    reused = []
+    for dedup_index in (dedup_indexes or {}).values():
+        for file_name in dedup_index.keys:
+            generated_events[file_name] = threading.Event()
+            generated_events[file_name].set()
+    
+    enhanced_journal = ProgressJournal(journal_path_for(enhanced_csv))
+    images_journal = ProgressJournal(journal_path_for(images_csv))
+    enhanced_writer = InOrderWriter(existing_enhanced)
+    images_writer = InOrderWriter(existing_images)
+    enhanced_fields = enhanced_columns(config)
+    
+    def finish(row):
+        # Called once per row, by whichever stage it leaves the pipeline at
+        enhanced_writer.add(row['index'], {column: row.get(column) for column in enhanced_fields})
+        image_row = {column: row[column] for column in MANIFEST_COLUMNS if column in row} if row.get('file_name') else None
+        images_writer.add(row['index'], image_row)
+    
+    def with_previous(row):
+        row['enhanced_description'] = existing_enhanced.get_value(row['image_id'], 'enhanced_description')
+        return row
+    
+    def describe(unit):
+        # A unit holds up to batch_size rows still to describe, sent as one request when batching
+        pending = [row for row in unit if not row['enhanced_description']]
+        journal_rows = [{column: row.get(column) for column in enhanced_fields} for row in pending]
+        if pending and batch_size > 1:
+            results = enhance_batch(journal_rows, gpt_prompts, batch_prompt, limiters, max_retries, enhanced_journal, cache,
+                                    dead_letters=dead_letters, budget=budget)
+        else:
+            results = [enhance_row(journal_row, gpt_prompts, limiters, max_retries, enhanced_journal, cache,
+                                   dead_letters=dead_letters, budget=budget) for journal_row in journal_rows]
+        for row, enhanced_description in zip(pending, results):
+            row['enhanced_description'] = enhanced_description
+            if enhanced_description:
+                logging.info(f"Generated new enhanced description for image {row['image_id']}")
+        
+        described = []
+        for row in unit:
+            if row['enhanced_description']:
+                described.append(row)
+            else:
+                logging.warning(f"No enhanced description for {row['image_id']}; skipping image generation")
+        return described
+    
+    def generate_or_reuse(job):
+        if dedup_indexes is None:
+            return generate_and_save(job, output_dir, config, image_limiter, images_journal, image_concurrency_limiter)
+        match = dedup_indexes[job['variant']['key']].match_or_add(job['file_name'], job['enhanced_description'])
+        done = generated_events.setdefault(match or job['file_name'], threading.Event())
+        if match is not None:
+            done.wait()
+            if reuse_image(match, job, output_dir, dedup_settings['link']):
+                images_journal.record(job)
+                reused.append(job['image_id'])
+                if dead_letters is not None:
+                    dead_letters.resolve('generate', job)
+                return True
+            # The original failed, so later duplicates must not wait for it either
+            dedup_indexes[job['variant']['key']].discard(match)
+        try:
+            return generate_and_save(job, output_dir, config, image_limiter, images_journal, image_concurrency_limiter)
+        finally:
+            done.set()
+    
+    def generate(row):
+        image_id = row['image_id']
+        files, jobs = variant_jobs({column: row.get(column) for column in enhanced_fields}, config, variants, output_dir)
+        if not jobs:
+            logging.info(f"Skipping image_id {image_id}: Already generated")
+        # Variants are independent requests, so a row's variants run concurrently in their own pool
+        results = variant_pool.map(generate_or_reuse, jobs) if len(jobs) > 1 else map(generate_or_reuse, jobs)
+        for job, success in zip(jobs, results):
+            if success:
+                files[job['variant']['key']] = job['file_name']
+            elif success is False:
+                logging.warning(f"Failed to generate image for {image_id} ({job['variant']['key']})")
+        
+        updated = variant_row(row, files, variants)
+        if updated is None:
+            return None
+        previous = existing_images.get(image_id)
+        if previous and previous['file_name'] == updated['file_name']:
+            row['derivatives'] = previous['derivatives']
+        row.update(updated)
+        return row
+    
+    def postprocess(job):
+        file_names = pending_files(job, output_dir, postprocess_settings['derivatives'])
+        if not file_names:
+            return job
+        # Every variant of the row is processed, in parallel across the pool
+        with metrics.span(job['image_id'], 'postprocess'):
+            futures = [postprocess_pool.submit(process_image, os.path.abspath(output_dir), file_name, postprocess_settings['derivatives'],
+                                               postprocess_settings['recompress']) for file_name in file_names]
+            results = [future.result() for future in futures]
+        for file_name, result in zip(file_names, results):
+            if not record_result(job, file_name, result):
+                logging.warning(f"Failed to post-process image {file_name} of {job['image_id']}")
+        return job
+    
+    def upload(job):
+        for file_name in image_files(job) + list(load_derivatives(job.get('derivatives')).values()):
+            file_path = os.path.join(output_dir, file_name)
+            s3_key = os.path.join(s3_directory, file_name).replace("\\", "/")
+            entry = None
+            if sync_state is not None and os.path.exists(file_path):
+                upload_needed, entry = needs_upload(file_path, s3_key, sync_state[1])
+                if not upload_needed:
+                    sync_state[1][s3_key] = entry
+                    continue
+            with metrics.span(job['image_id'], 'validate'):
+                valid = is_valid_image(file_path)
+            if not valid:
+                logging.warning(f"Not uploading invalid image file: {file_path}")
+                continue
+            if bundle_writer is not None:
+                with metrics.span(job['image_id'], 'bundle'):
+                    bundle_writer.add(file_name, file_path)
+                continue
+            with metrics.span(job['image_id'], 'upload'):
+                if upload_file(file_path, bucket_name, s3_key, transfer_config):
+                    sync_state[1][s3_key] = dict(entry, etag=None)
+        return None
+    
+    variant_pool = ThreadPoolExecutor(max_workers=image_workers)
+    transfer_config = get_transfer_config(config)
+    bundle_writer = None
+    if bundle_settings is not None:
+        # Sealed bundles are uploaded in the background while later rows are still being generated
+        bundle_uploads = ThreadPoolExecutor(max_workers=1)
+        bundle_writer = open_bundle_writer(config, lambda shard_path, index_path: bundle_uploads.submit(
+            upload_shard, bundle_writer, os.path.basename(shard_path), bucket_name, bundle_settings, transfer_config))
+    upload_stage = Stage("upload", upload, upload_workers, queue_size, on_exit=finish)
+    postprocess_pool = None
+    after_generate = upload_stage
+    if postprocess_settings is not None:
+        # Encoding is CPU-bound: stage threads only hand images to a pool of processes, which
+        # are spawned rather than forked because the other stages' threads are already running
+        postprocess_pool = ProcessPoolExecutor(max_workers=postprocess_settings['workers'],
+                                               mp_context=multiprocessing.get_context('spawn'))
+        after_generate = Stage("postprocess", postprocess, postprocess_settings['workers'], queue_size, upload_stage, finish)
+    # Rows finish describing out of order, so the generate stage takes the most important waiting row first;
+    # the budget stops generation at its first refusal, so this decides which rows get images
+    generate_order = (lambda row: -row_priority(row, scheduler_settings)) if scheduler_settings is not None else None
+    generate_stage = Stage("generate", generate, image_workers, queue_size, after_generate, finish, generate_order)
+    describe_stage = Stage("describe", describe, describe_workers, queue_size, generate_stage, finish)
+    stages = [upload_stage, generate_stage, describe_stage]
+    if postprocess_pool is not None:
+        stages.insert(1, after_generate)
+    for stage in stages:
+        stage.start()
+    
+    logging.info(f"Streaming pipeline started: describe={describe_workers} ({batch_size} per request), generate={image_workers}, "
+                 f"postprocess={postprocess_settings['workers'] if postprocess_pool else 0}, "
+                 f"upload={upload_workers} workers, queue size {queue_size}")
+    # With the scheduler enabled the most important rows go first; they are still written in input order
+    rows = read_input_rows(input_csv, config)
+    if scheduler_settings is not None:
+        rows = prioritized(rows, scheduler_settings)
+    for unit in group_units(map(with_previous, rows), batch_size, queue_size):
+        describe_stage.put(unit)
+    describe_stage.close()
+    upload_stage.join()
+    variant_pool.shutdown()
+    if bundle_writer is not None:
+        bundle_writer.flush()
+        bundle_uploads.shutdown()
+        bundle_writer.close()
+    if postprocess_pool is not None:
+        postprocess_pool.shutdown()
+    if sync_state is not None:
+        save_sync_state(sync_state[0], sync_state[2])
+    
+    # Compact both manifests into their CSVs, then drop the journals
+    enhanced_writer.flush()
+    export_manifest(existing_enhanced, enhanced_fields, enhanced_csv)
+    enhanced_journal.discard()
+    images_writer.flush()
+    export_manifest(existing_images, image_columns(config), images_csv)
+    images_journal.discard()
+    if dedup_indexes is not None:
+        logging.info(f"Near-duplicate detection saved {len(reused)} API calls")
+    
+    if cache is not None:
+        cache.log_stats("pipeline")
+    return True
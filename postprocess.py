@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import metrics
+from manifest_store import image_columns, open_manifest
+from variants import image_files
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Defaults, overridden by the `output.postprocess` section of the config
+DEFAULT_POSTPROCESS_WORKERS = os.cpu_count() or 1
+DEFAULT_DERIVATIVE_QUALITY = 80
+
+# Output formats and the Pillow encoder that writes them
+PILLOW_FORMATS = {'webp': 'WEBP', 'avif': 'AVIF', 'jpeg': 'JPEG', 'jpg': 'JPEG', 'png': 'PNG'}
+LOSSLESS_FORMATS = ('webp', 'png')
+
+def get_postprocess_settings(config):
+    """Return the `output.postprocess` section with defaults filled in, or None when it is disabled."""
+    settings = config.get('output', {}).get('postprocess', {})
+    if not settings.get('enabled'):
+        return None
+
+    from PIL import features
+
+    derivatives = []
+    for spec in settings.get('derivatives') or []:
+        image_format = str(spec.get('format', 'webp')).lower()
+        if image_format not in PILLOW_FORMATS:
+            logging.warning(f"Skipping derivative {spec.get('name')}: unknown format {image_format}")
+            continue
+        if image_format in ('webp', 'avif') and not features.check(image_format):
+            logging.warning(f"Skipping derivative {spec.get('name')}: this Pillow build cannot write {image_format}")
+            continue
+        lossless = bool(spec.get('lossless', False))
+        if lossless and image_format not in LOSSLESS_FORMATS:
+            logging.warning(f"Derivative {spec.get('name')}: {image_format} has no lossless mode, using quality instead")
+            lossless = False
+        derivatives.append({
+            'name': spec.get('name') or image_format,
+            'format': image_format,
+            'width': int(spec.get('width') or 0),
+            'quality': int(spec.get('quality', DEFAULT_DERIVATIVE_QUALITY)),
+            'lossless': lossless
+        })
+
+    workers = int(settings.get('workers') or DEFAULT_POSTPROCESS_WORKERS)
+    return {'workers': max(1, workers), 'recompress': bool(settings.get('recompress', False)), 'derivatives': derivatives}
+
+def derivative_path(file_name, spec):
+    """Path of a derivative relative to the output directory, e.g. thumb/<image>.webp."""
+    return f"{spec['name']}/{os.path.splitext(file_name)[0]}.{spec['format']}"
+
+def load_derivatives(value):
+    """Parse the derivatives column (JSON object of name -> relative path); empty means none."""
+    if not value:
+        return {}
+    try:
+        return json.loads(value)
+    except ValueError:
+        return {}
+
+def derivative_key(row, file_name, name):
+    """Key of a derivative in the derivatives column: its name for file_name, name:file for other variants."""
+    return name if file_name == row['file_name'] else f"{name}:{file_name}"
+
+def derivative_source(row, key):
+    """Image file whose derivative is recorded under key (the inverse of derivative_key)."""
+    return key.split(':', 1)[1] if ':' in key else row['file_name']
+
+def derivative_keys(row, specs):
+    """Keys of every configured derivative of every image file of a row."""
+    return [derivative_key(row, file_name, spec['name']) for file_name in image_files(row) for spec in specs]
+
+def pending_files(row, output_dir, specs):
+    """Image files of a row, among those on disk, whose derivatives are not all recorded, on disk and newer than the image."""
+    recorded = load_derivatives(row.get('derivatives'))
+    pending = []
+    for file_name in image_files(row):
+        source = os.path.join(output_dir, file_name)
+        if not os.path.exists(source):
+            continue
+        if not row.get('derivatives'):
+            pending.append(file_name)
+            continue
+        source_mtime = os.path.getmtime(source)
+        for spec in specs:
+            key = derivative_key(row, file_name, spec['name'])
+            path = os.path.join(output_dir, recorded.get(key, derivative_path(file_name, spec)))
+            if key not in recorded or not os.path.exists(path) or os.path.getmtime(path) < source_mtime:
+                pending.append(file_name)
+                break
+    return pending
+
+def _save_atomically(image, path, pillow_format, **options):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        image.save(tmp_path, pillow_format, **options)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def recompress_losslessly(path):
+    """Re-encode a PNG with maximum compression if that makes it smaller; returns bytes saved.
+
+    The pixels are unchanged, so the original mtime is kept and derivatives made from the
+    image before recompression stay current.
+    """
+    from PIL import Image
+
+    with Image.open(path) as img:
+        if img.format != 'PNG':
+            return 0
+        img.load()
+        stat = os.stat(path)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        img.save(tmp_path, 'PNG', optimize=True)
+    saved = stat.st_size - os.path.getsize(tmp_path)
+    if saved <= 0:
+        os.remove(tmp_path)
+        return 0
+    os.replace(tmp_path, path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return saved
+
+def write_derivative(img, spec, path):
+    """Resize (never upscale) and encode one derivative of an already opened image."""
+    from PIL import Image
+
+    image = img
+    if spec['width'] and img.width > spec['width']:
+        height = max(1, round(img.height * spec['width'] / img.width))
+        image = img.resize((spec['width'], height), Image.Resampling.LANCZOS)
+    pillow_format = PILLOW_FORMATS[spec['format']]
+    if pillow_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    if pillow_format == 'PNG':
+        options = {'optimize': True}
+    elif spec['lossless']:
+        options = {'lossless': True}
+    else:
+        options = {'quality': spec['quality']}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _save_atomically(image, path, pillow_format, **options)
+
+def process_image(output_dir, file_name, specs, recompress):
+    """Recompress one generated image and write its derivatives.
+
+    Runs in a worker process; returns (derivatives, bytes_saved, seconds) where derivatives
+    maps name -> path relative to output_dir, or is None if the image could not be processed.
+    """
+    from PIL import Image
+
+    start = time.perf_counter()
+    source = os.path.join(output_dir, file_name)
+    try:
+        saved = recompress_losslessly(source) if recompress else 0
+        derivatives = {}
+        with Image.open(source) as img:
+            img.load()
+            for spec in specs:
+                relative_path = derivative_path(file_name, spec)
+                write_derivative(img, spec, os.path.join(output_dir, relative_path))
+                derivatives[spec['name']] = relative_path
+        return derivatives, saved, time.perf_counter() - start
+    except Exception as e:
+        logging.error(f"Error post-processing {source}: {e}")
+        return None, 0, time.perf_counter() - start
+
+def record_result(row, file_name, result):
+    """Store the process_image() result for one image file on an images.csv row and report it; returns False on failure."""
+    derivatives, saved, seconds = result
+    metrics.observe('postprocess_seconds', seconds)
+    if derivatives is None:
+        metrics.inc('postprocess_images_total', result='error')
+        return False
+    metrics.inc('postprocess_images_total', result='ok')
+    metrics.inc('postprocess_bytes_saved_total', saved)
+    # Replace what was recorded for this file, keeping the derivatives of the row's other variants
+    recorded = {key: path for key, path in load_derivatives(row.get('derivatives')).items() if derivative_source(row, key) != file_name}
+    for name, path in derivatives.items():
+        recorded[derivative_key(row, file_name, name)] = path
+    row['derivatives'] = json.dumps(recorded, sort_keys=True)
+    return True
+
+def postprocess_images(csv_file, config):
+    """Write the configured derivatives for every image and variant in csv_file that lacks current ones.
+
+    Encoding is CPU-bound, so images are processed in a pool of worker processes. The
+    derivatives are recorded in the `derivatives` column of csv_file.
+    """
+    settings = get_postprocess_settings(config)
+    if settings is None:
+        return True
+    if not os.path.exists(csv_file):
+        logging.error(f"CSV file not found: {csv_file}")
+        return False
+
+    output_dir = config['output']['directory']
+    specs = settings['derivatives']
+    manifest = open_manifest(csv_file, config)
+    # One (row, image file) pair per image to process; a row's variants are processed independently
+    pending = []
+    for row in manifest.rows():
+        if not row['file_name']:
+            continue
+        pending.extend((row, file_name) for file_name in pending_files(row, output_dir, specs))
+
+    start = time.perf_counter()
+    workers = settings['workers']
+    # Workers get an absolute path so they do not depend on the working directory they start in
+    arguments = ([os.path.abspath(output_dir)] * len(pending), [file_name for _, file_name in pending],
+                 [specs] * len(pending), [settings['recompress']] * len(pending))
+    logging.info(f"Post-processing {len(pending)} images into {len(specs)} derivatives with {workers} workers")
+    if workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(process_image, *arguments, chunksize=4))
+    else:
+        results = [process_image(*args) for args in zip(*arguments)]
+
+    failed = 0
+    updated = {}
+    for (row, file_name), result in zip(pending, results):
+        if record_result(row, file_name, result):
+            updated[row['image_id']] = {'image_id': row['image_id'], 'derivatives': row['derivatives']}
+        else:
+            failed += 1
+    manifest.upsert_many(updated.values())
+    manifest.export_csv(csv_file, image_columns(config))
+    manifest.close()
+
+    saved = sum(result[1] for result in results)
+    logging.info(f"Post-processing complete: {len(pending) - failed} images of {len(updated)} rows, {failed} failed, "
+                 f"{saved / (1024 * 1024):.1f} MB saved by recompression, in {time.perf_counter() - start:.2f}s")
+    return failed == 0
+
+if __name__ == "__main__":
+    from config import CONFIG, IMAGES_CSV
+
+    postprocess_images(IMAGES_CSV, CONFIG)
@@ -0,0 +1,80 @@
+import csv
+import json
+import logging
+import os
+import tempfile
+import threading
+
+
+def journal_path_for(csv_path):
+    """Return the journal file that backs the given output CSV."""
+    return f"{csv_path}.journal.jsonl"
+
+def _to_json(value):
+    # numpy scalars (e.g. image_id read by pandas) expose .item() for the native Python value
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+def load_journal(path):
+    """Replay a journal into a dict of image_id -> latest entry, ignoring a torn final line."""
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    
+    with open(path, 'r', encoding='utf-8') as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f"Ignoring unreadable journal line {line_number} in {path}")
+                continue
+            entries[str(entry['image_id'])] = entry
+    
+    if entries:
+        logging.info(f"Recovered {len(entries)} entries from journal {path}")
+    return entries
+
+def atomic_write_rows(rows, columns, path):
+    """Write dict rows to CSV via a temp file and rename; None is written as an empty field."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', suffix='.csv', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=columns, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+class ProgressJournal:
+    """Append-only JSONL journal; every record is fsync'd before record() returns."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def record(self, entry):
+        line = json.dumps(entry, default=_to_json)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def discard(self):
+        """Close and delete the journal once its entries have been compacted into the CSV."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,177 @@
+import logging
+import threading
+import time
+import metrics
+
+
+class TokenBucket:
+    """Thread-safe token bucket that refills continuously at a per-minute rate."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        """Block until `amount` tokens are available, then consume them.
+
+        A request larger than the bucket waits for a full bucket and takes all of its
+        amount, leaving the bucket in debt; later requests wait until the debt is paid
+        back, so the per-minute rate holds however large the requests are.
+        """
+        needed = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.paused_until > now:
+                    wait = self.paused_until - now
+                else:
+                    self._refill()
+                    if self.tokens >= needed:
+                        self.tokens -= amount
+                        return
+                    wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds`, e.g. after a 429 with Retry-After."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def build_limiter(rate_per_minute):
+    """Return a TokenBucket for the given rate, or None when rate limiting is disabled."""
+    if not rate_per_minute:
+        return None
+    return TokenBucket(rate_per_minute)
+
+# Responses that mean the API wants fewer concurrent requests
+THROTTLE_STATUSES = (429, 503)
+
+# Defaults, overridden by the `concurrency.adaptive` section of the config
+DEFAULT_ADAPTIVE_INITIAL_LIMIT = 2
+DEFAULT_ADAPTIVE_MIN_LIMIT = 1
+DEFAULT_ADAPTIVE_DECREASE_FACTOR = 0.5
+DEFAULT_ADAPTIVE_LATENCY_TOLERANCE = 2.0
+
+# The baseline is the lowest smoothed latency seen, rising by BASELINE_DRIFT per round of
+# `limit` responses so that a lasting slowdown of the API is eventually accepted as normal
+LATENCY_SMOOTHING = 0.2
+BASELINE_DRIFT = 0.01
+LATENCY_WARMUP = 10
+
+
+class AdaptiveLimiter:
+    """Concurrency limit that follows API backpressure with AIMD (additive increase, multiplicative decrease).
+
+    Every healthy response adds 1/limit to the limit, i.e. about one more slot per
+    round of requests. A 429/503, or a smoothed latency above `latency_tolerance` times
+    the baseline, multiplies it by `decrease_factor`. Outcomes of requests that started
+    before the last decrease are not counted again, so one burst of throttling shrinks
+    the limit once rather than once per request that was already in flight.
+    """
+
+    def __init__(self, name, maximum, initial=DEFAULT_ADAPTIVE_INITIAL_LIMIT, minimum=DEFAULT_ADAPTIVE_MIN_LIMIT,
+                 decrease_factor=DEFAULT_ADAPTIVE_DECREASE_FACTOR, latency_tolerance=DEFAULT_ADAPTIVE_LATENCY_TOLERANCE):
+        self.name = name
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.samples = 0
+        self.baseline = None
+        self.smoothed = None
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        metrics.set_gauge('concurrency_limit', self.limit, stage=name)
+
+    def acquire(self):
+        """Block until a slot is free; returns the start time to pass to release()."""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started, throttled=False, failed=False):
+        """Free a slot and adapt the limit to how the request went; failed requests only free the slot."""
+        now = time.monotonic()
+        latency = now - started
+        with self.condition:
+            self.in_flight -= 1
+            if failed and not throttled:
+                self.condition.notify_all()
+                return
+            reason = 'throttled' if throttled else None
+            if not throttled:
+                self.samples += 1
+                self.smoothed = latency if self.smoothed is None else self.smoothed + LATENCY_SMOOTHING * (latency - self.smoothed)
+                if self.samples >= LATENCY_WARMUP:
+                    self.baseline = self.smoothed if self.baseline is None else min(self.smoothed, self.baseline * (1 + BASELINE_DRIFT / self.limit))
+                if self.latency_tolerance and self.baseline and self.smoothed > self.latency_tolerance * self.baseline:
+                    reason = 'latency'
+            
+            if reason is None:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif started >= self.last_decrease:
+                self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                self.last_decrease = now
+                self.smoothed = None
+                metrics.inc('concurrency_backoffs_total', stage=self.name, reason=reason)
+                logging.info(f"Backing off {self.name} concurrency to {int(self.limit)} ({reason})")
+            metrics.set_gauge('concurrency_limit', self.limit, stage=self.name)
+            self.condition.notify_all()
+
+
+class _Slot:
+    """Context manager holding one slot of an AdaptiveLimiter (or nothing, for None).
+
+    Set `throttled` inside the block when the response was a 429/503; exceptions that
+    carry such a status_code (e.g. openai.RateLimitError) count as throttled too, and
+    any other exception leaves the limit as it is.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.throttled = False
+
+    def __enter__(self):
+        if self.limiter is not None:
+            self.started = self.limiter.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.limiter is not None:
+            throttled = self.throttled or getattr(exc, 'status_code', None) in THROTTLE_STATUSES
+            self.limiter.release(self.started, throttled, failed=exc is not None)
+        return False
+
+
+def concurrency_slot(limiter):
+    """Hold a slot of `limiter` for the duration of a request; a no-op when limiter is None."""
+    return _Slot(limiter)
+
+
+def build_concurrency_limiter(name, config, maximum):
+    """Return an AdaptiveLimiter capped at `maximum` if `concurrency.adaptive.enabled`, otherwise None."""
+    settings = config.get('concurrency', {}).get('adaptive', {})
+    if not settings.get('enabled'):
+        return None
+    return AdaptiveLimiter(
+        name,
+        maximum,
+        initial=int(settings.get('initial_limit', DEFAULT_ADAPTIVE_INITIAL_LIMIT)),
+        minimum=int(settings.get('min_limit', DEFAULT_ADAPTIVE_MIN_LIMIT)),
+        decrease_factor=float(settings.get('decrease_factor', DEFAULT_ADAPTIVE_DECREASE_FACTOR)),
+        latency_tolerance=float(settings.get('latency_tolerance', DEFAULT_ADAPTIVE_LATENCY_TOLERANCE))
+    )
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import metrics
+
+DEFAULT_CACHE_DIRECTORY = ".cache/responses"
+DEFAULT_CACHE_MAX_SIZE_MB = 2048
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def make_cache_key(request):
+    """Hash the full request (any JSON-serialisable dict) into a content address."""
+    canonical = json.dumps(request, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """Content-addressed on-disk cache with least-recently-used eviction under a size bound.
+
+    Payloads are stored as files under `directory`; a SQLite index tracks their size and
+    last access time so eviction does not need to walk the directory.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, accessed REAL)")
+        self.db.commit()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Return the cached bytes for key, or None on a miss."""
+        path = self._path(key)
+        with self.lock:
+            row = self.db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None or not os.path.exists(path):
+                self.misses += 1
+                metrics.inc('cache_requests_total', result='miss')
+                return None
+            self.db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+            self.hits += 1
+        metrics.inc('cache_requests_total', result='hit')
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def put(self, key, data):
+        """Store bytes under key, evicting least recently used entries beyond the size bound."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        self._index(key, len(data))
+
+    def put_file(self, key, source_path):
+        """Store the contents of a file under key without reading it into memory."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, path)
+        self._index(key, os.path.getsize(path))
+
+    def _index(self, key, size):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO entries (key, size, accessed) VALUES (?, ?, ?)",
+                            (key, size, time.time()))
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            path = self._path(key)
+            if os.path.exists(path):
+                os.remove(path)
+            total -= size
+            self.evictions += 1
+            metrics.inc('cache_evictions_total')
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def log_stats(self, stage):
+        logging.info(f"Response cache ({stage}): {self.hits} hits, {self.misses} misses, {self.evictions} evictions")
+
+def get_response_cache(config):
+    """Return the process-wide response cache, or None when caching is disabled in the config."""
+    global _shared_cache
+    settings = config.get('cache', {})
+    if not settings.get('enabled', False):
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            directory = settings.get('directory', DEFAULT_CACHE_DIRECTORY)
+            max_bytes = int(settings.get('max_size_mb', DEFAULT_CACHE_MAX_SIZE_MB) * 1024 * 1024)
+            _shared_cache = ResponseCache(directory, max_bytes)
+        return _shared_cache
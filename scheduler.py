@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import heapq
+import logging
+import tempfile
+import threading
+import contextlib
+import metrics
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Defaults, overridden by the `scheduler` section of the config
+DEFAULT_PRIORITY_COLUMN = "priority"
+DEFAULT_LOOKAHEAD = 10000
+DEFAULT_CREDITS_PER_IMAGE = 4
+DEFAULT_DEGRADE_BELOW = 0.2
+DEFAULT_HISTORY_PATH = ".cache/cost_history.json"
+
+# Per-call estimates used until calls of that kind have been observed: tokens per
+# description and seconds per request
+INITIAL_DESCRIBE_TOKENS = 600
+INITIAL_SECONDS = {'describe': 3.0, 'generate': 8.0}
+
+# Weight of each new call in the moving averages of cost and latency
+SMOOTHING = 0.1
+
+# Why a call was not started, recorded as the error class of a deferred row
+BUDGET_EXHAUSTED = "BudgetExhausted"
+DEADLINE_REACHED = "DeadlineReached"
+DEGRADED = "Degraded"
+
+class Deferred(Exception):
+    """Raised instead of making an API call the budget or deadline does not allow."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+_shared_budget = None
+_shared_budget_lock = threading.Lock()
+
+def get_scheduler_settings(config):
+    """Return the `scheduler` section with defaults filled in, or None when scheduling is disabled."""
+    settings = (config or {}).get('scheduler', {})
+    if not settings.get('enabled'):
+        return None
+    return {
+        'priority_column': settings.get('priority_column', DEFAULT_PRIORITY_COLUMN),
+        'context_priorities': {str(context).strip().replace(' ', '_'): float(priority)
+                               for context, priority in (settings.get('context_priorities') or {}).items()},
+        'lookahead': max(0, int(settings.get('lookahead', DEFAULT_LOOKAHEAD))),
+        'max_tokens': int(settings.get('max_tokens') or 0),
+        'max_credits': float(settings.get('max_credits') or 0),
+        'credits_per_image': float(settings.get('credits_per_image', DEFAULT_CREDITS_PER_IMAGE)),
+        'deadline': float(settings.get('deadline_minutes') or 0) * 60,
+        'degrade_below': float(settings.get('degrade_below', DEFAULT_DEGRADE_BELOW)),
+        'history': settings.get('history', DEFAULT_HISTORY_PATH)
+    }
+
+def row_priority(row, settings):
+    """Priority of a row, higher first: its priority if set, else its context's priority, else 0.
+
+    Rows carry the input's priority_column as 'priority', as does enhanced_descriptions.csv.
+    """
+    value = row.get('priority')
+    if value not in (None, ''):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            logging.warning(f"Ignoring non-numeric priority {value!r} of image {row.get('image_id')}")
+    return settings['context_priorities'].get(row.get('context'), 0.0)
+
+def prioritized(rows, settings):
+    """Yield rows highest priority first, sorting lookahead rows at a time (0 sorts the whole input).
+
+    Rows of equal priority keep their input order. Sorting in blocks keeps memory, and
+    how far any row moves from its input position, bounded by lookahead.
+    """
+    lookahead = settings['lookahead']
+    block = []
+    for position, row in enumerate(rows):
+        block.append((-row_priority(row, settings), position, row))
+        if lookahead and len(block) >= lookahead:
+            heapq.heapify(block)
+            while block:
+                yield heapq.heappop(block)[2]
+    heapq.heapify(block)
+    while block:
+        yield heapq.heappop(block)[2]
+
+class CostModel:
+    """Moving averages of the cost and latency of one call, per operation, kept between runs.
+
+    Costs are tokens per description for `describe` and credits per image for `generate`.
+    """
+
+    def __init__(self, path, initial):
+        self.path = path
+        self.lock = threading.Lock()
+        self.estimates = {operation: dict(estimate) for operation, estimate in initial.items()}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as file:
+                    for operation, estimate in json.load(file).items():
+                        self.estimates.setdefault(operation, {}).update(estimate)
+            except (OSError, ValueError, AttributeError) as e:
+                logging.warning(f"Ignoring unreadable cost history {path}: {e}")
+
+    def estimate(self, operation):
+        """(cost, seconds) expected for one call."""
+        with self.lock:
+            estimate = self.estimates[operation]
+            return estimate['cost'], estimate['seconds']
+
+    def observe(self, operation, cost, seconds):
+        with self.lock:
+            estimate = self.estimates[operation]
+            estimate['cost'] += SMOOTHING * (cost - estimate['cost'])
+            estimate['seconds'] += SMOOTHING * (seconds - estimate['seconds'])
+            estimate['calls'] = estimate.get('calls', 0) + 1
+
+    def save(self):
+        with self.lock:
+            estimates = json.dumps(self.estimates, indent=1)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w') as file:
+            file.write(estimates)
+        os.replace(tmp_path, self.path)
+
+class Budget:
+    """Token and credit budgets and a wall-clock deadline shared by every API call of a run.
+
+    A call is only started if its estimated cost fits in what is left of its budget,
+    after what calls in flight are expected to spend, and its estimated latency ends
+    before the deadline. Once a call is refused, no more calls of that operation start,
+    so work is never done out of priority order. Optional calls (the extra variants of a
+    row) are refused earlier, once less than degrade_below of the budget or time is left.
+    """
+
+    def __init__(self, settings, model):
+        self.model = model
+        self.limits = {'describe': settings['max_tokens'], 'generate': settings['max_credits']}
+        self.credits_per_image = settings['credits_per_image']
+        self.degrade_below = settings['degrade_below']
+        self.started = time.time()
+        self.duration = settings['deadline']
+        self.deadline = self.started + self.duration if self.duration else None
+        self.lock = threading.Lock()
+        self.spent = {operation: 0 for operation in self.limits}
+        self.reserved = {operation: 0 for operation in self.limits}
+        self.stopped = {}
+        self.degraded = False
+        self.refused = {operation: 0 for operation in self.limits}
+
+    def _refuse(self, operation, cost, seconds):
+        """Reason calls of operation costing cost may not start, or None; called with the lock held."""
+        if operation in self.stopped:
+            return self.stopped[operation]
+        limit = self.limits[operation]
+        if limit and self.spent[operation] + self.reserved[operation] + cost > limit:
+            reason = BUDGET_EXHAUSTED
+        elif self.deadline is not None and time.time() + seconds > self.deadline:
+            reason = DEADLINE_REACHED
+        else:
+            return None
+        self.stopped[operation] = reason
+        logging.warning(f"Not starting any more {operation} calls: {reason} "
+                        f"(spent {self.spent[operation]:.0f} of {limit or 'unlimited'}, {time.time() - self.started:.0f}s elapsed)")
+        return reason
+
+    def _low(self, operation):
+        limit = self.limits[operation]
+        if limit and (limit - self.spent[operation] - self.reserved[operation]) < self.degrade_below * limit:
+            return True
+        return self.deadline is not None and self.deadline - time.time() < self.degrade_below * self.duration
+
+    @contextlib.contextmanager
+    def reserve(self, operation, calls=1, optional=False):
+        """Context around calls of operation; yields None if they may run, otherwise why not."""
+        cost, seconds = self.model.estimate(operation)
+        cost *= calls
+        with self.lock:
+            refusal = self._refuse(operation, cost, seconds)
+            if refusal is None and optional and self._low(operation):
+                refusal = DEGRADED
+                if not self.degraded:
+                    self.degraded = True
+                    logging.warning("Budget or time running low; generating only the first variant of each row from now on")
+            if refusal is None:
+                self.reserved[operation] += cost
+            else:
+                self.refused[operation] += calls
+        if refusal is not None:
+            metrics.inc('budget_refused_total', calls, operation=operation, reason=refusal)
+        try:
+            yield refusal
+        finally:
+            if refusal is None:
+                with self.lock:
+                    self.reserved[operation] -= cost
+
+    def charge(self, operation, cost, seconds, calls=1):
+        """Record what calls (one request) of operation really cost and how long the request took."""
+        with self.lock:
+            self.spent[operation] += cost
+            spent = self.spent[operation]
+        self.model.observe(operation, cost / calls, seconds)
+        metrics.set_gauge('budget_spent', spent, operation=operation)
+
+    def exhausted(self):
+        """True once the budget or deadline has refused any call, including optional ones."""
+        with self.lock:
+            return any(self.refused.values())
+
+    def log_summary(self):
+        with self.lock:
+            for operation, limit in self.limits.items():
+                cost, seconds = self.model.estimates[operation]['cost'], self.model.estimates[operation]['seconds']
+                logging.info(f"Budget ({operation}): spent {self.spent[operation]:.0f} of {limit or 'unlimited'}, "
+                             f"{self.refused[operation]} calls not started; estimated {cost:.1f} per call, {seconds:.2f}s latency")
+
+def reserve(budget, operation, calls=1, optional=False):
+    """budget.reserve(), or a context that always allows the calls when there is no budget."""
+    if budget is None:
+        return contextlib.nullcontext(None)
+    return budget.reserve(operation, calls, optional)
+
+def get_budget(config):
+    """Return the process-wide budget, or None when the scheduler is disabled in the config.
+
+    The deadline counts from the first call, so call this when the run starts.
+    """
+    global _shared_budget
+    settings = get_scheduler_settings(config)
+    if settings is None:
+        return None
+    with _shared_budget_lock:
+        if _shared_budget is None:
+            model = CostModel(settings['history'], {
+                'describe': {'cost': INITIAL_DESCRIBE_TOKENS, 'seconds': INITIAL_SECONDS['describe']},
+                'generate': {'cost': settings['credits_per_image'], 'seconds': INITIAL_SECONDS['generate']}
+            })
+            _shared_budget = Budget(settings, model)
+        return _shared_budget
+
+def close_budget():
+    """Log what the run spent and save the observed costs for the next run's estimates."""
+    with _shared_budget_lock:
+        budget = _shared_budget
+    if budget is None:
+        return
+    budget.log_summary()
+    budget.model.save()
@@ -0,0 +1,361 @@
+import csv
+import glob
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+from generate_descriptions import process_csv as generate_descriptions
+from generate_images import process_descriptions as generate_images
+from manifest_store import DEFAULT_MANIFEST_DIRECTORY, IMAGE_COLUMNS, MANIFEST_COLUMNS, enhanced_columns, manifest_path_for, open_manifest
+from ingest import iter_csv_rows, open_csv_source, parse_s3_url, source_signature
+from progress_journal import atomic_write_rows
+from postprocess import postprocess_images
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Load environment variables
+load_dotenv()
+
+DEFAULT_LEASE_BATCH = 50
+DEFAULT_LEASE_TTL = 600
+DEFAULT_LEASE_MAX_ATTEMPTS = 3
+DEFAULT_RELEASE_BACKOFF = 30
+
+# Input rows written to the lease database per transaction while seeding
+SEED_BATCH = 10000
+
+def shard_of(image_id, shard_count):
+    """Map an image_id to a shard with a hash that is stable across processes and machines."""
+    digest = hashlib.sha256(str(image_id).strip().encode('utf-8')).hexdigest()
+    return int(digest[:16], 16) % shard_count
+
+def parse_shard(value):
+    """Parse an 'i/N' shard spec into (i, N)."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{value}', expected i/N")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{value}', index must be in [0, {count})")
+    return index, count
+
+def partial_path(csv_path, tag):
+    """Return the per-shard/per-worker variant of an output CSV, e.g. images.shard-0-of-4.csv."""
+    root, ext = os.path.splitext(csv_path)
+    return f"{root}.{tag}{ext}"
+
+def local_partial_path(input_source, tag):
+    """Local per-shard/per-worker input subset, also for an input read straight from S3."""
+    location = parse_s3_url(input_source)
+    return partial_path(os.path.basename(location[1]) if location else input_source, tag)
+
+def write_input_subset(input_csv, output_csv, keep, config=None):
+    """Copy the input CSV rows whose image_id satisfies keep(image_id); return how many were kept."""
+    kept = 0
+    with open_csv_source(input_csv, config) as infile, open(output_csv, 'w', newline='') as outfile:
+        reader = csv.DictReader(infile)
+        writer = csv.DictWriter(outfile, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        for row in reader:
+            if keep(row['image_id'].strip()):
+                writer.writerow(row)
+                kept += 1
+    return kept
+
+def run_stages(input_csv, enhanced_csv, images_csv, config):
+    """Run the describe and generate stages over one slice of the input."""
+    if not generate_descriptions(input_csv, enhanced_csv, config):
+        logging.error("Failed to generate enhanced descriptions")
+        return False
+    generate_images(enhanced_csv, images_csv, config)
+    postprocess_images(images_csv, config)
+    return True
+
+def run_shard(input_csv, enhanced_csv, images_csv, shard_index, shard_count, config):
+    """Process the slice of the input that hashes to shard_index, writing partial output CSVs."""
+    tag = f"shard-{shard_index}-of-{shard_count}"
+    shard_input = local_partial_path(input_csv, tag)
+    kept = write_input_subset(input_csv, shard_input, lambda image_id: shard_of(image_id, shard_count) == shard_index, config)
+    logging.info(f"Shard {shard_index}/{shard_count}: {kept} rows")
+    return run_stages(shard_input, partial_path(enhanced_csv, tag), partial_path(images_csv, tag), config)
+
+def merge_csvs(paths, csv_path, config=None):
+    """Upsert the rows of every CSV in paths, in order, into csv_path; return its row count.
+
+    Later files win for an image_id present in several of them.
+    """
+    manifest = open_manifest(csv_path, config)
+    columns = None
+    for path in paths:
+        with open(path, 'r', newline='', encoding='utf-8') as file:
+            reader = csv.DictReader(file)
+            columns = columns or [column for column in MANIFEST_COLUMNS if column in (reader.fieldnames or [])]
+            manifest.upsert_many(reader)
+    manifest.export_csv(csv_path, columns or IMAGE_COLUMNS)
+    merged_count = len(manifest)
+    manifest.close()
+    return merged_count
+
+def merge_partials(csv_path, config=None):
+    """Combine every partial output (csv_path with a shard/worker/batch tag) into csv_path."""
+    root, ext = os.path.splitext(csv_path)
+    partials = sorted(glob.glob(f"{glob.escape(root)}.*{ext}"))
+    if not partials:
+        logging.error(f"No partial files found for {csv_path}")
+        return False
+    
+    merged_count = merge_csvs(partials, csv_path, config)
+    logging.info(f"Merged {len(partials)} partial files into {csv_path} ({merged_count} rows)")
+    return True
+
+class LeaseStore:
+    """Row leases in a SQLite database shared by all workers (a local stand-in for a queue).
+
+    The input rows are copied into the database once, so a batch is built from its
+    claimed rows without reading the input again. A worker claims a batch of unfinished
+    rows, in input order, for `ttl` seconds. If it crashes, the leases expire and the
+    rows become claimable by any other worker. A released row is not claimable again for
+    `backoff` seconds, doubling with each attempt, and other workers get it before the
+    worker that released it; its enhanced description is kept so it is not described
+    again. Rows are given up on after `max_attempts` claims so a permanently failing row
+    cannot loop forever.
+    """
+
+    def __init__(self, path, max_attempts=DEFAULT_LEASE_MAX_ATTEMPTS, backoff=DEFAULT_RELEASE_BACKOFF):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS leases (
+            image_id TEXT PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0,
+            not_before REAL NOT NULL DEFAULT 0,
+            released_by TEXT,
+            position INTEGER,
+            row TEXT,
+            enhanced TEXT
+        )""")
+        existing = {row[1] for row in self.db.execute("PRAGMA table_info(leases)")}
+        for column, definition in (('not_before', "REAL NOT NULL DEFAULT 0"), ('released_by', "TEXT"),
+                                   ('position', "INTEGER"), ('row', "TEXT"), ('enhanced', "TEXT")):
+            if column not in existing:
+                self.db.execute(f"ALTER TABLE leases ADD COLUMN {column} {definition}")
+        # Claims walk unfinished rows in input order, and look up released rows separately
+        self.db.execute("CREATE INDEX IF NOT EXISTS leases_pending ON leases (done, position)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS leases_released ON leases (released_by)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def seeded(self, signature):
+        """True if the rows of the input with this source_signature() were already seeded."""
+        with self.lock:
+            found = self.db.execute("SELECT value FROM meta WHERE key = 'input_signature'").fetchone()
+        return signature is not None and found is not None and found[0] == signature
+
+    def seed(self, rows, signature=None):
+        """Register input rows (dicts with an image_id) and their payloads, in input order.
+
+        Rows already known keep their lease state, so every worker may call this. Rows are
+        written in transactions of SEED_BATCH so other workers are never blocked for long.
+        """
+        insert = ("INSERT INTO leases (image_id, position, row) VALUES (?, ?, ?) "
+                  "ON CONFLICT(image_id) DO UPDATE SET position = excluded.position, row = excluded.row")
+        batch = []
+        for position, row in enumerate(rows):
+            # A None key holds the extra fields of a malformed line, which no stage reads
+            batch.append((row['image_id'].strip(), position, json.dumps({key: value for key, value in row.items() if key is not None})))
+            if len(batch) >= SEED_BATCH:
+                self._write(insert, batch)
+                batch = []
+        self._write(insert, batch)
+        if signature is not None:
+            self._write("INSERT OR REPLACE INTO meta (key, value) VALUES ('input_signature', ?)", [(signature,)])
+
+    def _write(self, statement, parameters):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany(statement, parameters)
+            self.db.execute("COMMIT")
+
+    def claim(self, owner, limit, ttl):
+        """Atomically lease up to `limit` unfinished rows that are free or whose lease expired.
+
+        Rows released by another worker come first, so a row that failed here is retried
+        elsewhere if possible, then new rows in input order, then rows owner released.
+        """
+        now = time.time()
+        claimable = "done = 0 AND attempts < ? AND (owner IS NULL OR expires_at < ?) AND not_before <= ?"
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            image_ids = []
+            for released, parameters in (("released_by IS NOT NULL AND released_by IS NOT ?", (owner,)),
+                                         ("released_by IS NULL", ()),
+                                         ("released_by IS ?", (owner,))):
+                if len(image_ids) >= limit:
+                    break
+                rows = self.db.execute(
+                    f"SELECT image_id FROM leases WHERE {released} AND {claimable} ORDER BY position LIMIT ?",
+                    (*parameters, self.max_attempts, now, now, limit - len(image_ids))).fetchall()
+                image_ids.extend(row[0] for row in rows)
+            self.db.executemany("UPDATE leases SET owner = ?, expires_at = ?, attempts = attempts + 1 WHERE image_id = ?",
+                                [(owner, now + ttl, image_id) for image_id in image_ids])
+            self.db.execute("COMMIT")
+        return image_ids
+
+    def payloads(self, image_ids):
+        """[(input row, enhanced row or None)] of image_ids, in input order."""
+        image_ids = list(image_ids)
+        found = []
+        with self.lock:
+            for start in range(0, len(image_ids), 500):
+                chunk = image_ids[start:start + 500]
+                found.extend(self.db.execute(
+                    f"SELECT position, row, enhanced FROM leases WHERE image_id IN ({', '.join('?' * len(chunk))})", chunk))
+        return [(json.loads(row), json.loads(enhanced) if enhanced else None) for _, row, enhanced in sorted(found)]
+
+    def record_enhanced(self, rows):
+        """Keep the enhanced rows of claimed rows, so a row that is claimed again is not described again."""
+        with self.lock:
+            self.db.executemany("UPDATE leases SET enhanced = ? WHERE image_id = ?",
+                                [(json.dumps(row), row['image_id']) for row in rows])
+
+    def renew(self, owner, ttl):
+        """Extend every active lease held by owner."""
+        with self.lock:
+            self.db.execute("UPDATE leases SET expires_at = ? WHERE owner = ? AND done = 0", (time.time() + ttl, owner))
+
+    def complete(self, owner, image_ids):
+        """Mark rows finished; ignored for rows whose lease has passed to another worker."""
+        with self.lock:
+            self.db.executemany("UPDATE leases SET done = 1 WHERE image_id = ? AND owner = ?",
+                                [(image_id, owner) for image_id in image_ids])
+
+    def release(self, owner, image_ids):
+        """Give failed rows back, claimable again after a backoff that doubles with every attempt."""
+        with self.lock:
+            self.db.executemany("UPDATE leases SET owner = NULL, expires_at = 0, released_by = owner, "
+                                "not_before = ? + ? * (1 << (attempts - 1)) WHERE image_id = ? AND owner = ? AND done = 0",
+                                [(time.time(), self.backoff, image_id, owner) for image_id in image_ids])
+
+    def next_claimable(self):
+        """Earliest time an unfinished, unleased row waiting out its backoff can be claimed, or None."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT MIN(not_before) FROM leases WHERE done = 0 AND attempts < ? AND (owner IS NULL OR expires_at < ?)",
+                (self.max_attempts, time.time())).fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+def run_leased_worker(input_csv, enhanced_csv, images_csv, lease_db, config, worker_id=None):
+    """Claim and process batches of rows until none are left, renewing leases while working.
+
+    Each batch is run on its own input and output CSVs, built from the rows stored in the
+    lease database, so only the claimed rows are processed and the input is read once, by
+    whichever worker seeds it. Enhanced descriptions recorded for a claimed row are reused.
+    The batch outputs are merged into the worker's partial CSVs at the end.
+    """
+    settings = config.get('sharding', {})
+    batch_size = int(settings.get('lease_batch', DEFAULT_LEASE_BATCH))
+    ttl = float(settings.get('lease_ttl', DEFAULT_LEASE_TTL))
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    tag = f"worker-{worker_id}"
+    store = LeaseStore(lease_db, int(settings.get('max_attempts', DEFAULT_LEASE_MAX_ATTEMPTS)),
+                       float(settings.get('release_backoff', DEFAULT_RELEASE_BACKOFF)))
+    signature = source_signature(input_csv)
+    if not store.seeded(signature):
+        store.seed(iter_csv_rows(input_csv, config), signature)
+    
+    # Batch outputs left by an earlier run of this worker are merged too; new batches are numbered after them
+    batch_number = max((int(path.rsplit('.batch-', 1)[1].split('.', 1)[0])
+                        for path in batch_paths(enhanced_csv, tag) + batch_paths(images_csv, tag)), default=0)
+    
+    stop_heartbeat = threading.Event()
+    def heartbeat():
+        while not stop_heartbeat.wait(ttl / 3):
+            store.renew(worker_id, ttl)
+    threading.Thread(target=heartbeat, daemon=True).start()
+    
+    failed = set()
+    try:
+        while True:
+            claimed = store.claim(worker_id, batch_size, ttl)
+            if not claimed:
+                next_claimable = store.next_claimable()
+                if next_claimable is None:
+                    logging.info(f"Worker {worker_id}: no rows left to claim")
+                    break
+                # Released rows are waiting out their backoff
+                time.sleep(max(0, next_claimable - time.time()))
+                continue
+            
+            batch_number += 1
+            batch_tag = f"{tag}.batch-{batch_number:06d}"
+            logging.info(f"Worker {worker_id}: claimed {len(claimed)} rows (batch {batch_number})")
+            claimed_set = set(claimed)
+            batch_input = local_partial_path(input_csv, batch_tag)
+            batch_enhanced = partial_path(enhanced_csv, batch_tag)
+            batch_images = partial_path(images_csv, batch_tag)
+            payloads = store.payloads(claimed)
+            input_rows = [row for row, _ in payloads]
+            atomic_write_rows(input_rows, list(input_rows[0]), batch_input)
+            # Rows described in an earlier claim start out enhanced, so describing them is skipped
+            enhanced_rows = [enhanced for _, enhanced in payloads if enhanced]
+            if enhanced_rows:
+                atomic_write_rows(enhanced_rows, enhanced_columns(config), batch_enhanced)
+            run_stages(batch_input, batch_enhanced, batch_images, config)
+            os.remove(batch_input)
+            
+            if os.path.exists(batch_enhanced):
+                manifest = open_manifest(batch_enhanced, config)
+                described = [manifest.get(image_id) for image_id in claimed_set - {row['image_id'] for row in enhanced_rows}]
+                store.record_enhanced([row for row in described if row and row['enhanced_description']])
+                manifest.close()
+            
+            # Rows with an image are done; the rest go back to the pool
+            finished = set()
+            if os.path.exists(batch_images):
+                manifest = open_manifest(batch_images, config)
+                finished = {image_id for image_id in claimed_set if manifest.get_value(image_id, 'file_name')}
+                manifest.close()
+            store.complete(worker_id, finished)
+            store.release(worker_id, claimed_set - finished)
+            failed = (failed - finished) | (claimed_set - finished)
+            if claimed_set - finished:
+                logging.warning(f"Worker {worker_id}: released {len(claimed_set - finished)} failed rows")
+    finally:
+        stop_heartbeat.set()
+        store.close()
+    
+    merge_batches(enhanced_csv, tag, config)
+    merge_batches(images_csv, tag, config)
+    return not failed
+
+def batch_paths(csv_path, tag):
+    """Per-batch output CSVs of worker `tag`, oldest batch first."""
+    root, ext = os.path.splitext(partial_path(csv_path, f"{tag}.batch-"))
+    return sorted(glob.glob(f"{glob.escape(root)}*{ext}"))
+
+def merge_batches(csv_path, tag, config):
+    """Merge the batch outputs of worker `tag` into its partial CSV, then remove them and their manifests."""
+    batches = batch_paths(csv_path, tag)
+    if not batches:
+        return
+    worker_csv = partial_path(csv_path, tag)
+    merged_count = merge_csvs(batches, worker_csv, config)
+    directory = config.get('manifest', {}).get('directory', DEFAULT_MANIFEST_DIRECTORY)
+    for path in batches:
+        os.remove(path)
+        for manifest_file in glob.glob(glob.escape(manifest_path_for(path, directory)) + "*"):
+            os.remove(manifest_file)
+    logging.info(f"Merged {len(batches)} batches into {worker_csv} ({merged_count} rows)")
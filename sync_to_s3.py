@@ -1,10 +1,17 @@
 import os
+import json
+import hashlib
 import logging
-import boto3
-from botocore.exceptions import ClientError
+import tempfile
+import csv
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-import pandas as pd
+from config import SETTINGS
+from clients import get_s3_client
+from postprocess import load_derivatives
+from variants import image_files
+from bundles import get_bundle_settings, sync_bundles
+import metrics
 
 # Load environment variables
 load_dotenv()
@@ -12,36 +19,127 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Initialize S3 client
-s3 = boto3.client('s3')
+# Defaults, overridden by the `s3` and `concurrency.uploads` sections of the config
+DEFAULT_SYNC_STATE = ".cache/s3_sync_state.json"
+DEFAULT_UPLOAD_WORKERS = 8
+DEFAULT_MULTIPART_THRESHOLD_MB = 8
+DEFAULT_MULTIPART_CHUNKSIZE_MB = 8
+DEFAULT_TRANSFER_CONCURRENCY = 4
 
-def get_s3_file_list(bucket_name, prefix):
-    """Get a list of all files under specified S3 bucket and prefix"""
-    s3_keys = []
+def list_s3_objects(bucket_name, prefix):
+    """Get {key: {'size', 'etag'}} for all objects under specified S3 bucket and prefix"""
+    from botocore.exceptions import ClientError
+
+    objects = {}
     try:
-        paginator = s3.get_paginator('list_objects_v2')
+        paginator = get_s3_client().get_paginator('list_objects_v2')
         for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
             if 'Contents' in page:
                 for obj in page['Contents']:
-                    s3_keys.append(obj['Key'])
+                    objects[obj['Key']] = {'size': obj['Size'], 'etag': obj['ETag'].strip('"')}
     except ClientError as e:
         logging.error(f"Error listing objects in bucket {bucket_name} with prefix {prefix}: {e}")
-    return s3_keys
+    return objects
+
+def get_s3_file_list(bucket_name, prefix):
+    """Get a list of all files under specified S3 bucket and prefix"""
+    return list(list_s3_objects(bucket_name, prefix))
+
+def get_transfer_config(config):
+    """Build boto3's TransferConfig from the `s3.transfer` section of the config."""
+    from boto3.s3.transfer import TransferConfig
+
+    settings = config.get('s3', {}).get('transfer', {})
+    megabyte = 1024 * 1024
+    return TransferConfig(
+        multipart_threshold=int(settings.get('multipart_threshold_mb', DEFAULT_MULTIPART_THRESHOLD_MB) * megabyte),
+        multipart_chunksize=int(settings.get('multipart_chunksize_mb', DEFAULT_MULTIPART_CHUNKSIZE_MB) * megabyte),
+        max_concurrency=int(settings.get('max_concurrency', DEFAULT_TRANSFER_CONCURRENCY))
+    )
+
+def file_md5(file_path, chunk_size=1024 * 1024):
+    """MD5 of a file's contents; equals the S3 ETag for single-part uploads."""
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_sync_state(path):
+    """Load the local sync index: s3_key -> {'size', 'mtime_ns', 'md5', 'etag'}."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable sync state {path}: {e}")
+        return {}
+
+def save_sync_state(state, path):
+    """Write the sync index atomically."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=directory)
+    with os.fdopen(fd, 'w') as file:
+        json.dump(state, file)
+    os.replace(tmp_path, path)
 
-def upload_file(file_path, bucket_name, s3_key):
+def open_sync_state(bucket_name, s3_directory, config, refresh=False):
+    """Load the sync index and return (state, bucket_state, path) for one destination.
+
+    The prefix is only listed when there is no usable index for it, or with refresh=True.
+    Save the whole state with save_sync_state(state, path) once uploads are recorded.
+    """
+    path = config.get('s3', {}).get('sync_state', DEFAULT_SYNC_STATE)
+    state = load_sync_state(path)
+    bucket_state = state.setdefault(f"s3://{bucket_name}/{s3_directory}", {})
+    if refresh or not bucket_state:
+        logging.info(f"Rebuilding sync state from a full listing of s3://{bucket_name}/{s3_directory}")
+        for s3_key, remote in list_s3_objects(bucket_name, s3_directory).items():
+            entry = bucket_state.setdefault(s3_key, {})
+            entry.update(remote)
+            if remote['size'] != entry.get('size'):
+                entry.pop('md5', None)
+    return state, bucket_state, path
+
+def needs_upload(local_path, s3_key, state):
+    """Decide whether a local file differs from what was last synced to s3_key.
+
+    Unchanged size and mtime are trusted without hashing; otherwise the MD5 is compared
+    with the recorded hash, or with the listed ETag when it came from a single-part upload.
+    Returns (upload, entry) where entry is the refreshed state for the file.
+    """
+    stat = os.stat(local_path)
+    entry = state.get(s3_key)
+    if entry and entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+        return False, entry
+    
+    md5 = file_md5(local_path)
+    refreshed = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5': md5, 'etag': entry.get('etag') if entry else None}
+    if entry and (entry.get('md5') == md5 or entry.get('etag') == md5):
+        return False, refreshed
+    return True, refreshed
+
+def upload_file(file_path, bucket_name, s3_key, transfer_config=None):
     """Upload a single file to S3"""
+    from botocore.exceptions import ClientError
+
     try:
-        s3.upload_file(file_path, bucket_name, s3_key)
+        with metrics.in_flight('s3_uploads_in_flight'), metrics.timer('s3_upload_seconds'):
+            get_s3_client().upload_file(file_path, bucket_name, s3_key, Config=transfer_config)
+        metrics.inc('s3_uploads_total', result='ok')
         logging.info(f"Uploaded {file_path} to s3://{bucket_name}/{s3_key}")
         return True
     except ClientError as e:
+        metrics.inc('s3_uploads_total', result='error')
         logging.error(f"Error uploading {file_path} to S3: {e}")
         return False
 
 def validate_file_count(local_directory, csv_file):
-    """Validate that the number of files matches the CSV entries"""
-    df = pd.read_csv(csv_file)
-    expected_count = len(df)
+    """Validate that the number of files matches the CSV entries, their variants and their derivatives"""
+    with open(csv_file, 'r', newline='', encoding='utf-8') as file:
+        expected_count = sum(len(image_files(row)) + len(load_derivatives(row.get('derivatives'))) for row in csv.DictReader(file))
     
     actual_count = sum([len(files) for _, _, files in os.walk(local_directory)])
     
@@ -52,17 +150,29 @@ def validate_file_count(local_directory, csv_file):
     logging.info(f"File count validation passed. {actual_count} files found.")
     return True
 
-def sync_to_s3(local_directory, bucket_name, s3_directory, csv_file):
-    """Sync local directory to S3 bucket"""
+def sync_to_s3(local_directory, bucket_name, s3_directory, csv_file, config=None, refresh=False):
+    """Sync local directory to S3 bucket
+    
+    A local index of what was last uploaded replaces listing the whole prefix on every run;
+    pass refresh=True (or delete the index) to rebuild it from a full listing. With
+    `bundles.enabled` the files are packed into shard archives and those are uploaded instead.
+    """
     if not os.path.exists(local_directory):
         logging.error(f"Local directory not found: {local_directory}")
         return False
 
+    config = config or SETTINGS.config
+    workers = max(1, int(config.get('concurrency', {}).get('uploads', {}).get('workers', DEFAULT_UPLOAD_WORKERS)))
+    transfer_config = get_transfer_config(config)
+    
+    # Bundle mode uploads a few large shard archives instead of one object per file
+    if get_bundle_settings(config) is not None:
+        return sync_bundles(local_directory, bucket_name, csv_file, config, transfer_config, workers)
+    
     if not validate_file_count(local_directory, csv_file):
         return False
 
-    # Get list of files already in S3
-    s3_files = set(get_s3_file_list(bucket_name, s3_directory))
+    state, bucket_state, state_path = open_sync_state(bucket_name, s3_directory, config, refresh)
     
     # Get list of local files
     local_files = []
@@ -73,26 +183,38 @@ def sync_to_s3(local_directory, bucket_name, s3_directory, csv_file):
             s3_key = os.path.join(s3_directory, relative_path).replace("\\", "/")
             local_files.append((local_path, s3_key))
     
-    # Filter out files that already exist in S3
-    files_to_upload = [(local_path, s3_key) for local_path, s3_key in local_files if s3_key not in s3_files]
+    # Filter out files whose content already matches what is in S3
+    files_to_upload = []
+    for local_path, s3_key in local_files:
+        upload, entry = needs_upload(local_path, s3_key, bucket_state)
+        if upload:
+            files_to_upload.append((local_path, s3_key, entry))
+        else:
+            bucket_state[s3_key] = entry
     
     if not files_to_upload:
+        save_sync_state(state, state_path)
         logging.info("No new files to upload.")
         return True
 
+    logging.info(f"Uploading {len(files_to_upload)} new or modified files with {workers} workers")
+
     # Upload files in parallel
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_file = {executor.submit(upload_file, local_path, bucket_name, s3_key): (local_path, s3_key) 
-                          for local_path, s3_key in files_to_upload}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        future_to_file = {executor.submit(upload_file, local_path, bucket_name, s3_key, transfer_config): (local_path, s3_key, entry) 
+                          for local_path, s3_key, entry in files_to_upload}
         for future in as_completed(future_to_file):
-            local_path, s3_key = future_to_file[future]
+            local_path, s3_key, entry = future_to_file[future]
             try:
                 success = future.result()
-                if not success:
+                if success:
+                    bucket_state[s3_key] = dict(entry, etag=None)
+                else:
                     logging.warning(f"Failed to upload {local_path}")
             except Exception as e:
                 logging.error(f"Exception occurred while uploading {local_path}: {e}")
 
+    save_sync_state(state, state_path)
     return True
 
 if __name__ == "__main__":
@@ -104,7 +226,7 @@ if __name__ == "__main__":
     if not bucket_name:
         logging.error("S3_BUCKET_NAME environment variable is not set")
     else:
-        if sync_to_s3(local_directory, bucket_name, s3_directory):
+        if sync_to_s3(local_directory, bucket_name, s3_directory, csv_file):
             logging.info("Sync to S3 completed successfully")
         else:
             logging.error("Sync to S3 failed")
\ No newline at end of file
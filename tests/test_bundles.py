@@ -0,0 +1,62 @@
+import os
+import sys
+import tarfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bundles import BundleReader, BundleWriter
+
+
+def write_images(directory, sizes):
+    """Write one file per size, with bytes that differ from file to file."""
+    contents = {}
+    for number, size in enumerate(sizes):
+        # Names over 100 characters need an extra tar header block before the data
+        file_name = f"{number}_{'x' * (120 if number % 2 else 10)}.png"
+        contents[file_name] = bytes((number + i) % 256 for i in range(size))
+        with open(os.path.join(directory, file_name), 'wb') as file:
+            file.write(contents[file_name])
+    return contents
+
+
+def test_reader_finds_every_file_at_its_recorded_offset(tmp_path):
+    images = tmp_path / 'images'
+    images.mkdir()
+    contents = write_images(images, [0, 1, 511, 512, 513, 3000, 10000, 70000])
+    sealed = []
+    writer = BundleWriter(str(tmp_path / 'bundles'), 16 * 1024, lambda shard_path, index_path: sealed.append(shard_path))
+    for file_name in contents:
+        assert writer.add(file_name, str(images / file_name))
+    writer.close()
+
+    # A small target size spreads the files over several shards
+    assert len(sealed) > 1
+    reader = BundleReader(str(tmp_path / 'bundles'))
+    assert len(reader) == len(contents)
+    for file_name, data in contents.items():
+        assert reader.read(file_name) == data
+    # Shards stay plain tar files
+    with tarfile.open(sealed[0]) as tar:
+        assert tar.getnames()
+
+
+def test_changed_file_is_bundled_again_and_read_from_the_newest_shard(tmp_path):
+    images = tmp_path / 'images'
+    images.mkdir()
+    contents = write_images(images, [100, 200])
+    writer = BundleWriter(str(tmp_path / 'bundles'), 1024 * 1024)
+    for file_name in contents:
+        writer.add(file_name, str(images / file_name))
+    writer.flush()
+
+    first, second = contents
+    assert not writer.add(first, str(images / first))
+    with open(images / second, 'wb') as file:
+        file.write(b'changed')
+    os.utime(images / second, ns=(1, 1))
+    assert writer.add(second, str(images / second))
+    writer.close()
+
+    reader = BundleReader(str(tmp_path / 'bundles'))
+    assert reader.read(first) == contents[first]
+    assert reader.read(second) == b'changed'
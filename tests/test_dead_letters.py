@@ -0,0 +1,55 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import dead_letters
+from dead_letters import DeadLetterStore
+
+
+class FakeClock:
+    """Stands in for the time module so retries fall due without waiting."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def open_store(tmp_path, monkeypatch, **kwargs):
+    clock = FakeClock()
+    monkeypatch.setattr(dead_letters, 'time', clock)
+    return DeadLetterStore(str(tmp_path / 'dead_letters.sqlite'), **kwargs), clock
+
+
+def test_backoff_doubles_with_jitter_up_to_the_cap_then_gives_up(tmp_path, monkeypatch):
+    store, clock = open_store(tmp_path, monkeypatch, max_attempts=5, backoff_base=30, backoff_max=100)
+    row = {'image_id': '7', 'enhanced_description': "a cat"}
+    for delay in (30, 60, 100, 100):
+        store.record('generate', row, 'HTTP 500', 500)
+        wait = store.next_due() - clock.now
+        assert delay / 2 <= wait <= delay
+        assert store.due('generate') == []
+        clock.now += wait
+        assert store.due('generate') == [row]
+
+    store.record('generate', row, 'HTTP 500', 500)
+    assert store.next_due() is None
+    assert store.due('generate', now=clock.now + 10 ** 6) == []
+    assert store.summary() == {('generate', 'HTTP 500'): (1, 1)}
+
+
+def test_deferred_rows_are_due_at_once_and_resolved_rows_dropped(tmp_path, monkeypatch):
+    store, clock = open_store(tmp_path, monkeypatch)
+    variant = {'image_id': '7', 'variant': {'key': 's1_1:1'}}
+    store.defer('generate', variant, 'budget')
+    store.record('describe', {'image_id': '7'}, 'RateLimitError')
+    assert store.due('generate') == [variant]
+
+    # Stages and variants of one image are tracked separately
+    store.resolve('generate', {'image_id': '7'})
+    assert store.due('generate') == [variant]
+    store.resolve('generate', variant)
+    assert store.due('generate') == []
+    assert list(store.summary()) == [('describe', 'RateLimitError')]
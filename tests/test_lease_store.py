@@ -0,0 +1,73 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sharding
+from sharding import LeaseStore
+
+
+class FakeClock:
+    """Stands in for the time module so leases can expire without waiting."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def open_store(tmp_path, monkeypatch, rows=6, **kwargs):
+    clock = FakeClock()
+    monkeypatch.setattr(sharding, 'time', clock)
+    store = LeaseStore(str(tmp_path / 'leases.sqlite'), **kwargs)
+    store.seed({'image_id': str(i), 'description': f"desc {i}"} for i in range(rows))
+    return store, clock
+
+
+def test_workers_claim_disjoint_rows_in_input_order(tmp_path, monkeypatch):
+    store, clock = open_store(tmp_path, monkeypatch)
+    assert store.claim('a', 4, ttl=60) == ['0', '1', '2', '3']
+    assert store.claim('b', 4, ttl=60) == ['4', '5']
+    assert store.claim('c', 4, ttl=60) == []
+    assert [row['description'] for row, _ in store.payloads(['5', '0'])] == ['desc 0', 'desc 5']
+
+
+def test_expired_lease_is_claimed_again_and_keeps_its_description(tmp_path, monkeypatch):
+    store, clock = open_store(tmp_path, monkeypatch, rows=3)
+    assert store.claim('a', 3, ttl=60) == ['0', '1', '2']
+    store.record_enhanced([{'image_id': '1', 'enhanced_description': "kept"}])
+    store.complete('a', ['0'])
+
+    # Worker a stops renewing, e.g. because it crashed
+    clock.now += 61
+    assert store.claim('b', 3, ttl=60) == ['1', '2']
+    assert store.payloads(['1'])[0][1]['enhanced_description'] == "kept"
+
+    # The lease has passed to b, so a late completion from a does not count
+    store.complete('a', ['1'])
+    clock.now += 61
+    assert store.claim('c', 3, ttl=60) == ['1', '2']
+
+
+def test_released_rows_back_off_and_go_to_other_workers_first(tmp_path, monkeypatch):
+    store, clock = open_store(tmp_path, monkeypatch, rows=5, max_attempts=2, backoff=30)
+    assert store.claim('a', 1, ttl=60) == ['0']
+    store.release('a', ['0'])
+    assert store.claim('a', 2, ttl=60) == ['1', '2']
+
+    # Until its backoff has passed, a released row is skipped in favour of new rows
+    clock.now += 29
+    assert store.claim('b', 1, ttl=60) == ['3']
+
+    # Then it goes to another worker ahead of new rows
+    clock.now += 1
+    assert store.claim('b', 1, ttl=60) == ['0']
+    assert store.claim('a', 1, ttl=60) == ['4']
+
+    # The second failure was its last allowed attempt
+    store.complete('a', ['1', '2', '4'])
+    store.complete('b', ['3'])
+    store.release('b', ['0'])
+    clock.now += 3600
+    assert store.claim('c', 5, ttl=60) == []
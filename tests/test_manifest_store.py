@@ -0,0 +1,72 @@
+import csv
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from manifest_store import ENHANCED_COLUMNS, IMAGE_COLUMNS, InOrderWriter, ManifestStore, open_manifest
+
+
+def read_csv(path):
+    with open(path, 'r', newline='', encoding='utf-8') as file:
+        return list(csv.DictReader(file))
+
+
+def test_upsert_updates_only_the_columns_given_and_keeps_the_first_position(tmp_path):
+    store = ManifestStore(str(tmp_path / 'manifest.sqlite'))
+    store.upsert_many([{'image_id': '1', 'context': 'a', 'enhanced_description': 'first'},
+                       {'image_id': '2', 'context': 'b', 'enhanced_description': ''}])
+    store.upsert({'image_id': '1', 'file_name': '1.png'})
+
+    assert store.get('1')['enhanced_description'] == 'first'
+    assert store.get_value('1', 'file_name') == '1.png'
+    assert store.get_value('2', 'enhanced_description') is None
+    assert store.get('3') is None
+    assert store.count('file_name') == 1
+
+    store.export_csv(str(tmp_path / 'images.csv'), IMAGE_COLUMNS)
+    rows = read_csv(tmp_path / 'images.csv')
+    assert [row['image_id'] for row in rows] == ['1', '2']
+    assert rows[0]['file_name'] == '1.png' and rows[1]['file_name'] == ''
+
+
+def test_csv_is_imported_again_only_after_it_changed(tmp_path):
+    csv_path = str(tmp_path / 'enhanced_descriptions.csv')
+    config = {'manifest': {'directory': str(tmp_path / 'manifests')}}
+    store = open_manifest(csv_path, config)
+    store.upsert({'image_id': '1', 'enhanced_description': 'from the store'})
+    store.export_csv(csv_path, ENHANCED_COLUMNS)
+    store.close()
+
+    # Unchanged since the export: the store is used as is
+    store = open_manifest(csv_path, config)
+    assert store.get_value('1', 'enhanced_description') == 'from the store'
+    store.close()
+
+    with open(csv_path, 'w', newline='', encoding='utf-8') as file:
+        file.write("image_id,context,original_description,enhanced_description\n2,c,o,edited by hand\n")
+    store = open_manifest(csv_path, config)
+    assert store.get('1') is None
+    assert store.get_value('2', 'enhanced_description') == 'edited by hand'
+    store.close()
+
+
+def test_in_order_writer_writes_rows_once_every_earlier_row_is_done(tmp_path):
+    store = ManifestStore(str(tmp_path / 'manifest.sqlite'))
+    writer = InOrderWriter(store, batch_size=2)
+    writer.add(1, {'image_id': 'b'})
+    writer.add(2, {'image_id': 'c'})
+    assert len(store) == 0
+
+    # Row 0 unblocks rows 1 and 2; a None row is finished but not written
+    writer.add(0, None)
+    assert [row['image_id'] for row in store.rows()] == ['b', 'c']
+
+    writer.add(4, {'image_id': 'e'})
+    writer.add(3, {'image_id': 'd'})
+    writer.add(6, {'image_id': 'g'})
+    assert len(store) == 4
+
+    # Row 5 never finishes, so flush writes row 6 after it anyway
+    writer.flush()
+    assert [row['image_id'] for row in store.rows()] == ['b', 'c', 'd', 'e', 'g']
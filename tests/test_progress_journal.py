@@ -0,0 +1,35 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from progress_journal import ProgressJournal, journal_path_for, load_journal
+
+
+def test_replay_keeps_the_latest_entry_per_image_and_skips_a_torn_line(tmp_path):
+    path = journal_path_for(str(tmp_path / 'images.csv'))
+    journal = ProgressJournal(path)
+    journal.record({'image_id': 1, 'file_name': 'first.png'})
+    journal.record({'image_id': '2', 'file_name': '2.png'})
+    journal.record({'image_id': '1', 'file_name': 'second.png'})
+    journal.close()
+    # A crash in the middle of a write leaves a partial last line
+    with open(path, 'a', encoding='utf-8') as file:
+        file.write('{"image_id": "3", "file_na')
+
+    entries = load_journal(path)
+    assert sorted(entries) == ['1', '2']
+    assert entries['1']['file_name'] == 'second.png'
+
+
+def test_journal_reopened_after_a_crash_appends_and_discard_removes_it(tmp_path):
+    path = journal_path_for(str(tmp_path / 'images.csv'))
+    assert load_journal(path) == {}
+    ProgressJournal(path).record({'image_id': '1', 'file_name': '1.png'})
+
+    journal = ProgressJournal(path)
+    journal.record({'image_id': '2', 'file_name': '2.png'})
+    assert sorted(load_journal(path)) == ['1', '2']
+    journal.discard()
+    assert not os.path.exists(path)
+    assert load_journal(path) == {}
@@ -0,0 +1,59 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import rate_limiter
+from rate_limiter import TokenBucket
+
+
+class FakeClock:
+    """Stands in for the time module so a limiter can be run for minutes instantly."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # A real sleep always lets some time pass, however short the wait
+        self.now += max(seconds, 1e-6)
+
+
+def tokens_per_minute(monkeypatch, rate_per_minute, request_tokens, minutes):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, 'time', clock)
+    bucket = TokenBucket(rate_per_minute)
+    granted = [0] * minutes
+    while True:
+        bucket.acquire(request_tokens)
+        minute = int(clock.now // 60)
+        if minute >= minutes:
+            return granted
+        granted[minute] += request_tokens
+
+
+def assert_keeps_to_rate(granted, rate_per_minute, request_tokens):
+    # The first minute may also spend the full bucket the limiter starts with
+    sustained = granted[1:]
+    assert sum(sustained) / len(sustained) <= rate_per_minute
+    # Requests are whole, so a single minute can be over by at most the request that straddles its end
+    assert all(tokens <= rate_per_minute + request_tokens for tokens in sustained)
+
+
+def test_requests_larger_than_a_second_of_tokens_keep_to_the_rate(monkeypatch):
+    # One describe request estimates ~846 tokens, more than the 500 a 30000 TPM bucket refills per second
+    granted = tokens_per_minute(monkeypatch, 30000, 846, 10)
+    assert_keeps_to_rate(granted, 30000, 846)
+    assert sum(granted[1:]) / len(granted[1:]) >= 30000 - 846
+
+
+def test_batched_requests_keep_to_the_rate(monkeypatch):
+    granted = tokens_per_minute(monkeypatch, 30000, 6000, 10)
+    assert_keeps_to_rate(granted, 30000, 6000)
+
+
+def test_small_requests_keep_to_the_rate(monkeypatch):
+    granted = tokens_per_minute(monkeypatch, 600, 1, 5)
+    assert_keeps_to_rate(granted, 600, 1)
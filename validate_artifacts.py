@@ -1,58 +1,186 @@
 import os
-import pandas as pd
+import csv
+import json
+import time
+import hashlib
+import tempfile
 import logging
-from PIL import Image
-import yaml
+from concurrent.futures import ProcessPoolExecutor
+from config import SETTINGS
+from postprocess import derivative_keys, get_postprocess_settings, load_derivatives
+from variants import get_variants, image_files, load_variants
+import metrics
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Defaults, overridden by the `validation` section of the config
+DEFAULT_VALIDATION_MODE = "full"  # "full" decodes and verifies, "header" only parses the image header
+DEFAULT_VALIDATION_WORKERS = os.cpu_count() or 1
+DEFAULT_VALIDATION_MANIFEST = ".cache/validation_manifest.json"
+
 def load_config():
     """Load configuration from YAML file."""
-    with open('./configs/images.yml', 'r') as config_file:
-        return yaml.safe_load(config_file)
+    return SETTINGS.images
 
-def is_valid_image(file_path):
+def is_valid_image(file_path, mode=DEFAULT_VALIDATION_MODE):
     """Check if the file is a valid image."""
+    from PIL import Image
+
     try:
         with Image.open(file_path) as img:
-            img.verify()
+            if mode == "full":
+                img.verify()
         return True
     except Exception as e:
         logging.warning(f"Invalid image file: {file_path}. Error: {str(e)}")
         return False
 
+def file_sha256(file_path, chunk_size=1024 * 1024):
+    """Hash a file's contents without loading it all into memory."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def check_file(file_path, mode, known_hash=None):
+    """Verify one file; in full mode hash it first and skip verifying content already known to be good.
+
+    Header mode only opens the file, so it relies on the size/mtime key alone and no hash
+    is computed. Runs in a worker process; returns (valid, sha256 or None, seconds).
+    """
+    start = time.perf_counter()
+    sha256 = file_sha256(file_path) if mode == "full" else None
+    valid = (sha256 is not None and sha256 == known_hash) or is_valid_image(file_path, mode)
+    return valid, sha256, time.perf_counter() - start
+
+def load_manifest(path):
+    """Load the validation manifest: file_name -> {size, mtime_ns, sha256}. Only valid files are kept.
+
+    sha256 is None for files last checked in header mode.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable validation manifest {path}: {e}")
+        return {}
+
+def save_manifest(manifest, path):
+    """Write the manifest atomically so an interrupted run leaves the previous one intact."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=directory)
+    with os.fdopen(fd, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(tmp_path, path)
+
 def validate_artifacts(csv_file, config):
-    """Validate the artifacts listed in the CSV file."""
+    """Validate the artifacts listed in the CSV file.
+    
+    Files whose size and mtime match the manifest from a previous run are trusted without
+    being reopened; the rest are verified (and in full mode hashed) in parallel worker processes.
+    """
     if not os.path.exists(csv_file):
         logging.error(f"CSV file not found: {csv_file}")
         return False
 
-    df = pd.read_csv(csv_file)
+    settings = config.get('validation', {})
+    mode = settings.get('mode', DEFAULT_VALIDATION_MODE)
+    workers = max(1, int(settings.get('workers', DEFAULT_VALIDATION_WORKERS)))
+    manifest_path = settings.get('manifest', DEFAULT_VALIDATION_MANIFEST)
+    manifest = load_manifest(manifest_path)
+
+    postprocess = get_postprocess_settings(config)
+    derivative_specs = postprocess['derivatives'] if postprocess else []
+    variant_keys = [variant['key'] for variant in get_variants(config)]
     output_dir = config['output']['directory']
     valid_count = 0
     invalid_count = 0
+    skipped_count = 0
+    to_check = []
 
-    for _, row in df.iterrows():
-        file_name = row['file_name']
-        if pd.isna(file_name):
-            logging.warning(f"Missing file_name for image_id: {row['image_id']}")
-            invalid_count += 1
-            continue
+    # Every image plus each of its derivatives is an artifact
+    artifacts = []
+    with open(csv_file, 'r', newline='', encoding='utf-8') as file:
+        for row in csv.DictReader(file):
+            image_id, file_name = row['image_id'], row['file_name']
+            if not file_name:
+                logging.warning(f"Missing file_name for image_id: {image_id}")
+                invalid_count += 1
+                continue
+            artifacts.extend(image_files(row))
+            if len(variant_keys) > 1:
+                missing = [key for key in variant_keys if key not in load_variants(row.get('variants'))]
+                if missing:
+                    logging.warning(f"Missing variants {', '.join(missing)} for image_id: {image_id}")
+                    invalid_count += 1
+            derivatives = load_derivatives(row.get('derivatives'))
+            missing = [key for key in derivative_keys(row, derivative_specs) if key not in derivatives]
+            if missing:
+                logging.warning(f"Missing derivatives {', '.join(missing)} for image_id: {image_id}")
+                invalid_count += 1
+            artifacts.extend(derivatives.values())
 
+    start = time.perf_counter()
+    for file_name in artifacts:
         file_path = os.path.join(output_dir, file_name)
-        
-        if not os.path.exists(file_path):
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
             logging.warning(f"File not found: {file_path}")
+            manifest.pop(file_name, None)
             invalid_count += 1
-        elif not is_valid_image(file_path):
-            logging.warning(f"Invalid image file: {file_path}")
-            invalid_count += 1
-        else:
+            continue
+
+        entry = manifest.get(file_name)
+        # Entries recorded in header mode carry no hash, so full mode still verifies those files
+        unchanged = entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+        if unchanged and (entry['sha256'] is not None or mode == "header"):
+            skipped_count += 1
             valid_count += 1
+        else:
+            to_check.append((file_name, file_path, stat, entry['sha256'] if entry else None))
+
+    timings = []
+    if to_check:
+        paths = [file_path for _, file_path, _, _ in to_check]
+        known_hashes = [known_hash for _, _, _, known_hash in to_check]
+        if workers > 1 and len(to_check) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(check_file, paths, [mode] * len(paths), known_hashes, chunksize=16))
+        else:
+            results = [check_file(path, mode, known_hash) for path, known_hash in zip(paths, known_hashes)]
+
+        for (file_name, file_path, stat, _), (valid, sha256, seconds) in zip(to_check, results):
+            timings.append((seconds, file_path))
+            metrics.observe('validation_check_seconds', seconds, mode=mode)
+            logging.debug(f"Checked {file_path} in {seconds * 1000:.1f} ms")
+            if valid:
+                manifest[file_name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+                valid_count += 1
+            else:
+                logging.warning(f"Invalid image file: {file_path}")
+                manifest.pop(file_name, None)
+                invalid_count += 1
+
+    save_manifest(manifest, manifest_path)
+    metrics.inc('validation_files_total', valid_count - skipped_count, result='valid')
+    metrics.inc('validation_files_total', skipped_count, result='unchanged')
+    metrics.inc('validation_files_total', invalid_count, result='invalid')
 
     total_count = valid_count + invalid_count
-    logging.info(f"Validation complete. Total: {total_count}, Valid: {valid_count}, Invalid: {invalid_count}")
+    elapsed = time.perf_counter() - start
+    logging.info(f"Validation complete. Total: {total_count}, Valid: {valid_count}, Invalid: {invalid_count}, "
+                 f"Unchanged (skipped): {skipped_count}, Checked: {len(to_check)} ({mode} mode) in {elapsed:.2f}s")
+    if timings:
+        timings.sort(reverse=True)
+        average_ms = sum(seconds for seconds, _ in timings) / len(timings) * 1000
+        slowest = ", ".join(f"{os.path.basename(path)} ({seconds * 1000:.1f} ms)" for seconds, path in timings[:3])
+        logging.info(f"Per-file check time: avg {average_ms:.1f} ms; slowest: {slowest}")
     
     return invalid_count == 0
 
@@ -63,4 +191,4 @@ if __name__ == "__main__":
     if validate_artifacts(csv_file, config):
         logging.info("All artifacts are valid.")
     else:
-        logging.warning("Some artifacts are invalid or missing. Please check the logs for details.")
\ No newline at end of file
+        logging.warning("Some artifacts are invalid or missing. Please check the logs for details.")
@@ -0,0 +1,79 @@
+import os
+import json
+import itertools
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Defaults, overridden by the `stability_ai.variants` section of the config
+DEFAULT_SEED = 0
+DEFAULT_ASPECT_RATIO = "1:1"
+
+# Aspect ratios accepted by the Stable Diffusion 3 endpoint
+SUPPORTED_ASPECT_RATIOS = ("21:9", "16:9", "3:2", "5:4", "1:1", "4:5", "2:3", "9:16", "9:21")
+
+def variant_key(seed, aspect_ratio):
+    """Short, file-name-safe name of a variant, e.g. s1_16x9."""
+    return f"s{seed}_{aspect_ratio.replace(':', 'x')}"
+
+def get_variants(config):
+    """Every combination of the configured seeds and aspect ratios, in a fixed order.
+
+    Without a `stability_ai.variants` section this is the single variant seed 0, 1:1,
+    the request the pipeline has always sent. Seed 0 asks the API for a random seed.
+    """
+    settings = config.get('stability_ai') or {}
+    matrix = settings.get('variants') or {}
+    if matrix.get('style_presets'):
+        raise ValueError("stability_ai.variants.style_presets is not supported: the SD3 endpoint has no style_preset")
+    seeds = [int(seed) for seed in matrix.get('seeds') or [DEFAULT_SEED]]
+    aspect_ratios = [str(ratio) for ratio in matrix.get('aspect_ratios') or [DEFAULT_ASPECT_RATIO]]
+    unsupported = [ratio for ratio in aspect_ratios if ratio not in SUPPORTED_ASPECT_RATIOS]
+    if unsupported:
+        raise ValueError(f"Unsupported stability_ai.variants.aspect_ratios: {', '.join(unsupported)}")
+
+    variants = {}
+    for seed, aspect_ratio in itertools.product(seeds, aspect_ratios):
+        key = variant_key(seed, aspect_ratio)
+        variants.setdefault(key, {'key': key, 'seed': seed, 'aspect_ratio': aspect_ratio})
+    return list(variants.values())
+
+def variant_file_name(file_name, variant, variants):
+    """File name of one variant of an image; a single variant keeps the plain file name."""
+    if len(variants) == 1:
+        return file_name
+    stem, extension = os.path.splitext(file_name)
+    return f"{stem}_{variant['key']}{extension}"
+
+def load_variants(value):
+    """Parse the variants column (JSON object of variant key -> file name); empty means none."""
+    if not value:
+        return {}
+    try:
+        return json.loads(value)
+    except ValueError:
+        return {}
+
+def image_files(row):
+    """Every image file of a manifest row: file_name and the files of its other variants."""
+    files = [row['file_name']] if row.get('file_name') else []
+    for file_name in load_variants(row.get('variants')).values():
+        if file_name not in files:
+            files.append(file_name)
+    return files
+
+def variant_row(row, files, variants):
+    """Manifest row for the variant images in files (key -> file name), or None if there are none.
+
+    file_name is the first configured variant that exists; the variants column lists all of
+    them and is only written when more than one variant is configured.
+    """
+    ordered = {variant['key']: files[variant['key']] for variant in variants if variant['key'] in files}
+    if not ordered:
+        return None
+    updated = {column: row[column] for column in ('image_id', 'context', 'original_description', 'enhanced_description')}
+    updated['file_name'] = next(iter(ordered.values()))
+    if len(variants) > 1:
+        updated['variants'] = json.dumps(ordered)
+    return updated